@@ -0,0 +1,409 @@
+import logging
+import os
+import json
+import math
+import shutil
+import hashlib
+from array import array
+#####
+import compression
+import date_utils
+import logging_factory
+#####
+from typing import Optional
+#####
+logger_err = logging_factory.get_module_logger("account_matcher_err", logging.ERROR)
+logger = logging_factory.get_module_logger("account_matcher", logging.DEBUG)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Number of candidates considered for each author (the default size of an Elasticsearch search, so that the pairs are
+# the same as with 'questioner.generate_reference_authors')
+max_candidates = 10
+
+# Width (seconds) of the intervals of dates of creation the table is divided into: the accounts are sorted by
+# interval and, inside each one, by comment karma
+bucket_seconds = 86400
+
+# Scale and offset of the comment karma in the sort key of the table (see '_sort_key')
+_key_scale = 1 << 40
+_key_offset = 1 << 39
+
+# Fields of the accounts (in the order of the .csv files)
+account_fields = ("acc_id", "username", "created", "updated", "comment_karma", "link_karma")
+
+# Fields of the accounts that can be looked up (see 'AccountTable.lookup')
+lookup_fields = ("acc_id", "username")
+
+# Arrays of the table saved in its directory (one .npy file each, memory mapped when loaded)
+table_arrays = ("created", "updated", "comment_karma", "link_karma", "order", "rows", "keys", "acc_ids",
+                "acc_id_offsets", "acc_id_hashes", "acc_id_rows", "usernames", "username_offsets",
+                "username_hashes", "username_rows", "source")
+
+
+def similarity_ranges(created: int, comment: int, link: int, days_diff: int, similarity_karma: float):
+    """
+    Function that given the date of creation and the karma punctuations of an account returns the intervals that the
+    similar accounts must be contained in
+
+    :param created: int - date of creation of the account (epoch)
+    :param comment: int - comment karma punctuation
+    :param link: int - link karma punctuation
+    :param days_diff: int - interval of difference in days between accounts creation
+    [base - days, base, base + days]
+    :param similarity_karma: float - (0-1.0] Percentage of deviation of comment and karma punctuations
+    :return: list[list] - the intervals (both ends included) of the date of creation, comment karma and link karma
+    """
+
+    return [[date_utils.substract_days_from_epoch(created, days_diff),
+             date_utils.add_days_to_epoch(created, days_diff)],
+            [comment - comment * similarity_karma, comment + comment * similarity_karma],
+            [link - link * similarity_karma, link + link * similarity_karma]]
+
+
+def read_accounts(path: str):
+    """
+    Given a path to a file containing the information of the accounts (.jsonl or .csv with header, plain or
+    compressed), yields each account
+
+    :param path: str - path to the file
+    :return: generator - the accounts as tuples (same order as 'account_fields')
+    """
+
+    is_csv = ".csv" in os.path.basename(path)
+    with compression.open_file(path, "r") as input_file:
+        if is_csv:
+            next(input_file, None)
+        for line in input_file:
+            try:
+                if is_csv:
+                    usr = line.rstrip("\n").split(",")
+                else:
+                    usr = json.loads(line)
+                    usr = [usr[field] for field in account_fields]
+                yield str(usr[0]), str(usr[1]), int(usr[2]), int(usr[3]), int(usr[4]), int(usr[5])
+            except (ValueError, KeyError, IndexError):
+                logger_err.error("Errored account in file '{}'".format(path))
+
+
+def string_hash(value: str):
+    """
+    Function that returns the hash (64 bits, stable between executions) of a username/account identifier used by the
+    lookup indices of the tables
+
+    :param value: str - the string
+    :return: int - the hash
+    """
+
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class AccountTable:
+    """
+    Table of accounts kept as compact arrays, to look up accounts and find similar accounts (see 'similarity_ranges')
+    without Elasticsearch. The accounts are sorted by day of creation and comment karma, so the accounts of each day in
+    the interval of a query with a similar comment karma are a contiguous slice of the table. The usernames and
+    identifiers are stored (in the order of the file) as a single block of bytes each one and are only decoded for the
+    accounts returned, and they are indexed by their hashes (sorted) for the exact lookups. The table is saved as a
+    directory of .npy files that are memory mapped when loaded, so it's opened without reading it
+    """
+
+    def __init__(self, arrays: dict):
+        """
+        :param arrays: dict - the arrays of the table (see 'from_file')
+        """
+
+        if np is None:
+            raise ImportError("numpy is required to use the account table")
+
+        self.arrays = arrays
+        self.created = arrays["created"]
+        self.comment_karma = arrays["comment_karma"]
+        self.link_karma = arrays["link_karma"]
+        self.updated = arrays["updated"]
+        # Position in the file of each account of the table and position in the table of each account of the file
+        self.order = arrays["order"]
+        self.rows = arrays["rows"]
+        self._keys = arrays["keys"]
+        self._usernames, self._username_offsets = arrays["usernames"], arrays["username_offsets"]
+        self._acc_ids, self._acc_id_offsets = arrays["acc_ids"], arrays["acc_id_offsets"]
+
+    def __len__(self):
+        return len(self.created)
+
+    @classmethod
+    def from_file(cls, path: str):
+        """
+        Builds the table from a file containing the information of the accounts (see 'read_accounts')
+
+        :param path: str - path to the file
+        :return: AccountTable - the table
+        """
+
+        if np is None:
+            raise ImportError("numpy is required to use the account table")
+
+        logger.debug("Loading accounts from '{}'...".format(path))
+        columns = {field: array("q") for field in ("created", "updated", "comment_karma", "link_karma")}
+        acc_ids, usernames = bytearray(), bytearray()
+        acc_id_ends, username_ends = array("q"), array("q")
+        acc_id_hashes, username_hashes = array("Q"), array("Q")
+
+        for acc_id, username, created, updated, comment, link in read_accounts(path):
+            acc_ids += acc_id.encode("utf-8")
+            acc_id_ends.append(len(acc_ids))
+            acc_id_hashes.append(string_hash(acc_id))
+            usernames += username.encode("utf-8")
+            username_ends.append(len(usernames))
+            username_hashes.append(string_hash(username))
+            columns["created"].append(created)
+            columns["updated"].append(updated)
+            columns["comment_karma"].append(comment)
+            columns["link_karma"].append(link)
+
+        created = np.frombuffer(columns["created"], dtype=np.int64)
+        comment = np.frombuffer(columns["comment_karma"], dtype=np.int64)
+        # Stable, so the accounts with the same key keep the order of the file
+        keys = _sort_key(created, comment)
+        order = np.argsort(keys, kind="stable")
+
+        arrays = {field: np.frombuffer(values, dtype=np.int64)[order] for field, values in columns.items()}
+        arrays["order"], arrays["keys"] = order, keys[order]
+        arrays["rows"] = np.empty_like(order)
+        arrays["rows"][order] = np.arange(len(order))
+        arrays["acc_ids"], arrays["acc_id_offsets"] = _strings(acc_ids, acc_id_ends)
+        arrays["acc_id_hashes"], arrays["acc_id_rows"] = _hash_index(acc_id_hashes)
+        arrays["usernames"], arrays["username_offsets"] = _strings(usernames, username_ends)
+        arrays["username_hashes"], arrays["username_rows"] = _hash_index(username_hashes)
+        arrays["source"] = _source_version(path)
+        logger.debug("{} accounts loaded".format(len(order)))
+
+        return cls(arrays)
+
+    @classmethod
+    def open(cls, path: str):
+        """
+        Opens a table saved in a directory (see 'save'), memory mapping its arrays
+
+        :param path: str - path to the directory
+        :return: AccountTable - the table
+        """
+
+        if np is None:
+            raise ImportError("numpy is required to use the account table")
+
+        return cls({key: np.load(os.path.join(path, key + ".npy"), mmap_mode="r") for key in table_arrays})
+
+    @classmethod
+    def load(cls, path: str, cache: bool = True):
+        """
+        Loads the table of a file containing the information of the accounts, from its cache ('<file>.table', see
+        'save') if it was built from the current version of the file
+
+        :param path: str - path to the file
+        :param cache: bool - True to save the cache if it was built
+        :return: AccountTable - the table
+        """
+
+        cache_path = table_path(path)
+        try:
+            table = cls.open(cache_path)
+            if tuple(table.arrays["source"]) == tuple(_source_version(path)):
+                return table
+        except (OSError, IOError, ValueError):
+            pass
+
+        table = cls.from_file(path)
+        if cache:
+            table.save(cache_path)
+
+        return table
+
+    def save(self, path: str):
+        """
+        Saves the arrays of the table in a directory (a .npy file each one), replacing it
+
+        :param path: str - path to the directory to be generated
+        """
+
+        tmp_path = path + ".tmp"
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for key in table_arrays:
+            np.save(os.path.join(tmp_path, key + ".npy"), self.arrays[key])
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+    def account(self, i: int):
+        """
+        Returns the account in a position of the table
+
+        :param i: int - the position (in the order of the table)
+        :return: dict - the information of the account
+        """
+
+        j = int(self.order[i])
+        return {"acc_id": _string(self._acc_ids, self._acc_id_offsets, j),
+                "username": _string(self._usernames, self._username_offsets, j),
+                "created": int(self.created[i]), "updated": int(self.updated[i]),
+                "comment_karma": int(self.comment_karma[i]), "link_karma": int(self.link_karma[i])}
+
+    def lookup(self, values: list, field: str = "username"):
+        """
+        Given a list of usernames/account identifiers, returns their accounts (the first one in the file if there are
+        several with the same value)
+
+        :param values: list[str] - the values to look up
+        :param field: str - the field the values belong to ("username" or "acc_id")
+        :return: list[dict/None] - the account of each value (None if not found)
+        """
+
+        if field not in lookup_fields:
+            raise ValueError("Accounts can only be looked up by: {}".format(", ".join(lookup_fields)))
+
+        data, offsets = self.arrays[field + "s"], self.arrays[field + "_offsets"]
+        hashes, rows = self.arrays[field + "_hashes"], self.arrays[field + "_rows"]
+
+        values = [str(value) for value in values]
+        keys = np.fromiter((string_hash(value) for value in values), dtype=np.uint64, count=len(values))
+        starts = np.searchsorted(hashes, keys, side="left")
+        ends = np.searchsorted(hashes, keys, side="right")
+
+        result = []
+        for value, start, end in zip(values, starts.tolist(), ends.tolist()):
+            account = None
+            # Rows with the same hash, in the order of the file
+            for j in rows[start:end]:
+                if _string(data, offsets, j) == value:
+                    account = self.account(self.rows[j])
+                    break
+            result.append(account)
+
+        return result
+
+    def created_between(self, start: int, end: int, size: Optional[int] = None):
+        """
+        Returns the accounts created in an interval of dates (in the order of the table: by day of creation and
+        comment karma)
+
+        :param start: int - start of the interval (epoch, included)
+        :param end: int - end of the interval (epoch, included)
+        :param size: int/None - maximum number of accounts returned (None -> all)
+        :return: list[dict] - the accounts found
+        """
+
+        # Slice of the days of the interval (the first and the last days are not complete)
+        first = np.searchsorted(self._keys, _bucket_key(int(start) // bucket_seconds, -_key_offset), side="left")
+        last = np.searchsorted(self._keys, _bucket_key(int(end) // bucket_seconds + 1, -_key_offset), side="left")
+        created = self.created[first:last]
+        positions = np.nonzero((created >= start) & (created <= end))[0][:size] + first
+
+        return [self.account(i) for i in positions]
+
+    def candidates(self, ranges: list, size: Optional[int] = None):
+        """
+        Given the intervals of a similar account (see 'similarity_ranges'), returns the first accounts (in the order of
+        the original file) contained in them
+
+        :param ranges: list[list] - the intervals of the date of creation, comment karma and link karma
+        :param size: int/None - maximum number of accounts returned (None -> module default)
+        :return: list[dict] - the accounts found
+        """
+
+        size = size if size is not None else max_candidates
+
+        comment_min, comment_max = math.ceil(ranges[1][0]), math.floor(ranges[1][1])
+        if comment_min > comment_max:
+            return []
+
+        # For each day of the interval of dates, the slice of the accounts with a comment karma in the interval
+        buckets = np.arange(int(ranges[0][0]) // bucket_seconds, int(ranges[0][1]) // bucket_seconds + 1)
+        starts = np.searchsorted(self._keys, _bucket_key(buckets, comment_min), side="left")
+        ends = np.searchsorted(self._keys, _bucket_key(buckets, comment_max), side="right")
+        lengths = ends - starts
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+        # The first and the last days are not complete
+        created, link = self.created[positions], self.link_karma[positions]
+        positions = positions[(created >= ranges[0][0]) & (created <= ranges[0][1]) &
+                              (link >= ranges[2][0]) & (link <= ranges[2][1])]
+
+        # The first ones in the file
+        positions = positions[np.argsort(self.order[positions])[:size]]
+
+        return [self.account(i) for i in positions]
+
+    def similar_candidates(self, authors: list, days_diff: int, similarity_karma: float, size: Optional[int] = None):
+        """
+        Given a list of authors, returns the candidates to be paired with each one of them (see 'candidates'). The
+        table is sorted once (when built) and each author only costs a binary search per day of its interval of dates
+        plus reading the accounts of those days with a similar comment karma: O(authors * (days * log(accounts) +
+        accounts in the slices)), not O(authors * accounts). Searching the slices of all the authors at once was not
+        faster, since reading the slices and building the candidates dominate
+
+        :param authors: list[dict] - the authors (with their date of creation and karma punctuations)
+        :param days_diff: int - interval of difference in days between accounts creation
+        :param similarity_karma: float - (0-1.0] Percentage of deviation of comment and karma punctuations
+        :param size: int/None - maximum number of candidates per author (None -> module default)
+        :return: list[tuple] - for each author, the author and its candidates
+        """
+
+        result = []
+        for author in authors:
+            ranges = similarity_ranges(int(author["created"]), int(author["comment_karma"]),
+                                       int(author["link_karma"]), days_diff, similarity_karma)
+            result.append((author, self.candidates(ranges, size)))
+
+        return result
+
+
+def _sort_key(created, comment):
+    # Day of creation and comment karma (limited to the range of the key)
+    return _bucket_key(created // bucket_seconds, comment)
+
+
+def _bucket_key(bucket, comment):
+    return bucket * _key_scale + np.clip(comment, 1 - _key_offset, _key_offset - 1) + _key_offset
+
+
+def table_path(path: str):
+    """
+    Given a path to a file containing the information of the accounts, returns the path to the directory of its table
+
+    :param path: str - path to the file
+    :return: str - path to the directory
+    """
+
+    return path + ".table"
+
+
+def _source_version(path: str):
+    # Version of the file the table is built from
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def _hash_index(hashes: array):
+    # Sorted hashes and the rows (in the order of the file) they belong to
+    hashes = np.frombuffer(hashes, dtype=np.uint64)
+    rows = np.argsort(hashes, kind="stable")
+    return hashes[rows], rows
+
+
+def _strings(data: bytearray, ends: array):
+    # Block of strings (bytes) and the offsets where each one starts (plus the end of the last one)
+    return np.frombuffer(data, dtype=np.uint8), np.concatenate(([0], np.frombuffer(ends, dtype=np.int64)))
+
+
+def _string(data, offsets, i: int):
+    return bytes(data[offsets[i]:offsets[i + 1]]).decode("utf-8")
+
+# table = AccountTable.load("./data/reddit_users.csv.gz")
+# table.lookup(["username1", "username2"], "username")
@@ -0,0 +1,74 @@
+"""
+Benchmark of the decoding stage of the bulk indexer (see indexer): decodes a synthetic accounts file (.csv.gz) line by
+line in a single process (indexer.decode_file, as the indexer used to do) and in blocks parsed by several processes
+(indexer.csv_bulk_batches, which also builds the bodies of the bulk requests, with pyarrow if installed), and reports
+the rows/sec of each one. No Elasticsearch server is needed
+
+Usage (from the root of the project): python benchmarks/decoder_benchmark.py [--rows 5000000] [--processes N]
+"""
+
+import os
+import sys
+import gzip
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import indexer
+
+
+def generate_accounts(path: str, rows: int):
+    """
+    Function that generates a synthetic accounts file (.csv.gz) with the given number of rows
+
+    :param path: str - path to the file to be generated
+    :param rows: int - number of accounts
+    """
+
+    random.seed(0)
+    with gzip.open(path, "wt", compresslevel=3) as output:
+        output.write(",".join(indexer.es_fields_keys) + "\n")
+        for start in range(0, rows, 100000):
+            lines = []
+            for i in range(start, min(start + 100000, rows)):
+                lines.append("{},user_{},{},{},{},{}\n".format(i, random.randint(0, 10 ** 9),
+                                                              1130000000 + random.randint(0, 5 * 10 ** 8),
+                                                              1600000000, random.randint(-100, 10 ** 5),
+                                                              random.randint(0, 10 ** 5)))
+            output.write("".join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serial vs parallel decoding of an accounts .csv.gz file")
+    parser.add_argument("--path", default="./backups/benchmark_accounts.csv.gz")
+    parser.add_argument("--rows", type=int, default=5000000)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.path):
+        print("Generating synthetic accounts ({} rows)...".format(args.rows))
+        generate_accounts(args.path, args.rows)
+
+    start = time.perf_counter()
+    with gzip.open(args.path, "rt") as fh:
+        serial_rows = sum(1 for _ in indexer.decode_file(fh, True))
+    serial_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parallel_rows = sum(n for n, _ in indexer.csv_bulk_batches(args.path, "benchmark", args.chunk_size,
+                                                               processes=args.processes))
+    parallel_time = time.perf_counter() - start
+
+    assert serial_rows == parallel_rows
+    print("File: {} ({} rows)".format(args.path, serial_rows))
+    print("decode_file:      {:.2f} s ({:.0f} rows/sec)".format(serial_time, serial_rows / serial_time))
+    print("csv_bulk_batches: {:.2f} s ({:.0f} rows/sec, {} processes, bulk bodies included)".format(
+        parallel_time, parallel_rows / parallel_time, args.processes))
+    print("Speedup:          {:.2f}x".format(serial_time / parallel_time))
+
+
+if __name__ == "__main__":
+    main()
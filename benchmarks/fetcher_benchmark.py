@@ -0,0 +1,221 @@
+"""
+Benchmark of the fetch-convert-write pipeline of the fetcher (see fetcher): runs 'extract_historic_for_subreddit',
+'extract_posts_for_interval', 'generate_blocks' and 'search_author_posts' against a synthetic corpus served in-process
+(the psaw paging and wrapping are the real ones, only the HTTP requests are replaced by the searches of
+pushshift_replay.Corpus) and reports, for each one, the docs/sec, the CPU time per record spent in
+'convert_response', the bytes written/sec and the peak RSS. Each benchmark runs in its own process and the results are
+saved as JSON (by default in ./benchmarks/results/, ignored by git), so that they can be compared with a previous run
+(--compare). No network access is needed
+
+Usage (from the root of the project): python benchmarks/fetcher_benchmark.py [--docs 200000] [--output results.json]
+[--compare previous.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fetcher
+import pushshift_replay
+
+# Dates of the synthetic corpus
+corpus_start = 1500000000
+corpus_end = 1600000000
+
+benchmarks = ("extract_historic_for_subreddit", "extract_posts_for_interval", "generate_blocks",
+              "search_author_posts")
+
+
+class ReplayAPI(fetcher.LimitedPushshiftAPI):
+    """
+    Pushshift client whose requests are answered by in-memory corpora instead of the server
+    """
+
+    def __init__(self, corpora: dict):
+        super().__init__(rate_limit_per_minute=60)
+        self.corpora = corpora
+
+    def _get(self, url, payload={}):
+        kind = "comment" if "/comment/" in url else "submission"
+        params = {key: ",".join(str(v) for v in value) if isinstance(value, (list, tuple)) else str(value)
+                  for key, value in payload.items()}
+        return self.corpora[kind].search(params)
+
+
+class ConvertTimer:
+    """
+    Wrapper of 'fetcher.convert_response' that accumulates the CPU time (of the calling thread) spent in it
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.calls = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        start = time.thread_time()
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            elapsed = time.thread_time() - start
+            with self._lock:
+                self.calls += 1
+                self.seconds += elapsed
+
+
+def output_stats(path: str):
+    """
+    Function that returns the number of lines and bytes of the .jsonl files of a directory
+
+    :param path: str - path to the directory
+    :return: tuple - number of lines and bytes
+    """
+
+    lines, size = 0, 0
+    for name in os.listdir(path):
+        if name.endswith(".jsonl"):
+            with open(os.path.join(path, name), "rb") as input_file:
+                for block in iter(lambda: input_file.read(1 << 20), b""):
+                    lines += block.count(b"\n")
+                    size += len(block)
+
+    return lines, size
+
+
+def run_benchmark(name: str, docs: int, authors: int, workers: int, log: bool = False):
+    """
+    Function that runs a benchmark (in a new working directory) and measures it
+
+    :param name: str - the benchmark (see 'benchmarks')
+    :param docs: int - number of documents of the synthetic corpus
+    :param authors: int - number of authors of the corpus ('search_author_posts' searches all of them)
+    :param workers: int - maximum number of intervals searched at the same time ('generate_blocks')
+    :param log: bool - True to keep the debug logs of the fetcher
+    :return: dict - the measures
+    """
+
+    if not log:
+        logging.disable(logging.DEBUG)
+
+    corpus = pushshift_replay.synthetic_corpus(docs, start=corpus_start, end=corpus_end, authors=authors)
+    corpora = {"submission": corpus, "comment": corpus}
+    fetcher.get_api = lambda: ReplayAPI(corpora)
+    timer = ConvertTimer(fetcher.convert_response)
+    fetcher.convert_response = timer
+
+    work_dir = tempfile.mkdtemp(prefix="fetcher_benchmark_")
+    os.chdir(work_dir)
+    os.mkdir("backups")
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start, cpu_start = time.perf_counter(), time.process_time()
+    if name == "extract_historic_for_subreddit":
+        fetcher.extract_historic_for_subreddit("depression", False, corpus_end + 1)
+    elif name == "extract_posts_for_interval":
+        fetcher.extract_posts_for_interval(corpus_end + 1, corpus_start - 1, docs, 0)
+    elif name == "generate_blocks":
+        # Lines of a backup (newest first) to compute the intervals from
+        lines = [json.dumps(doc) + "\n" for doc in reversed(corpus.documents)]
+        fetcher.generate_blocks(lines, False, 1000, 100, corpus_end + 1, 0, max_workers=workers)
+    elif name == "search_author_posts":
+        for i in range(authors):
+            fetcher.search_author_posts("author_{}".format(i), "./backups/authors_posts.jsonl", corpus_end + 1)
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+
+    written, size = output_stats("backups")
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shutil.rmtree(work_dir)
+
+    return {"docs": written, "seconds": elapsed, "cpu_seconds": cpu, "docs_per_sec": written / elapsed,
+            "convert_calls": timer.calls,
+            "convert_cpu_us_per_record": timer.seconds / timer.calls * 1e6 if timer.calls else 0.0,
+            "bytes_written": size, "bytes_per_sec": size / elapsed,
+            "baseline_rss_kb": baseline_rss, "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def git_revision():
+    """
+    Function that returns the current commit of the repository (None if unknown)
+
+    :return: str/None - the commit
+    """
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results: dict, previous_path: str):
+    """
+    Function that prints the change of the measures of each benchmark with respect to a previous run
+
+    :param results: dict - the results of this run
+    :param previous_path: str - path to the results (.json) of the previous run
+    """
+
+    with open(previous_path) as input_file:
+        previous = json.load(input_file)["results"]
+
+    for name, measures in results.items():
+        if name not in previous:
+            continue
+        changes = []
+        for key in ("docs_per_sec", "convert_cpu_us_per_record", "bytes_per_sec", "peak_rss_kb"):
+            if previous[name].get(key):
+                changes.append("{} {:+.1f}%".format(key, (measures[key] / previous[name][key] - 1) * 100))
+        print("{:<32} {}".format(name, ", ".join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the fetch-convert-write pipeline of the fetcher")
+    parser.add_argument("--docs", type=int, default=200000, help="Documents of the synthetic corpus")
+    parser.add_argument("--authors", type=int, default=200, help="Authors of the synthetic corpus")
+    parser.add_argument("--workers", type=int, default=4, help="Intervals searched at the same time")
+    parser.add_argument("--only", nargs="*", choices=benchmarks, default=list(benchmarks))
+    parser.add_argument("--output", default="./benchmarks/results/fetcher_{}.json".format(int(time.time())),
+                        help="Path to save the results (.json)")
+    parser.add_argument("--compare", help="Results (.json) of a previous run")
+    parser.add_argument("--log", action="store_true", help="Keep the debug logs of the fetcher")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.only:
+        # A process per benchmark, so that the peak RSS is its own
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results[name] = executor.submit(run_benchmark, name, args.docs, args.authors, args.workers,
+                                            args.log).result()
+        r = results[name]
+        print("{:<32} {:>8} docs {:>7.2f} s {:>9.0f} docs/sec {:>6.1f} us/record (convert) {:>6.1f} MB/s "
+              "{:>7.0f} MB peak RSS".format(name, r["docs"], r["seconds"], r["docs_per_sec"],
+                                            r["convert_cpu_us_per_record"], r["bytes_per_sec"] / 2 ** 20,
+                                            r["peak_rss_kb"] / 1024))
+
+    report = {"timestamp": int(time.time()), "git_revision": git_revision(), "python": platform.python_version(),
+              "platform": platform.platform(), "cpus": os.cpu_count(),
+              "params": {"docs": args.docs, "authors": args.authors, "workers": args.workers}, "results": results}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print("Results saved in '{}'".format(args.output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
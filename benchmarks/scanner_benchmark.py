@@ -0,0 +1,88 @@
+"""
+Benchmark of the parallel JSONL scanner (see scanner): extracts the set of authors of a synthetic backup line by line in
+a single process (as tools.obtain_usernames used to do) and with scanner.scan, and reports the speedup
+
+Usage (from the root of the project): python benchmarks/scanner_benchmark.py [--size-mb 2048] [--workers N]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import scanner
+import tools
+
+
+def generate_backup(path: str, size_mb: int):
+    """
+    Function that generates a synthetic backup of posts (.jsonl) of the given size
+
+    :param path: str - path to the file to be generated
+    :param size_mb: int - approximate size of the file (MB)
+    """
+
+    random.seed(0)
+    words = ["depression", "reddit", "help", "today", "feel", "people", "life", "work", "time", "friend"]
+    target = size_mb * 1024 * 1024
+    written = 0
+    with open(path, "w") as output:
+        i = 0
+        while written < target:
+            lines = []
+            for _ in range(10000):
+                post = {"id": "p{}".format(i), "url": "https://www.reddit.com/r/test/{}".format(i),
+                        "title": " ".join(random.choices(words, k=8)),
+                        "author": "[deleted]" if i % 50 == 0 else "user_{}".format(random.randint(0, 200000)),
+                        "selftext": " ".join(random.choices(words, k=random.randint(20, 120))),
+                        "created_utc": 1577836800 - i, "subreddit": "test", "num_comments": i % 30, "score": i % 100}
+                lines.append(json.dumps(post) + "\n")
+                i += 1
+            block = "".join(lines)
+            output.write(block)
+            written += len(block)
+
+
+def serial_usernames(path: str):
+    authors = set()
+    with open(path, "r") as input_file:
+        for line in input_file:
+            tools.add_author(authors, json.loads(line))
+    return authors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serial vs parallel scanning of a JSONL backup")
+    parser.add_argument("--path", default="./backups/benchmark_scanner.jsonl")
+    parser.add_argument("--size-mb", type=int, default=2048)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.path):
+        print("Generating synthetic backup ({} MB)...".format(args.size_mb))
+        generate_backup(args.path, args.size_mb)
+    size_mb = os.path.getsize(args.path) / (1024 * 1024)
+
+    start = time.perf_counter()
+    serial = serial_usernames(args.path)
+    serial_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parallel = scanner.scan(args.path, reduce_fn=tools.add_author, initial=set(), combine_fn=set.union,
+                            workers=args.workers)
+    parallel_time = time.perf_counter() - start
+
+    assert serial == parallel
+    print("File: {} ({:.0f} MB), {} authors".format(args.path, size_mb, len(serial)))
+    print("Serial:   {:.2f} s ({:.1f} MB/s)".format(serial_time, size_mb / serial_time))
+    print("Parallel: {:.2f} s ({:.1f} MB/s, {} workers)".format(parallel_time, size_mb / parallel_time,
+                                                                args.workers))
+    print("Speedup:  {:.2f}x".format(serial_time / parallel_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import logging
+import os
+import json
+#####
+import compression
+import logging_factory
+#####
+from typing import Optional
+#####
+logger_err = logging_factory.get_module_logger("columnar_err", logging.ERROR)
+logger = logging_factory.get_module_logger("columnar", logging.DEBUG)
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow, parquet = None, None
+
+# Number of records of each row group of the columnar files
+batch_records = 100000
+
+# Types of the known fields of the posts/comments (the types of the rest of the fields are inferred, see
+# 'inferred_types')
+column_types = {
+    "id": "string", "created_utc": "int64", "retrieved_on": "int64", "num_comments": "int64", "score": "int64",
+    "author": "category", "subreddit": "category", "title": "string", "selftext": "string", "body": "string",
+    "url": "string", "permalink": "string", "link_id": "string", "parent_id": "string", "over_18": "bool",
+    "is_self": "bool"
+}
+
+# Types of the other fields given the types of their values in the whole file. Any other combination (i.e nested
+# objects/lists or mixed types) is saved as JSON text ("json") and decoded when loaded (see 'load_backup')
+inferred_types = {
+    frozenset(): "string", frozenset([str]): "string", frozenset([int]): "int64", frozenset([float]): "double",
+    frozenset([int, float]): "double", frozenset([bool]): "bool"
+}
+
+# Keys of the metadata of the columnar files that identify the version of the .jsonl file they were built from
+source_keys = (b"source_size", b"source_mtime")
+
+# Key of the metadata of the columnar files with the columns saved as JSON text
+json_key = b"json_columns"
+
+
+def columnar_path(path: str):
+    """
+    Given a path to a .jsonl file (plain or compressed), returns the path to its columnar (.parquet) file
+
+    :param path: str - path to the .jsonl file
+    :return: str - path to the .parquet file
+    """
+
+    if compression.codec_of(path) is not None:
+        path = os.path.splitext(path)[0]
+
+    return os.path.splitext(path)[0] + ".parquet"
+
+
+def _source_version(path: str):
+    stat = os.stat(path)
+    return str(stat.st_size).encode(), str(stat.st_mtime_ns).encode()
+
+
+def is_up_to_date(path: str):
+    """
+    Given a path to a .jsonl file, checks whether its columnar file exists and was built from the current version of
+    the file
+
+    :param path: str - path to the .jsonl file
+    :return: bool - True if the columnar file is up to date, False otherwise
+    """
+
+    try:
+        metadata = parquet.read_schema(columnar_path(path)).metadata or {}
+    except (OSError, IOError, pyarrow.ArrowException):
+        return False
+
+    # Files without the JSON columns were built from the fields of the first record only
+    return tuple(metadata.get(key) for key in source_keys) == _source_version(path) and json_key in metadata
+
+
+def scan_fields(path: str):
+    """
+    Given a path to a .jsonl file (plain or compressed), returns its fields (the keys of all its records, in order of
+    appearance) and the types of their values
+
+    :param path: str - path to the .jsonl file
+    :return: dict - for each field, the set of Python types of its values (nulls excluded)
+    """
+
+    fields = {}
+    with compression.open_file(path, "rb") as input_file:
+        for line in input_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            for key, value in record.items():
+                types = fields.get(key)
+                if types is None:
+                    types = fields[key] = set()
+                if value is not None:
+                    types.add(type(value))
+
+    return fields
+
+
+def _arrow_type(name: str):
+    if name == "category":
+        return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    if name == "json":
+        return pyarrow.string()
+
+    return pyarrow.type_for_alias(name)
+
+
+def _cast_value(value, name: str):
+    if value is None:
+        return None
+    try:
+        if name == "int64":
+            return int(value)
+        if name == "double":
+            return float(value)
+        if name == "bool":
+            return bool(value)
+    except (TypeError, ValueError):
+        return None
+
+    return value if isinstance(value, str) and name != "json" else json.dumps(value)
+
+
+def _write_batch(writer, schema, names: dict, batch: list):
+    arrays = []
+    for field in schema:
+        name = names[field.name]
+        values = [_cast_value(record.get(field.name), name) for record in batch]
+        if name == "category":
+            arrays.append(pyarrow.array(values, pyarrow.string()).dictionary_encode())
+        else:
+            arrays.append(pyarrow.array(values, field.type))
+    writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+
+def convert(path: str, columns: Optional[list] = None, types: Optional[dict] = None):
+    """
+    Given a path to a .jsonl file (plain or compressed), converts it (streaming it by batches) to a typed columnar
+    file (.parquet, next to the .jsonl file). The known fields are typed (see 'column_types'), the types of the rest
+    are inferred from their values (see 'inferred_types') and nested values are saved as JSON text. Unless all the
+    columns have a known type, the file is read twice (the first time to find its fields and their types). The
+    columnar file is replaced atomically and records the version of the .jsonl file it was built from
+
+    :param path: str - path to the .jsonl file
+    :param columns: list[str]/None - columns to save (None -> all the fields of the records)
+    :param types: dict/None - types of other columns (column -> "string", "int64", "double", "bool", "category" or
+    "json"), overriding 'column_types'
+    :return: str - path to the .parquet file
+    """
+
+    if pyarrow is None:
+        raise ImportError("pyarrow is required to build the columnar files")
+
+    save_path = columnar_path(path)
+    tmp_path = save_path + ".tmp"
+    version = _source_version(path)
+    logger.debug("Converting '{}' to columnar format...".format(path))
+
+    known = dict(column_types, **(types or {}))
+    fields = {} if columns is not None and all(column in known for column in columns) else scan_fields(path)
+    columns = columns if columns is not None else list(fields)
+    names = {column: known[column] if column in known else inferred_types.get(frozenset(fields.get(column, ())), "json")
+             for column in columns}
+
+    metadata = dict(zip(source_keys, version))
+    metadata[json_key] = json.dumps([column for column in columns if names[column] == "json"]).encode()
+    schema = pyarrow.schema([(column, _arrow_type(names[column])) for column in columns], metadata=metadata)
+
+    batch, records = [], 0
+    with compression.open_file(path, "rb") as input_file, parquet.ParquetWriter(tmp_path, schema) as writer:
+        for line in input_file:
+            try:
+                batch.append(json.loads(line))
+            except ValueError:
+                logger_err.error("Errored line in file '{}'".format(path))
+                continue
+
+            if len(batch) >= batch_records:
+                _write_batch(writer, schema, names, batch)
+                records += len(batch)
+                batch = []
+
+        if batch:
+            _write_batch(writer, schema, names, batch)
+            records += len(batch)
+    os.replace(tmp_path, save_path)
+
+    logger.debug("{} records saved in '{}'".format(records, save_path))
+
+    return save_path
+
+
+def load_backup(path: str, columns: Optional[list] = None):
+    """
+    Given a path to a .jsonl file (plain or compressed), loads it as a DataFrame reading only the given columns from
+    its columnar file (built or rebuilt first if it's missing or the .jsonl file changed). Without pyarrow, the .jsonl
+    file is read directly. The columns saved as JSON text are decoded
+
+    :param path: str - path to the .jsonl file
+    :param columns: list[str]/None - columns to load (None -> all)
+    :return: pandas.DataFrame - the records
+    """
+
+    if pyarrow is None:
+        import pandas as pd
+
+        logger.debug("pyarrow not installed, reading '{}' as .jsonl".format(path))
+        with compression.open_file(path, "r") as input_file:
+            data = pd.read_json(input_file, lines=True)
+        return data[columns] if columns is not None else data
+
+    if not is_up_to_date(path):
+        convert(path)
+
+    table = parquet.read_table(columnar_path(path), columns=columns)
+    data = table.to_pandas()
+    for column in json.loads((table.schema.metadata or {}).get(json_key, b"[]")):
+        if column in data:
+            data[column] = data[column].map(lambda value: json.loads(value) if isinstance(value, str) else None)
+
+    return data
+
+
+# load_backup("./backups/subr_author_posts.jsonl", ["author", "subreddit", "created_utc"])
@@ -0,0 +1,331 @@
+import logging
+import os
+import io
+import gzip
+import struct
+from array import array
+#####
+import logging_factory
+#####
+from typing import Optional
+#####
+logger_err = logging_factory.get_module_logger("compression_err", logging.ERROR)
+logger = logging_factory.get_module_logger("compression", logging.DEBUG)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compression levels (chosen for throughput rather than ratio)
+gzip_level = 3
+zstd_level = 3
+
+# Size (uncompressed bytes) of the blocks of the compressed files
+block_size = 4 * 1024 * 1024
+
+# Extensions of the compressed files
+extensions = {".gz": "gzip", ".zst": "zstd"}
+
+# Typical compression ratio of the .jsonl files of each codec (used when the uncompressed size can't be read)
+compression_ratios = {"gzip": 5, "zstd": 6}
+
+# Sidecar file with the blocks of a compressed file ('<file>.blocks'): for each block, its start and end offsets in the
+# compressed file and its number of lines (-1 if unknown). Every block is an independent gzip member/zstd frame that
+# only contains complete lines, so the file can be read from any block (and is still a valid .gz/.zst file)
+block_entry = struct.Struct("<qqq")
+
+
+def codec_of(path: str):
+    """
+    Function that given a path to a file returns its compression (based on its extension)
+
+    :param path: str - path to the file
+    :return: str/None - "gzip", "zstd" or None if not compressed
+    """
+
+    codec = extensions.get(os.path.splitext(path)[1])
+    if codec == "zstd" and zstandard is None:
+        raise ImportError("zstandard is required to use .zst files")
+
+    return codec
+
+
+def blocks_path(path: str):
+    """
+    Given a path to a compressed file, returns the path to its blocks sidecar
+
+    :param path: str - path to the compressed file
+    :return: str - path to the sidecar
+    """
+
+    return path + ".blocks"
+
+
+def compress(data: bytes, codec: str, level: Optional[int] = None):
+    """
+    Function that compresses some data as an independent gzip member/zstd frame
+
+    :param data: bytes - the data to compress
+    :param codec: str - "gzip" or "zstd"
+    :param level: int/None - compression level (None -> module default)
+    :return: bytes - the compressed data
+    """
+
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level if level is not None else zstd_level).compress(data)
+
+    return gzip.compress(data, compresslevel=level if level is not None else gzip_level)
+
+
+def decompress(data: bytes, codec: str):
+    """
+    Function that decompresses some data (one or several consecutive gzip members/zstd frames)
+
+    :param data: bytes - the compressed data
+    :param codec: str - "gzip" or "zstd"
+    :return: bytes - the decompressed data
+    """
+
+    if codec == "zstd":
+        with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True) as reader:
+            return reader.read()
+
+    return gzip.decompress(data)
+
+
+def load_blocks(path: str):
+    """
+    Given a path to a compressed file, returns its blocks (only if the sidecar covers the whole file)
+
+    :param path: str - path to the compressed file
+    :return: list[tuple]/None - start offset, end offset and number of lines of each block (None if there is no valid
+    sidecar)
+    """
+
+    data = array("q")
+    try:
+        with open(blocks_path(path), "rb") as sidecar:
+            data.frombytes(sidecar.read())
+    except (OSError, IOError, ValueError):
+        return None
+
+    blocks = list(zip(data[0::3], data[1::3], data[2::3]))
+    end = blocks[-1][1] if blocks else 0
+
+    return blocks if end == os.path.getsize(path) else None
+
+
+def open_file(path: str, mode: str = "r", level: Optional[int] = None):
+    """
+    Function that opens a file (plain or compressed, based on its extension) in the same way as the built-in 'open'.
+    Compressed files are written in blocks (see 'BlockWriter')
+
+    :param path: str - path to the file
+    :param mode: str - "r", "w" or "a" (text), "rb", "wb" or "ab" (binary)
+    :param level: int/None - compression level (None -> module default)
+    :return: file object
+    """
+
+    codec = codec_of(path)
+    if codec is None:
+        return open(path, mode)
+
+    binary = "b" in mode
+    base = mode.replace("b", "").replace("t", "")
+
+    if base == "r":
+        raw = open(path, "rb")
+        if codec == "zstd":
+            stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True))
+        else:
+            stream = gzip.GzipFile(fileobj=raw, mode="rb")
+            # Close the underlying file along with the stream
+            stream.myfileobj = raw
+    else:
+        stream = BlockWriter(path, base, level)
+
+    return stream if binary else io.TextIOWrapper(stream, encoding="utf-8")
+
+
+class BlockWriter(io.RawIOBase):
+    """
+    Writer of compressed files in independent blocks of complete lines (see 'block_entry'), so that they can be split
+    to be read in parallel or from any block
+    """
+
+    def __init__(self, path: str, mode: str = "w", level: Optional[int] = None, size: Optional[int] = None):
+        """
+        :param path: str - path to the compressed file
+        :param mode: str - "a" to append to the file, "w" to overwrite it
+        :param level: int/None - compression level (None -> module default)
+        :param size: int/None - size (uncompressed bytes) of the blocks (None -> module default)
+        """
+
+        super().__init__()
+        self.path = path
+        self.codec = codec_of(path)
+        self.level = level
+        self.block_size = size if size is not None else block_size
+
+        self._file = open(path, mode + "b")
+        self._buffer = bytearray()
+        self.offset = self._file.seek(0, 2)
+
+        if mode == "w" or load_blocks(path) is None:
+            with open(blocks_path(path), "wb") as sidecar:
+                # Contents not written in blocks are considered a single block
+                if self.offset > 0:
+                    sidecar.write(block_entry.pack(0, self.offset, -1))
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._buffer += data
+
+        if len(self._buffer) >= self.block_size:
+            cut = self._buffer.rfind(b"\n") + 1
+            if cut > 0:
+                self._write_block(bytes(self._buffer[:cut]))
+                del self._buffer[:cut]
+
+        return len(data)
+
+    def _write_block(self, data: bytes):
+        compressed = compress(data, self.codec, self.level)
+        self._file.write(compressed)
+        with open(blocks_path(self.path), "ab") as sidecar:
+            sidecar.write(block_entry.pack(self.offset, self.offset + len(compressed), data.count(b"\n")))
+        self.offset += len(compressed)
+
+    def flush(self):
+        """
+        Writes all the buffered data to the file as a block
+        """
+
+        if not self.closed and self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer = bytearray()
+            self._file.flush()
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self._file.close()
+        super().close()
+
+
+def count_lines(path: str):
+    """
+    Given a path to a compressed file, returns its number of lines using its blocks (without decompressing it)
+
+    :param path: str - path to the compressed file
+    :return: int/None - the number of lines (None if unknown)
+    """
+
+    blocks = load_blocks(path)
+    if blocks is None or any(lines < 0 for _, _, lines in blocks):
+        return None
+
+    return sum(lines for _, _, lines in blocks)
+
+
+def _block_size(file, start: int, end: int, codec: str):
+    # Uncompressed size of a block written by 'BlockWriter' (from the gzip trailer or the zstd frame header)
+    if codec == "zstd":
+        file.seek(start)
+        size = zstandard.frame_content_size(file.read(min(end - start, 18)))
+        return size if size >= 0 else None
+
+    file.seek(end - 4)
+    return struct.unpack("<I", file.read(4))[0]
+
+
+def uncompressed_size(path: str):
+    """
+    Given a path to a file (plain or compressed), returns its size once decompressed. For the compressed files, it's
+    read from the blocks (see 'block_entry') without decompressing them; the blocks not written by 'BlockWriter' (or
+    files without sidecar) are estimated from the typical compression ratio of the codec (see 'compression_ratios')
+
+    :param path: str - path to the file
+    :return: int - the size (bytes) of the uncompressed contents
+    """
+
+    codec = codec_of(path)
+    if codec is None:
+        return os.path.getsize(path)
+
+    blocks = load_blocks(path)
+    if blocks is None:
+        return os.path.getsize(path) * compression_ratios[codec]
+
+    total = 0
+    with open(path, "rb") as file:
+        for start, end, lines in blocks:
+            # A block of unknown lines may be made of several gzip members/zstd frames
+            size = _block_size(file, start, end, codec) if lines >= 0 and end > start else None
+            total += size if size is not None else (end - start) * compression_ratios[codec]
+
+    return total
+
+
+def read_blocks(path: str, start: int, end: int):
+    """
+    Given a path to a compressed file and a range of offsets (starting and ending at block boundaries), yields the
+    decompressed lines of the blocks in the range (decompressing them one at a time)
+
+    :param path: str - path to the compressed file
+    :param start: int - start offset of the first block
+    :param end: int - end offset of the last block
+    :return: generator - the lines (bytes)
+    """
+
+    codec = codec_of(path)
+    blocks = load_blocks(path)
+    if blocks is None:
+        blocks = [(0, os.path.getsize(path), -1)]
+
+    with open(path, "rb") as file:
+        for block_start, block_end, _ in blocks:
+            if block_start < start or block_end > end:
+                continue
+            file.seek(block_start)
+            yield from io.BytesIO(decompress(file.read(block_end - block_start), codec))
+
+
+def truncate(path: str, offset: int):
+    """
+    Given a path to a compressed file and an offset (at a block boundary), discards all the blocks after the offset
+
+    :param path: str - path to the compressed file
+    :param offset: int - the size (bytes) of the file once truncated
+    """
+
+    blocks = load_blocks(path) or []
+    with open(path, "ab") as file:
+        file.truncate(offset)
+    with open(blocks_path(path), "wb") as sidecar:
+        for block in blocks:
+            if block[1] <= offset:
+                sidecar.write(block_entry.pack(*block))
+
+
+def replace(src: str, dst: str):
+    """
+    Moves a file (and its blocks sidecar, if any) replacing the destination
+
+    :param src: str - path to the file to move
+    :param dst: str - path to the destination
+    """
+
+    os.replace(src, dst)
+    if os.path.isfile(blocks_path(src)):
+        os.replace(blocks_path(src), blocks_path(dst))
+    elif os.path.isfile(blocks_path(dst)):
+        os.remove(blocks_path(dst))
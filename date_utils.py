@@ -87,3 +87,24 @@ def substract_days_from_epoch(date_epoch: int, d: int):
         return date_epoch
     else:
         return int((convert_to_iso_date(date_epoch) + relativedelta(days=-d)).timestamp())
+
+
+def split_interval(start_epoch: int, end_epoch: int, n: int):
+    """
+    Function that given an interval of epochs splits it into (at most) n consecutive windows of the same length
+
+    :param start_epoch: int - the oldest epoch of the interval
+    :param end_epoch: int - the newest epoch of the interval
+    :param n: int - the number of windows
+    :return: list[int] - the boundaries of the windows, from the oldest to the newest (both ends included)
+    """
+
+    if end_epoch <= start_epoch:
+        raise ValueError("Empty interval: [{} - {}]".format(start_epoch, end_epoch))
+    if n < 1:
+        raise ValueError("The number of windows must be at least 1: {}".format(n))
+
+    n = min(n, end_epoch - start_epoch)
+    step = (end_epoch - start_epoch) / n
+
+    return [start_epoch + round(step * i) for i in range(n)] + [end_epoch]
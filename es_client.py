@@ -0,0 +1,220 @@
+import logging
+import os
+import time
+import socket
+import threading
+from collections import deque
+#####
+import logging_factory
+#####
+from elasticsearch import Elasticsearch, TransportError
+from elasticsearch.connection import Urllib3HttpConnection
+from typing import Optional
+#####
+logger_err = logging_factory.get_module_logger("es_client_err", logging.ERROR)
+logger = logging_factory.get_module_logger("es_client", logging.DEBUG)
+
+# Elasticsearch servers ('ES_HOSTS': comma separated list of host:port, or 'ES_HOST' and 'ES_PORT' for a single one)
+es_hosts = [{"host": host.split(":")[0], "port": int(host.split(":")[1]) if ":" in host else 9200}
+            for host in os.environ.get("ES_HOSTS", "").split(",") if host] or \
+           [{"host": os.environ.get("ES_HOST", "localhost"), "port": int(os.environ.get("ES_PORT", 9200))}]
+
+# Default settings of the clients: connections per server, timeout (seconds) of each request, retries of the failed
+# requests (also of the timed out ones), gzip compression of the bodies and TCP keep-alive of the idle connections
+pool_size = int(os.environ.get("ES_POOL_SIZE", 10))
+timeout = float(os.environ.get("ES_TIMEOUT", 30))
+max_retries = int(os.environ.get("ES_MAX_RETRIES", 3))
+retry_on_timeout = os.environ.get("ES_RETRY_ON_TIMEOUT", "1") == "1"
+http_compress = os.environ.get("ES_HTTP_COMPRESS", "0") == "1"
+keep_alive = True
+
+# Number of latencies kept per endpoint to compute the percentiles
+latency_samples = 10000
+
+# Clients shared by the whole process (see 'get_client') and statistics of their requests (see 'get_stats')
+_clients = {}
+_clients_lock = threading.Lock()
+_stats = {}
+_stats_lock = threading.Lock()
+_in_flight = {"current": 0, "max": 0}
+
+
+def hosts_description():
+    """
+    Function that returns the servers the clients connect to (for the logs)
+
+    :return: str - the servers (host:port, comma separated)
+    """
+
+    return ",".join("{}:{}".format(host["host"], host["port"]) for host in es_hosts)
+
+
+def endpoint_of(method: str, url: str):
+    """
+    Function that given a request returns the endpoint it's accounted in (the method and the first API path component
+    of the url, i.e "POST _bulk", "GET _search")
+
+    :param method: str - the HTTP method
+    :param url: str - the url (path) of the request
+    :return: str - the endpoint
+    """
+
+    parts = [part for part in url.split("?")[0].split("/") if part]
+    api = next((part for part in parts if part.startswith("_")), parts[0] if parts else "/")
+
+    return "{} {}".format(method, api)
+
+
+def record_request(endpoint: str, seconds: float, sent: int, received: int, failed: bool):
+    """
+    Function that records a request made by a client
+
+    :param endpoint: str - the endpoint of the request (see 'endpoint_of')
+    :param seconds: float - latency of the request
+    :param sent: int - size (bytes) of the body of the request
+    :param received: int - size (bytes) of the body of the response
+    :param failed: bool - True if the request failed (connection error or unexpected error status)
+    """
+
+    with _stats_lock:
+        stats = _stats.get(endpoint)
+        if stats is None:
+            stats = _stats[endpoint] = {"requests": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                        "bytes_sent": 0, "bytes_received": 0,
+                                        "latencies": deque(maxlen=latency_samples)}
+        stats["requests"] += 1
+        stats["errors"] += int(failed)
+        stats["seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        stats["bytes_sent"] += sent
+        stats["bytes_received"] += received
+        stats["latencies"].append(seconds)
+
+
+def _percentile(values: list, percent: float):
+    return values[min(len(values) - 1, int(len(values) * percent))] if values else 0.0
+
+
+def get_stats():
+    """
+    Function that returns the statistics of the requests made by the clients since the start (or the last reset)
+
+    :return: dict - for each endpoint: number of requests and errors, total, mean, p50, p95 and maximum latency
+    (seconds) and bytes sent/received; and the maximum number of requests in flight at the same time ("in_flight")
+    """
+
+    with _stats_lock:
+        result = {}
+        for endpoint, stats in _stats.items():
+            latencies = sorted(stats["latencies"])
+            result[endpoint] = {"requests": stats["requests"], "errors": stats["errors"],
+                                "seconds": stats["seconds"], "mean_seconds": stats["seconds"] / stats["requests"],
+                                "p50_seconds": _percentile(latencies, 0.5), "p95_seconds": _percentile(latencies, 0.95),
+                                "max_seconds": stats["max_seconds"], "bytes_sent": stats["bytes_sent"],
+                                "bytes_received": stats["bytes_received"]}
+        result["in_flight"] = _in_flight["max"]
+
+    return result
+
+
+def reset_stats():
+    """
+    Function that discards the statistics of the requests made until now
+    """
+
+    with _stats_lock:
+        _stats.clear()
+        _in_flight["max"] = _in_flight["current"]
+
+
+def log_stats():
+    """
+    Function that logs a summary of the statistics of the requests (see 'get_stats')
+    """
+
+    stats = get_stats()
+    in_flight = stats.pop("in_flight")
+    for endpoint, s in sorted(stats.items(), key=lambda item: -item[1]["seconds"]):
+        logger.debug("{}: {} requests ({} errors), {:.2f} s (mean {:.3f} s, p95 {:.3f} s, max {:.3f} s), "
+                     "{:.1f} MB sent, {:.1f} MB received".format(endpoint, s["requests"], s["errors"], s["seconds"],
+                                                                  s["mean_seconds"], s["p95_seconds"], s["max_seconds"],
+                                                                  s["bytes_sent"] / 2 ** 20,
+                                                                  s["bytes_received"] / 2 ** 20))
+    logger.debug("Maximum requests in flight: {}".format(in_flight))
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    return len(body.encode("utf-8")) if isinstance(body, str) else len(body)
+
+
+class InstrumentedConnection(Urllib3HttpConnection):
+    """
+    Connection to an Elasticsearch server that records the latency and the size of the bodies of every request (see
+    'record_request') and enables TCP keep-alive in its connections
+    """
+
+    def __init__(self, *args, keep_alive: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        if keep_alive:
+            self.pool.conn_kw["socket_options"] = self.pool.ConnectionCls.default_socket_options + \
+                [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        with _stats_lock:
+            _in_flight["current"] += 1
+            _in_flight["max"] = max(_in_flight["max"], _in_flight["current"])
+
+        start, received, failed = time.perf_counter(), 0, True
+        try:
+            status, response_headers, data = super().perform_request(method, url, params, body, timeout, ignore,
+                                                                     headers)
+            # Errored responses raise an exception unless they were expected (ignored)
+            received, failed = _body_size(data), False
+            return status, response_headers, data
+        except TransportError as e:
+            # Missing resources of the HEAD requests (i.e indices.exists) are not errors
+            failed = not (method == "HEAD" and e.status_code == 404)
+            raise
+        finally:
+            with _stats_lock:
+                _in_flight["current"] -= 1
+            record_request(endpoint_of(method, url), time.perf_counter() - start, _body_size(body), received, failed)
+
+
+def create_client(pool: Optional[int] = None, **kwargs):
+    """
+    Function that creates an Elasticsearch client with the module settings (servers, pool size, timeout, retries,
+    compression and keep-alive) whose requests are instrumented (see 'get_stats')
+
+    :param pool: int/None - number of connections per server (None -> module default)
+    :param kwargs: other arguments of the client, overriding the module settings
+    :return: Elasticsearch - the client
+    """
+
+    settings = {"hosts": es_hosts, "maxsize": pool if pool is not None else pool_size, "timeout": timeout,
+                "max_retries": max_retries, "retry_on_timeout": retry_on_timeout, "http_compress": http_compress,
+                "keep_alive": keep_alive, "connection_class": InstrumentedConnection}
+    settings.update(kwargs)
+
+    return Elasticsearch(**settings)
+
+
+def get_client(pool: Optional[int] = None):
+    """
+    Function that returns the client shared by the whole process for a pool size (created the first time it's
+    requested). The clients are thread safe, so each one can be used by as many threads as connections it has
+
+    :param pool: int/None - number of connections per server (None -> module default)
+    :return: Elasticsearch - the shared client
+    """
+
+    pool = pool if pool is not None else pool_size
+    with _clients_lock:
+        if pool not in _clients:
+            _clients[pool] = create_client(pool)
+        return _clients[pool]
+
+# es = get_client(8)
+# log_stats()
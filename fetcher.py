@@ -2,20 +2,111 @@ import logging
 import time
 import json
 import os
+import threading
+import requests
 #####
+import compression
 import file_manager
 import logging_factory
 import date_utils
 import indexer
+import line_index
 import questioner
+import rate_limiter
+import record_writer
 import tools
 #####
 from psaw import PushshiftAPI
 from typing import Optional, Iterable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 #####
 logger_err = logging_factory.get_module_logger("fetcher_err", logging.ERROR)
 logger = logging_factory.get_module_logger("fetcher", logging.DEBUG)
 
+# Base URL of the Pushshift API (None -> official API), i.e "http://localhost:8080" to use a local server
+pushshift_url = os.environ.get("PUSHSHIFT_URL")
+
+# Extension of the backups generated (".jsonl", or ".jsonl.gz"/".jsonl.zst" to compress them, see compression)
+backup_extension = os.environ.get("BACKUP_EXTENSION", ".jsonl")
+
+# Keep the line index ('.idx', see line_index) of the uncompressed backups up to date while they are written
+index_backups = True
+
+# Date of the oldest post available in Pushshift (23 June 2005 00:00:00 (GMT +00:00))
+pushshift_first_date = 1119484800
+
+# Cache of the counts of posts of the authors (see 'count_author_posts')
+_author_posts_counts = {}
+_author_posts_counts_lock = threading.Lock()
+
+# Rate limit of the server (learnt from the /meta endpoint the first time a client is created)
+server_rate_limit = None
+_server_rate_limit_lock = threading.Lock()
+
+_created_utc = file_manager.line_key("created_utc")
+
+
+class LimitedPushshiftAPI(PushshiftAPI):
+    """
+    Pushshift client whose requests are limited by the rate limiter shared by the whole process (instead of by the
+    rate limit of each client), which is adapted when the server throttles or fails
+    """
+
+    def _get(self, url, payload={}):
+        limiter = rate_limiter.get_limiter()
+
+        for i in range(self.max_retries):
+            limiter.acquire()
+            try:
+                response = requests.get(url, params=payload, proxies=self.proxies)
+            except requests.ConnectionError:
+                limiter.report(None)
+                logger_err.error("Connection error with Pushshift, retrying ({}/{})".format(i + 1, self.max_retries))
+                continue
+
+            limiter.report(response.status_code)
+            if response.status_code == 200:
+                return json.loads(response.text)
+            logger_err.error("Got non 200 code {} from Pushshift, retrying ({}/{})".format(response.status_code, i + 1,
+                                                                                          self.max_retries))
+
+        raise Exception("Unable to connect to pushshift.io. Max retries exceeded.")
+
+
+def get_api():
+    """
+    Function that creates a new client of the Pushshift API (pointing to the URL configured in the module, if any).
+    All the clients share the same rate limiter
+
+    :return: LimitedPushshiftAPI - the client
+    """
+
+    global server_rate_limit
+
+    # The rate limit is provided so that the client doesn't query the /meta endpoint (only done once, below)
+    api = LimitedPushshiftAPI(rate_limit_per_minute=60)
+    if pushshift_url is not None:
+        api._base_url = pushshift_url.rstrip("/") + "/{{endpoint}}"
+
+    with _server_rate_limit_lock:
+        if server_rate_limit is None:
+            server_rate_limit = api._get(api.base_url.format(endpoint="meta")).get("server_ratelimit_per_minute", 60)
+            rate_limiter.get_limiter().set_max_rate(server_rate_limit)
+            logger.debug("Pushshift rate limit: {} requests/minute".format(server_rate_limit))
+
+    return api
+
+
+def get_rate_limiter_stats():
+    """
+    Function that returns the state of the rate limiter shared by all the clients of the Pushshift API
+
+    :return: dict - current and maximum rate (requests per minute), tokens available and number of requests waiting
+    """
+
+    return rate_limiter.get_limiter().stats()
+
 
 def convert_response(data: dict, full_data: bool, comment: bool = False):
     """
@@ -57,75 +148,308 @@ def convert_response(data: dict, full_data: bool, comment: bool = False):
     return updated_data
 
 
+def interrupted_start_date(subreddit: str, comments: bool, sharded: bool = False):
+    """
+    Function that given a subreddit, returns the date the last interrupted historical search of the subreddit was
+    started from (the date in the name of its file), so that it can be resumed without knowing that date
+
+    :param subreddit: str - the subreddit name
+    :param comments: bool - True for the searches of comments, False for submissions
+    :param sharded: bool - True for the sharded searches (see 'extract_historic_for_subreddit_sharded')
+    :return: int/None - the date of the newest interrupted search (None if there is none)
+    """
+
+    import re
+
+    file_str = "comments" if comments else "posts"
+    suffix = "_shards" if sharded else re.escape(backup_extension + ".ckpt")
+    pattern = re.compile(r"^r_{}_{}_(\d+)_base{}$".format(re.escape(subreddit), file_str, suffix))
+
+    dates = []
+    for name in os.listdir("./backups/") if os.path.isdir("./backups/") else []:
+        match = pattern.match(name)
+        if match is None:
+            continue
+        if not sharded:
+            # Only the searches not completed (and with the same parameters)
+            checkpoint = file_manager.load_checkpoint(
+                os.path.join("./backups/", name[:-len(".ckpt")]),
+                {"subreddit": subreddit, "comments": comments, "after": None, "before": int(match.group(1))})
+            if checkpoint is None or checkpoint["completed"]:
+                continue
+        dates.append(int(match.group(1)))
+
+    return max(dates) if dates else None
+
+
 def extract_historic_for_subreddit(subreddit: str, comments: bool = False, start_date: Optional[int] = None):
     """
     Function that given a subreddit and the date to search from, performs a full historical search of all the posts
-    of that subreddit and dumps them to a file
+    of that subreddit and dumps them to a file (if a previous search with the same date was interrupted, it is resumed
+    from its checkpoint). Without date, the last interrupted search of the subreddit is resumed (if any, see
+    'interrupted_start_date')
 
     :param subreddit: str - the subreddit name
-    :param start_date: [int]/None - the base date to search from
+    :param start_date: [int]/None - the base date to search from (None -> date of the interrupted search, or the
+    current date)
     :param comments: bool - True if you want to extract the comments, False for submissions
+    :return: dict - elapsed time performing the search and number of successfully saved documents
     """
 
     # To put the timestamp in the filename
     timestamp = date_utils.get_current_date(False)
 
-    # API
-    api = PushshiftAPI()
-
-    ###
-
     file_str = "comments" if comments else "posts"
 
-    # Count of correct docs saved
-    ok_docs = 0
-
     # Measure elapsed time
     start = time.time()
 
     logger.debug("Starting generation of '{}' ({}) subreddit historic...".format(subreddit, file_str))
 
     if subreddit is not None:
+        if start_date is None:
+            start_date = interrupted_start_date(subreddit, comments)
+            if start_date is not None:
+                logger.debug("Resuming the search of '{}' started from {}".format(subreddit, start_date))
         start_date = start_date if start_date is not None else timestamp
-        if comments:
-            response = api.search_comments(q="", subreddit=subreddit, sort_type="created_utc", sort="desc",
-                                          before=start_date)
-        else:
-            response = api.search_submissions(q="", subreddit=subreddit, sort_type="created_utc", sort="desc",
-                                          before=start_date)
+        ok_docs = extract_window_for_subreddit(subreddit, comments, None, start_date, os.path.join(
+            "./backups/", ("r_{}_{}_{}_base" + backup_extension).format(subreddit, file_str, start_date)))
 
-        try:
-            with open(os.path.join("./backups/", "r_{}_{}_{}_base.jsonl".format(subreddit, file_str, start_date)), "a") as outfile:
-                for resp in response:
-                    post = convert_response(resp, False, comments)
-                    test = json.dumps(post)
-
-                    if bool(post) and test.startswith('{"id":'):
-                        try:
-                            # File backup
-                            json.dump(post, outfile)
-                            outfile.write('\n')
-                            saved = True
-                        except UnicodeEncodeError:
-                            logger_err.error("Encoding error has occurred")
-                            continue
-
-                        if saved:
-                            ok_docs += 1
+        if ok_docs is not None:
+            end = time.time()
+            elapsed_time = end - start
+            logger.debug("Total elapsed time performing the historical search: {} seconds".format(elapsed_time))
+            logger.debug("Total posts obtained: {}".format(ok_docs))
+
+            return {"elapsed_time": elapsed_time, "ok_docs": ok_docs}
+    else:
+        logger_err.error("Errored subreddit format: {}".format(subreddit))
 
-                end = time.time()
-                elapsed_time = end - start
-                logger.debug("Total elapsed time performing the historical search: {} seconds".format(elapsed_time))
-                logger.debug("Total posts obtained: {}".format(ok_docs))
-        except (OSError, IOError):
-            logger_err.error("Read/Write error has occurred with file '{}'".format
-                             ("r_{}_base.jsonl".format(subreddit, subreddit)))
+
+def extract_window_for_subreddit(subreddit: str, comments: bool, after: Optional[int], before: int, save_path: str,
+                                 checkpoint_every: int = 1000, index: bool = True):
+    """
+    Function that given a subreddit and a time window, extracts all the posts of that subreddit in the window (newest
+    first) and dumps them to a file. The progress is saved in a checkpoint next to the file so that, if interrupted,
+    the next call with the same parameters resumes from the last post saved (instead of starting from scratch)
+
+    :param subreddit: str - the subreddit name
+    :param comments: bool - True if you want to extract the comments, False for submissions
+    :param after: int/None - the date to search to (exclusive, None for no limit)
+    :param before: int - the date to search from (exclusive)
+    :param save_path: str - the path to the file to save the posts
+    :param checkpoint_every: int - minimum number of posts saved between checkpoints
+    :param index: bool - False to not keep the line index of the file (i.e temporary files, see 'index_backups')
+    :return: int/None - number of successfully saved documents (None if errored)
+    """
+
+    params = {"subreddit": subreddit, "comments": comments, "after": after, "before": before}
+
+    # Resume the previous search (discarding anything written after its last checkpoint) or start a new one
+    checkpoint = file_manager.load_checkpoint(save_path, params)
+    if checkpoint is not None and checkpoint["completed"]:
+        logger.debug("'{}' already completed ({} posts)".format(save_path, checkpoint["ok_docs"]))
+        return checkpoint["ok_docs"]
+    elif checkpoint is not None:
+        logger.debug("Resuming '{}' from {} ({} posts)".format(save_path, checkpoint["before"],
+                                                               checkpoint["ok_docs"]))
+        before, offset, ok_docs = checkpoint["before"], checkpoint["offset"], checkpoint["ok_docs"]
     else:
+        offset, ok_docs = 0, 0
+
+    # Every window needs its own client (the API keeps the state of the paging)
+    api = get_api()
+
+    query = {"q": "", "subreddit": subreddit, "sort_type": "created_utc", "sort": "desc", "before": before}
+    if after is not None:
+        query["after"] = after
+    response = api.search_comments(**query) if comments else api.search_submissions(**query)
+
+    # Date of the posts being saved, and the docs saved since the last checkpoint
+    last_created, pending = None, 0
+
+    try:
+        file_manager.truncate_file(save_path, offset)
+        with record_writer.RecordWriter(save_path, index=index and index_backups) as writer:
+            for resp in response:
+                post = convert_response(resp, False, comments)
+
+                if record_writer.is_valid(post):
+                    # Posts come newest first: once the date changes, all the posts of newer dates are saved
+                    if post.get("created_utc") != last_created:
+                        if pending >= checkpoint_every:
+                            writer.flush()
+                            file_manager.save_checkpoint(save_path, params, completed=False, before=last_created,
+                                                         offset=writer.offset, ok_docs=ok_docs)
+                            pending = 0
+                        last_created = post.get("created_utc")
+
+                    # File backup
+                    if writer.write(post):
+                        ok_docs += 1
+                        pending += 1
+    except (OSError, IOError):
+        logger_err.error("Read/Write error has occurred with file '{}'".format(save_path))
+        return None
+
+    file_manager.save_checkpoint(save_path, params, completed=True, ok_docs=ok_docs)
+
+    return ok_docs
+
+
+def extract_historic_for_subreddit_sharded(subreddit: str, comments: bool = False, start_date: Optional[int] = None,
+                                           end_date: Optional[int] = None, n_shards: int = 8,
+                                           max_workers: Optional[int] = None):
+    """
+    Function that performs the same historical search as 'extract_historic_for_subreddit' but splitting the interval
+    of dates in windows (shards) that are fetched concurrently and merged (newest to oldest) into the same file. The
+    shards of an interrupted search are kept, so the next call with the same dates only fetches the shards not
+    completed (without date, the last interrupted search of the subreddit is resumed, see 'interrupted_start_date')
+
+    :param subreddit: str - the subreddit name
+    :param comments: bool - True if you want to extract the comments, False for submissions
+    :param start_date: int/None - the base date to search from (None -> date of the interrupted search, or the current
+    date)
+    :param end_date: int/None - the oldest date to search to (None -> first date available in Pushshift)
+    :param n_shards: int - number of windows to split the interval into
+    :param max_workers: int/None - maximum number of windows fetched at the same time (None -> n_shards)
+    :return: dict - elapsed time performing the search and number of successfully saved documents
+    """
+
+    # To put the timestamp in the filename
+    timestamp = date_utils.get_current_date(False)
+
+    file_str = "comments" if comments else "posts"
+
+    if subreddit is None:
         logger_err.error("Errored subreddit format: {}".format(subreddit))
+        return
+
+    if start_date is None:
+        start_date = interrupted_start_date(subreddit, comments, sharded=True)
+        if start_date is not None:
+            logger.debug("Resuming the sharded search of '{}' started from {}".format(subreddit, start_date))
+    start_date = start_date if start_date is not None else timestamp
+    oldest = end_date if end_date is not None else pushshift_first_date
+
+    try:
+        boundaries = date_utils.split_interval(oldest, start_date, n_shards)
+    except ValueError as e:
+        logger_err.error("Errored interval for subreddit '{}': {}".format(subreddit, e))
+        return
+
+    # Measure elapsed time
+    start = time.time()
+
+    filename = ("r_{}_{}_{}_base" + backup_extension).format(subreddit, file_str, start_date)
+    shards_path = os.path.join("./backups/", filename.replace(backup_extension, "_shards"))
+    os.makedirs(shards_path, exist_ok=True)
+
+    # Windows from the newest to the oldest, each one covering [boundary, next boundary)
+    windows = []
+    for i in reversed(range(len(boundaries) - 1)):
+        after = boundaries[i] - 1 if i > 0 or end_date is not None else None
+        windows.append((after, boundaries[i + 1], os.path.join(shards_path, ("shard_{}" + backup_extension).format(i))))
+
+    logger.debug("Starting generation of '{}' ({}) subreddit historic in {} shards...".format(subreddit, file_str,
+                                                                                             len(windows)))
+
+    with ThreadPoolExecutor(max_workers=max_workers if max_workers is not None else len(windows)) as executor:
+        # The shards are temporary, only the merged file is indexed
+        futures = [executor.submit(extract_window_for_subreddit, subreddit, comments, after, before, shard,
+                                   index=False)
+                   for after, before, shard in windows]
+        results = [future.result() for future in futures]
+
+    if None in results:
+        # Keep the shards (and their checkpoints) so that a new call resumes the ones that failed
+        logger_err.error("Some shards of '{}' failed, skipping merge".format(filename))
+        return
+
+    ok_docs = sum(results)
+
+    # The shards are already sorted (newest first) and don't overlap, so they only need to be concatenated
+    try:
+        file_manager.clear_file(os.path.join("./backups/", filename))
+        for _, _, shard in windows:
+            file_manager.append_file(shard, os.path.join("./backups/", filename))
+        for _, _, shard in windows:
+            file_manager.remove_file(shard)
+            file_manager.remove_checkpoint(shard)
+        os.rmdir(shards_path)
+        update_backup_index(os.path.join("./backups/", filename))
+    except (OSError, IOError):
+        logger_err.error("Read/Write error has occurred with file '{}'".format(filename))
+
+    elapsed_time = time.time() - start
+    logger.debug("Total elapsed time performing the historical search: {} seconds".format(elapsed_time))
+    logger.debug("Total posts obtained: {}".format(ok_docs))
+
+    return {"elapsed_time": elapsed_time, "ok_docs": ok_docs}
+
+
+def extract_historics_for_subreddits(subreddits: list, start_date: Optional[int] = None, max_concurrency: int = 4):
+    """
+    Function that given a list of subreddits performs the historical search of each one of them (posts and/or
+    comments) concurrently, with a global limit of searches running at the same time. Each subreddit is dumped to its
+    own file (see 'extract_historic_for_subreddit')
+
+    :param subreddits: list[str/dict] - the subreddits to search, either the name (only posts) or a dictionary as
+    {"subreddit": str, "posts": bool, "comments": bool}
+    :param start_date: int/None - the base date to search from (None -> current date)
+    :param max_concurrency: int - maximum number of searches running at the same time
+    :return: list[dict] - for each search: subreddit, type of documents, elapsed time, number of documents saved and
+    documents per second
+    """
+
+    # The same date for all the searches (also used in the filenames)
+    start_date = start_date if start_date is not None else date_utils.get_current_date(False)
+
+    jobs = []
+    for s in subreddits:
+        if isinstance(s, str):
+            s = {"subreddit": s}
+        if s.get("posts", True):
+            jobs.append((s["subreddit"], False))
+        if s.get("comments", False):
+            jobs.append((s["subreddit"], True))
+
+    logger.debug("Starting {} historical searches ({} at the same time)...".format(len(jobs), max_concurrency))
+
+    # Measure elapsed time
+    start = time.time()
+
+    result = []
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(extract_historic_for_subreddit, subreddit, comments, start_date)
+                   for subreddit, comments in jobs]
+        for (subreddit, comments), future in zip(jobs, futures):
+            file_str = "comments" if comments else "posts"
+            try:
+                resp = future.result()
+            except Exception as e:
+                logger_err.error("Historical search of '{}' ({}) failed: {}".format(subreddit, file_str, e))
+                resp = None
+
+            if resp is None:
+                resp = {"elapsed_time": 0, "ok_docs": 0}
+            docs_sec = resp["ok_docs"] / resp["elapsed_time"] if resp["elapsed_time"] > 0 else 0
+            logger.debug("'{}' ({}): {} documents in {:.2f} seconds ({:.2f} docs/sec)".format(
+                subreddit, file_str, resp["ok_docs"], resp["elapsed_time"], docs_sec))
+
+            result.append({"subreddit": subreddit, "type": file_str, "elapsed_time": resp["elapsed_time"],
+                           "ok_docs": resp["ok_docs"], "docs_sec": docs_sec})
+
+    elapsed_time = time.time() - start
+    total_docs = sum(r["ok_docs"] for r in result)
+    logger.debug("Total elapsed time performing the historical searches: {} seconds ({} documents, {:.2f} docs/sec)"
+                 .format(elapsed_time, total_docs, total_docs / elapsed_time if elapsed_time > 0 else 0))
+
+    return result
 
 
 def extract_posts_for_interval(start_date: int, end_date: int, size: int, timestamp: int,
-                               exclude: Optional[list] = None):
+                               exclude: Optional[list] = None, writer: Optional[record_writer.RecordWriter] = None):
     """
     Function that extracts N (size) posts in a given time interval
 
@@ -134,13 +458,14 @@ def extract_posts_for_interval(start_date: int, end_date: int, size: int, timest
     :param size: int - maximum number of posts to be retrieved
     :param timestamp: int - timestamp for the filename
     :param exclude: list[str]/None - the subreddits to skip
+    :param writer: RecordWriter/None - writer to save the posts (None -> appends to 'ref_col_{size}_{timestamp}.jsonl')
     :return dict - elapsed time performing the query and number of successfully saved documents
     """
 
     to_skip = exclude if exclude is not None else []
 
     # API
-    api = PushshiftAPI()
+    api = get_api()
 
     #####
 
@@ -157,42 +482,39 @@ def extract_posts_for_interval(start_date: int, end_date: int, size: int, timest
                                       after=end_date)
 
     try:
-        with open(os.path.join("./backups/", "ref_col_{}_{}.jsonl".format(size, timestamp)), "a") as outfile:
+        outfile = writer if writer is not None else record_writer.RecordWriter(
+            os.path.join("./backups/", ("ref_col_{}_{}" + backup_extension).format(size, timestamp)),
+            index=index_backups)
+        try:
             for resp_post in response:
                 if ok_docs == size:
                     break
                 post = convert_response(resp_post, False)
-                test = json.dumps(post)
 
-                if bool(post) and test.startswith('{"id":'):
+                if record_writer.is_valid(post):
                     try:
-                        if post["subreddit"] not in to_skip:
-                            try:
-                                # File backup
-                                json.dump(post, outfile)
-                                outfile.write('\n')
-                                saved = True
-                            except UnicodeEncodeError:
-                                logger_err.error("Encoding error has occurred")
-                                continue
-
-                            if saved:
-                                ok_docs += 1
+                        # File backup
+                        if post["subreddit"] not in to_skip and outfile.write(post):
+                            ok_docs += 1
                     except KeyError:
                         logger_err.error("Missing subreddit key and skipping post")
                         continue
+        finally:
+            if writer is None:
+                outfile.close()
 
-            end = time.time()
-            elapsed_time = end - start
+        end = time.time()
+        elapsed_time = end - start
 
-            return {"elapsed_time": elapsed_time, "ok_docs": ok_docs}
+        return {"elapsed_time": elapsed_time, "ok_docs": ok_docs}
     except (OSError, IOError):
         logger_err.error("Read/Write error has occurred with file '{}'".format
-                         ("ref_col_{}_{}.jsonl".format(size, timestamp)))
+                         (("ref_col_{}_{}" + backup_extension).format(size, timestamp)))
 
 
 def obtain_reference_collection(path: str, max_block_size: int, posts_per_block: int, base_date: int,
-                                exclude: Optional[list] = None, posts: Optional[Iterable] = None):
+                                exclude: Optional[list] = None, posts: Optional[Iterable] = None,
+                                max_workers: int = 4):
     """
     Function that given the path of the backups file and the size of the posts' intervals creates a reference
     collection of random posts
@@ -206,47 +528,42 @@ def obtain_reference_collection(path: str, max_block_size: int, posts_per_block:
     :param exclude: list[str]/None - the subreddits to skip
     :param posts: Iterable - a generator from ElasticSearch (omits file specified in 'path' if so) /
     None -> defaults to textIO from file in the path specified as parameter
+    :param max_workers: int - maximum number of intervals queried at the same time
     """
 
     # To put the timestamp in the filename
     timestamp = date_utils.get_current_date(False)
+    save_path = os.path.join("./backups/", ("ref_col_{}_{}" + backup_extension).format(posts_per_block, timestamp))
 
     logger.debug("Starting generation of the reference collection...")
 
     resp = {}
-    if posts is not None:
-        logger.debug("Data coming from ES loaded...")
-        resp = generate_blocks(posts, True, max_block_size, posts_per_block, base_date, timestamp, exclude)
-    else:
-        try:
-            with open(path, "r") as readfile:
-                resp = generate_blocks(readfile, False, max_block_size, posts_per_block, base_date, timestamp,
-                                       exclude)
-        except (OSError, IOError):
-            logger_err.error("Read/Write error has occurred")
+    try:
+        with record_writer.RecordWriter(save_path, index=index_backups) as writer:
+            if posts is not None:
+                logger.debug("Data coming from ES loaded...")
+                resp = generate_blocks(posts, True, max_block_size, posts_per_block, base_date, timestamp, exclude,
+                                       max_workers, writer)
+            else:
+                with compression.open_file(path, "r") as readfile:
+                    resp = generate_blocks(readfile, False, max_block_size, posts_per_block, base_date, timestamp,
+                                           exclude, max_workers, writer)
+
+            if resp and resp["current_block_size"] > 0 and resp["start_date"] < base_date:
+                # Write remaining (after the last block, in the same file)
+                resp["end_date"] = resp["last_post"]["created_utc"]
+                second_resp = extract_posts_for_interval(resp["start_date"], resp["end_date"],
+                                                         resp["current_block_size"], timestamp, exclude, writer)
+
+                resp["total_time"] += second_resp["elapsed_time"]  # Add the time spent with the remaining documents
+                resp["ok_docs"] += second_resp["ok_docs"]  # Add the successful documents
+    except (OSError, IOError):
+        logger_err.error("Read/Write error has occurred")
 
     if resp:
-        end_date = resp["end_date"]
-        if resp["current_block_size"] > 0 and resp["start_date"] < base_date:
-            # Write remaining
-            end_date = resp["last_post"]["created_utc"]
-            second_resp = extract_posts_for_interval(resp["start_date"], end_date, resp["current_block_size"],
-                                                     timestamp, exclude)
-            # Join remaining
-            merged = file_manager.merge_backups("ref_col_{}_{}.jsonl".format(max_block_size, timestamp),
-                                                "ref_col_{}_{}.jsonl".format(resp["current_block_size"],
-                                                                             timestamp))
-            # Delete once completed
-            if merged:
-                file_manager.remove_file("./backups/ref_col_{}_{}.jsonl".format(resp["current_block_size"],
-                                                                                timestamp))
-
-            resp["total_time"] += second_resp["elapsed_time"]  # Add the time spent with the remaining documents
-            resp["ok_docs"] += second_resp["ok_docs"]  # Add the successful documents
-
         logger.debug("Generated documents between {} and {} with {} documents per interval (size {})".format(
             date_utils.convert_to_iso_date_str(resp["initial_date"]),
-            date_utils.convert_to_iso_date_str(end_date),
+            date_utils.convert_to_iso_date_str(resp["end_date"]),
             posts_per_block,
             max_block_size))
         logger.debug("Total elapsed time generating the collection: {} seconds".format(resp["total_time"]))
@@ -256,12 +573,89 @@ def obtain_reference_collection(path: str, max_block_size: int, posts_per_block:
             resp["ok_docs"]))
 
 
+def compute_blocks(posts: Iterable, es: bool, max_block_size: int, base_date: int):
+    """
+    Function that given an Iterable containing the posts (newest to oldest) computes, in a single pass, the intervals
+    of dates that contain max_block_size posts each one (only posts older than the base date)
+
+    :param posts: Iterable - posts to obtain the intervals from
+    :param es: bool - True if the posts are coming from ElasticSearch, False otherwise (lines of a .jsonl file)
+    :param max_block_size: int - the posts to skip to find a new date
+    :param base_date: int - the limit timestamp (posts must be older that this)
+    :return: dict - the intervals and the information about the posts
+        intervals: list[tuple] - start and end date of each interval
+        current_block_size: int - posts remaining (after the last interval)
+        skipped: int - documents skipped (newer than date)
+        start_date: int - start date of the final interval if there were documents remaining
+        end_date: int - end date of the last interval
+        initial_date: int - the first date obtained older that the base date
+        last_post: dict - the last post
+    """
+
+    intervals = []
+    current_block_size, skipped = 0, 0
+    start_date, end_date, initial_date = None, None, None
+    last_line = None
+
+    for line in posts:
+        last_line = line
+        # Only the date is decoded (see file_manager.line_key)
+        created_utc = line["_source"]["created_utc"] if es else _created_utc(line)
+
+        if start_date is None:  # First time
+            if created_utc > base_date:  # Skip posts newer than date passed as parameter
+                skipped += 1
+            else:
+                start_date = initial_date = created_utc
+                current_block_size += 1
+
+        else:
+            current_block_size += 1
+
+            if current_block_size == max_block_size:
+                end_date = created_utc
+                intervals.append((start_date, end_date))
+
+                # Reset
+                current_block_size = 0
+                start_date = end_date
+
+    last_post = None
+    if last_line is not None:
+        last_post = last_line["_source"] if es else json.loads(last_line)
+
+    return {"intervals": intervals, "current_block_size": current_block_size, "skipped": skipped,
+            "start_date": start_date, "end_date": end_date, "initial_date": initial_date, "last_post": last_post}
+
+
+def collect_posts_for_interval(start_date: int, end_date: int, size: int, timestamp: int,
+                               exclude: Optional[list] = None):
+    """
+    Function that performs the same search as 'extract_posts_for_interval' but keeping the posts in memory (so that
+    several intervals can be searched at the same time and then written in order)
+
+    :param start_date: int - the date to search from
+    :param end_date: int - the date to search to
+    :param size: int - maximum number of posts to be retrieved
+    :param timestamp: int - timestamp for the filename
+    :param exclude: list[str]/None - the subreddits to skip
+    :return: tuple - the result of 'extract_posts_for_interval' and the posts obtained
+    """
+
+    buffer = record_writer.RecordBuffer()
+    resp = extract_posts_for_interval(start_date, end_date, size, timestamp, exclude, buffer)
+
+    return resp, buffer.records
+
+
 def generate_blocks(posts: Iterable, es: bool, max_block_size: int, posts_per_block: int, base_date: int,
-                    timestamp: int, exclude: Optional[list] = None):
+                    timestamp: int, exclude: Optional[list] = None, max_workers: int = 4,
+                    writer: Optional[record_writer.RecordWriter] = None):
     """
     Function that given an Iterable containing the posts, the interval between posts, the posts to generate within that
     interval, the base date (posts must be older than this date) and a timestamp for the filename returns a dictionary
-    containing the information about the operation performed
+    containing the information about the operation performed. The intervals are computed first (see 'compute_blocks')
+    and then searched concurrently, the posts being written in the order of the intervals
 
     :param posts: Iterable - posts to obtain the intervals from
     :param es: bool - True if the posts are coming from ElasticSearch, False otherwise
@@ -270,80 +664,79 @@ def generate_blocks(posts: Iterable, es: bool, max_block_size: int, posts_per_bl
     :param base_date: int - the limit timestamp (posts must be older that this)
     :param timestamp: int - the timestamp for the filename
     :param exclude: list[str]/None - the subreddits to skip
+    :param max_workers: int - maximum number of intervals searched at the same time
+    :param writer: RecordWriter/None - writer to save the posts (None -> appends to
+    'ref_col_{posts_per_block}_{timestamp}.jsonl')
     :return: dict - all the data obtained during the generation of the collection
         current_block_size: int - posts remaining
         ok_docs: int - documents successfully saved
         skipped: int - documents skipped (newer than date)
         total_time: float - total time spent generating the collecting
-        skipped: int - start date of the final interval if there were documents remaining
+        start_date: int - start date of the final interval if there were documents remaining
         end_date: int - end date of the last interval
         initial_date: str - the first date obtained older that the base date
         last_post: dict - the last post obtained
     """
 
-    # Actual count of posts
-    current_block_size = 0
-
-    # Skipped posts because of newer date
-    skipped = 0
+    # Measure elapsed time
+    start = time.time()
 
-    # To store the time intervals
-    start_date = None
-    end_date = None
-    last_post = None
+    result = compute_blocks(posts, es, max_block_size, base_date)
+    intervals = result.pop("intervals")
+    logger.debug("{} intervals computed in {:.2f} seconds".format(len(intervals), time.time() - start))
 
-    # Stats
-    total_time = 0
     ok_docs = 0
-    initial_date = None
-
-    for line in posts:
-        if es:
-            temp = line["_source"]
-        else:
-            temp = json.loads(line)
-        last_post = temp
-
-        if start_date is None:  # First time
-            # Set initial date
-            start_date = temp["created_utc"]
-            if start_date > base_date:  # Skip posts newer than date passed as parameter
-                start_date = None
-                skipped += 1
-            else:
-                initial_date = temp["created_utc"]
-                current_block_size += 1
+    outfile = writer if writer is not None else record_writer.RecordWriter(
+        os.path.join("./backups/", ("ref_col_{}_{}" + backup_extension).format(posts_per_block, timestamp)),
+        index=index_backups)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            for start_date, end_date in intervals:
+                pending.append(executor.submit(collect_posts_for_interval, start_date, end_date, posts_per_block,
+                                               timestamp, exclude))
+                # Keep the workers busy but don't keep the posts of too many intervals in memory
+                if len(pending) >= 2 * max_workers:
+                    ok_docs += _write_block(pending.popleft(), outfile, ok_docs)
+            while pending:
+                ok_docs += _write_block(pending.popleft(), outfile, ok_docs)
+    finally:
+        if writer is None:
+            outfile.close()
+
+    result["ok_docs"] = ok_docs
+    result["total_time"] = time.time() - start
+    logger.debug("{} intervals generated in {:.2f} seconds ({} documents)".format(len(intervals), result["total_time"],
+                                                                                 ok_docs))
 
-        else:
-            current_block_size += 1
+    return result
 
-            if current_block_size == max_block_size:
-                if es:
-                    temp = line["_source"]
-                else:
-                    temp = json.loads(line)
-                end_date = temp["created_utc"]
 
-                # Write interval of random posts to file
-                resp = extract_posts_for_interval(start_date, end_date, posts_per_block, timestamp, exclude)
-                total_time += resp["elapsed_time"]
-                ok_docs += resp["ok_docs"]
+def _write_block(future, writer, ok_docs: int):
+    """
+    Function that waits for the search of an interval (see 'collect_posts_for_interval') and writes its posts, so that
+    the posts are written in the order of the intervals whatever the order the searches finish in
 
-                logger.debug("Total number of documents collected: {}".format(ok_docs))
+    :param future: Future - the search of the interval, returning its result and its posts
+    :param writer: RecordWriter/RecordBuffer - writer to save the posts
+    :param ok_docs: int - documents saved before this interval (for the logs)
+    :return: int - number of posts of the interval successfully written (0 if its search failed)
+    """
 
-                # Reset
-                current_block_size = 0
-                start_date = end_date
+    resp, block_posts = future.result()
+    if resp is None:
+        logger_err.error("Search of the interval failed, skipping its {} posts".format(len(block_posts)))
+        return 0
 
-    result = {"current_block_size": current_block_size, "ok_docs": ok_docs, "skipped": skipped,
-              "total_time": total_time, "start_date": start_date, "end_date": end_date,
-              "initial_date": initial_date, "last_post": last_post
-              }
+    written = sum(1 for post in block_posts if writer.write(post))
+    logger.debug("Interval searched in {:.2f} seconds ({} documents), total number of documents collected: {}".format(
+        resp["elapsed_time"], written, ok_docs + written))
 
-    return result
+    return written
 
 
-def search_author_posts(username: str, save_path: str, before_date: int, exclude: Optional[list] = None):
+def search_author_posts(username: str, save_path: str, before_date: int, exclude: Optional[list] = None,
+                        writer: Optional[record_writer.RecordWriter] = None):
     """
     Given an author searches all its posts in all subreddits (skipping, if necessary, the subreddits passed as
     parameter) and writes them to a .jsonl file
@@ -352,47 +745,60 @@ def search_author_posts(username: str, save_path: str, before_date: int, exclude
     :param save_path: str - the path to save the posts of the selected author
     :param before_date: int - the epoch to starting searching from
     :param exclude: list[str]/None - the subreddits to skip
+    :param writer: RecordWriter/None - writer to save the posts (None -> appends to the file in 'save_path')
     :return num_post: int - total number of posts found for the author
     """
 
     to_skip = exclude if exclude is not None else []
     num_posts = 0
 
-    api = PushshiftAPI()
+    api = get_api()
     response = api.search_submissions(author=username,
                                       sort_type="created_utc",
                                       sort="desc",
                                       before=before_date)
 
     try:
-        with open(save_path, "a") as outfile:
+        outfile = writer if writer is not None else record_writer.RecordWriter(save_path, index=index_backups)
+        try:
             for resp_post in response:
                 post = convert_response(resp_post, False)
-                test = json.dumps(post)
 
-                if bool(post) and test.startswith('{"id":'):
+                if record_writer.is_valid(post):
                     try:
-                        if post["subreddit"] not in to_skip:
-                            try:
-                                # File backup
-                                json.dump(post, outfile)
-                                outfile.write("\n")
-                                num_posts += 1
-                            except UnicodeEncodeError:
-                                logger_err.error("Encoding error has occurred")
+                        # File backup
+                        if post["subreddit"] not in to_skip and outfile.write(post):
+                            num_posts += 1
                     except KeyError:
                         logger_err.error("Missing subreddit key and skipping post")
                         continue
+        finally:
+            if writer is None:
+                outfile.close()
     except (OSError, IOError):
         logger_err.error("Read/Write error has occurred")
 
     return num_posts
 
 
+def update_backup_index(path: str):
+    """
+    Function that rebuilds the line index of a backup rewritten as a whole (i.e once sorted or merged), since only the
+    records appended by 'record_writer.RecordWriter' keep it up to date
+
+    :param path: str - the path to the backup
+    """
+
+    if index_backups and compression.codec_of(path) is None and os.path.isfile(path):
+        line_index.update_index(path)
+
+
 def extract_authors_posts(path: str, save_path: str, before_date: int, log: bool, exclude: Optional[list] = None):
     """
     Given a path to file containing the data of the authors (.jsonl) creates a file containing all the posts made by
-    that users (a list of subreddits to skip can be also provided so that posts in that subreddits will be skipped)
+    that users (a list of subreddits to skip can be also provided so that posts in that subreddits will be skipped).
+    The progress is saved in a checkpoint after each author, so an interrupted extraction with the same parameters is
+    resumed from the last author processed
 
     :param path: str - the path to the file containing the data of the authors
     :param save_path: str - the path to the file to save all the posts of each author
@@ -406,57 +812,218 @@ def extract_authors_posts(path: str, save_path: str, before_date: int, log: bool
     # Measure elapsed time
     start = time.time()
 
-    # Total posts found
-    total_posts = 0
+    # The input is also identified by its fingerprint, so that a modified input file is not resumed
+    params = {"path": path, "input": file_manager.file_fingerprint(path), "before_date": before_date,
+              "exclude": exclude}
+    checkpoint = file_manager.load_checkpoint(save_path, params)
+
+    if checkpoint is not None and checkpoint["completed"]:
+        logger.debug("'{}' already completed ({} posts)".format(save_path, checkpoint["total_posts"]))
+        return
+
+    # Total posts found and last author processed
+    if checkpoint is not None:
+        total_posts, last_author = checkpoint["total_posts"], checkpoint["author_index"]
+        logger.debug("Resuming from author {} ({} posts)".format(last_author + 1, total_posts))
+        # Discard the posts of the author being processed when interrupted
+        file_manager.truncate_file(save_path, checkpoint["offset"])
+    else:
+        total_posts, last_author = 0, 0
+        file_manager.clear_file(save_path)
 
-    file_manager.clear_file(save_path)
     try:
-        with open(path) as input_file:
+        with compression.open_file(path) as input_file, \
+                record_writer.RecordWriter(save_path, index=index_backups) as writer:
             total_authors = file_manager.count_lines_file(path)
             for i, a in enumerate(input_file, 1):
+                if i <= last_author:
+                    continue
                 author_data = json.loads(a)
-                posts_found = search_author_posts(author_data["username"], save_path, before_date, exclude)
+                posts_found = search_author_posts(author_data["username"], save_path, before_date, exclude, writer)
                 total_posts += posts_found
+                writer.flush()
+                file_manager.save_checkpoint(save_path, params, completed=False, author_index=i,
+                                             offset=writer.offset, total_posts=total_posts)
                 if log:
                     logger.debug("{}/{} - ({}: {} posts)".format(i, total_authors, author_data["username"],
                                                                  posts_found))
     except (OSError, IOError):
         logger_err.error("Read/Write error has occurred")
+        return
 
     # Sort file by created_utc (oldest to newest)
     file_manager.sort_file(save_path, "created_utc")
+    update_backup_index(save_path)
+    file_manager.save_checkpoint(save_path, params, completed=True, total_posts=total_posts)
 
     end = time.time()
     elapsed_time = end - start
     logger.debug("Total elapsed time: {} for a total of {} posts found".format(elapsed_time, total_posts))
 
 
-def count_author_posts(username: str, before_date: int, exclude: list):
+def search_authors_shard(usernames: list, shard_path: str, before_date: int, exclude: Optional[list] = None):
+    """
+    Given a group of authors searches all their posts (see 'search_author_posts') and writes them to a .jsonl file
+    (shard) sorted by created_utc (newest to oldest). A completed shard is not searched again
+
+    :param usernames: list[str] - the authors' usernames
+    :param shard_path: str - the path to save the posts of the authors
+    :param before_date: int - the epoch to starting searching from
+    :param exclude: list[str]/None - the subreddits to skip
+    :return: int - total number of posts found for the authors
+    """
+
+    params = {"usernames": usernames, "before_date": before_date, "exclude": exclude}
+    checkpoint = file_manager.load_checkpoint(shard_path, params)
+    if checkpoint is not None and checkpoint["completed"]:
+        return checkpoint["total_posts"]
+
+    total_posts = 0
+    with record_writer.RecordWriter(shard_path, "w") as writer:
+        for username in usernames:
+            total_posts += search_author_posts(username, shard_path, before_date, exclude, writer)
+
+    file_manager.sort_file(shard_path, "created_utc")
+    file_manager.save_checkpoint(shard_path, params, completed=True, total_posts=total_posts)
+
+    return total_posts
+
+
+def extract_authors_posts_parallel(path: str, save_path: str, before_date: int, log: bool,
+                                   exclude: Optional[list] = None, max_workers: int = 8, authors_per_shard: int = 1):
+    """
+    Same as 'extract_authors_posts' but the authors are searched concurrently: each group of authors is saved into its
+    own sorted file (shard) and all the shards are merged (k-way, by created_utc) into the final file, which is
+    identical to the one generated by 'extract_authors_posts'. Shards already completed are not searched again if the
+    extraction is interrupted
+
+    :param path: str - the path to the file containing the data of the authors
+    :param save_path: str - the path to the file to save all the posts of each author
+    :param before_date: int - the epoch to starting searching from
+    :param log: bool - activates/deactivates logging of authors
+    :param exclude: list[str]/None - the subreddits to skip
+    :param max_workers: int - maximum number of shards searched at the same time
+    :param authors_per_shard: int - number of authors in each shard
+    """
+
+    logger.debug("Extracting author posts ({} workers)...".format(max_workers))
+
+    # Measure elapsed time
+    start = time.time()
+
+    # The input is also identified by its fingerprint, so that a modified input file is not resumed
+    params = {"path": path, "input": file_manager.file_fingerprint(path), "before_date": before_date,
+              "exclude": exclude}
+    checkpoint = file_manager.load_checkpoint(save_path, params)
+    if checkpoint is not None and checkpoint["completed"]:
+        logger.debug("'{}' already completed ({} posts)".format(save_path, checkpoint["total_posts"]))
+        return
+
+    usernames = []
+    try:
+        with compression.open_file(path) as input_file:
+            for a in input_file:
+                usernames.append(json.loads(a)["username"])
+    except (OSError, IOError):
+        logger_err.error("Read/Write error has occurred")
+        return
+
+    shards_path = save_path + "_shards"
+    os.makedirs(shards_path, exist_ok=True)
+    shards = [(usernames[i:i + authors_per_shard], os.path.join(shards_path, ("shard_{}" + backup_extension).format(i)))
+              for i in range(0, len(usernames), authors_per_shard)]
+
+    total_posts = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(search_authors_shard, group, shard, before_date, exclude)
+                   for group, shard in shards]
+        for i, ((group, _), future) in enumerate(zip(shards, futures), 1):
+            posts_found = future.result()
+            total_posts += posts_found
+            if log:
+                logger.debug("{}/{} - ({}: {} posts)".format(i, len(shards), ", ".join(group), posts_found))
+
+    # Merge the shards (in the order of the authors) from newest to oldest
+    file_manager.merge_sorted_files([shard for _, shard in shards], save_path, "created_utc")
+    for _, shard in shards:
+        file_manager.remove_file(shard)
+        file_manager.remove_checkpoint(shard)
+    os.rmdir(shards_path)
+    update_backup_index(save_path)
+    file_manager.save_checkpoint(save_path, params, completed=True, total_posts=total_posts)
+
+    end = time.time()
+    elapsed_time = end - start
+    logger.debug("Total elapsed time: {} for a total of {} posts found".format(elapsed_time, total_posts))
+
+
+def count_author_posts(username: str, before_date: int, exclude: list, exact: bool = False):
     """
     Function that given an author name, the date to start searching from and the list of subreddits to skip, returns the
-    total post count
+    total post count. By default the count is obtained from the metadata of the API (without downloading the posts)
+    and it's only computed by downloading all the posts if the API doesn't provide it or an exact count is requested.
+    The counts are cached for the same author, date and subreddits to skip
 
     :param username: str - the author's name
     :param before_date: int - the epoch to starting searching from
     :param exclude: list[str] - list of subreddit to skip
+    :param exact: bool - True to count only the posts that would be saved by 'search_author_posts' (downloading all
+    of them), False to use the count of the API
     :return: int - the total count of posts
     """
 
-    api = PushshiftAPI()
-    response = api.search_submissions(author=username, before=before_date)
+    key = (username, before_date, tuple(sorted(exclude)), exact)
+    with _author_posts_counts_lock:
+        if key in _author_posts_counts:
+            return _author_posts_counts[key]
 
-    count = 0
-    for hit in response:
-        post = convert_response(hit, False)
-        test = json.dumps(post)
+    count = None if exact else count_author_posts_metadata(username, before_date, exclude)
 
-        if bool(post) and test.startswith('{"id":'):
-            try:
-                if post["subreddit"] not in exclude:
-                    count += 1
-            except KeyError:
-                logger_err.error("Missing subreddit key and skipping post")
-                continue
+    if count is None:
+        api = get_api()
+        response = api.search_submissions(author=username, before=before_date)
+
+        count = 0
+        for hit in response:
+            post = convert_response(hit, False)
+
+            if record_writer.is_valid(post):
+                try:
+                    if post["subreddit"] not in exclude:
+                        count += 1
+                except KeyError:
+                    logger_err.error("Missing subreddit key and skipping post")
+                    continue
+
+    with _author_posts_counts_lock:
+        _author_posts_counts[key] = count
+
+    return count
+
+
+def count_author_posts_metadata(username: str, before_date: int, exclude: list):
+    """
+    Function that given an author name, the date to start searching from and the list of subreddits to skip, returns the
+    total post count using only the metadata of the API (no posts are downloaded): the total of posts of the author
+    minus the total of posts of the author in the subreddits to skip
+
+    :param username: str - the author's name
+    :param before_date: int - the epoch to starting searching from
+    :param exclude: list[str] - list of subreddit to skip
+    :return: int/None - the total count of posts (None if the API doesn't provide it)
+    """
+
+    api = get_api()
+    url = api.base_url.format(endpoint="reddit/submission/search")
+    query = {"author": username, "before": before_date, "size": 0, "metadata": "true"}
+
+    try:
+        count = api._get(url, query)["metadata"]["total_results"]
+        if len(exclude) > 0:
+            count -= api._get(url, dict(query, subreddit=",".join(exclude)))["metadata"]["total_results"]
+    except (KeyError, TypeError):
+        logger_err.error("Post count not available in the metadata for author '{}'".format(username))
+        return None
 
     return count
 
@@ -555,7 +1122,9 @@ def generate_authors_samples(subreddit: str, sample_size: int, before_date: int,
 
 # obtain_reference_collection("./backups/r_depression_base.jsonl", 100, 100, 1577836800, ["depression"], None)
 #extract_historic_for_subreddit("immigration")
-extract_historic_for_subreddit("immigration", True, 1652365845)
+# extract_historic_for_subreddit("immigration", True, 1652365845)
+# extract_historics_for_subreddits([{"subreddit": "immigration", "posts": True, "comments": True}, "depression"],
+#                                  1652365845, 4)
 # tools.systematic_authors_sample("./backups/subr_authors_info_backup.jsonl", 12000)
 # obtain_authors_samples("./backups/subr_authors_info_backup.jsonl", 10000, "./data/subr_authors.txt", 30, 0.10)
 # extract_authors_posts("./data/subr_authors_selected.jsonl", "./backups/subr_author_posts.jsonl", 1577836800, False,
@@ -1,25 +1,50 @@
 import os
 import logging
 import json
+import heapq
+import re
+import shutil
+import tempfile
 #####
+import compression
 import logging_factory
 #####
+from typing import Optional
+#####
 logger_err = logging_factory.get_module_logger("file_manager_err", logging.ERROR)
 logger = logging_factory.get_module_logger("file_manager", logging.DEBUG)
 
+# Default memory budget (bytes) of each sorted run in 'sort_file'
+sort_memory_budget = 256 * 1024 * 1024
+
+# Size (bytes) of the chunks copied when appending a file to another one
+copy_buffer_size = 1024 * 1024
+
+_id_pattern = re.compile(r'\{"id":\s*"((?:[^"\\]|\\.)*)"\s*[,}]')
+
 
 def count_lines_file(path: str):
     """
-    Function that returns the number of lines of a file given its path
+    Function that returns the number of lines of a file given its path (using its line index if it's up to date, see
+    line_index, or the blocks of compressed files)
 
     :param path: str - the path to the file
     :return: int - the number of lines of the file
     """
 
-    with open(path) as f:
-        for i, l in enumerate(f):
-            pass
-    return i + 1
+    import line_index
+
+    count = compression.count_lines(path) if compression.codec_of(path) else line_index.count_lines(path)
+    if count is not None:
+        return count
+
+    count, last = 0, b"\n"
+    with compression.open_file(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            count += block.count(b"\n")
+            last = block
+    # Last line without new line
+    return count if last.endswith(b"\n") else count + 1
 
 
 def clear_file(save_path: str):
@@ -29,38 +54,266 @@ def clear_file(save_path: str):
     :param save_path: str - path to the file
     """
 
-    open(save_path, "w").close()
+    compression.open_file(save_path, "w").close()
 
 
-def sort_file(path: str, field: str):
+def sort_file(path: str, field: str, reverse: bool = True, memory_budget: Optional[int] = None):
     """
-    Given a file path (.jsonl format), sorts the contents of the file (using the provided key)
+    Given a file path (.jsonl format), sorts the contents of the file (using the provided key). The file is sorted in
+    runs that fit in the memory budget, spilled to temporary files and merged (k-way), so files bigger than the
+    available memory can be sorted. The original file is only replaced (atomically) once the sorted one is complete
 
     :param path: str - path to the file
     :param field: str - the key to use in the sort
+    :param reverse: bool - True to sort in descending order, False for ascending
+    :param memory_budget: int/None - maximum size (bytes) of the lines loaded at the same time (None -> module default)
     """
 
     logger.debug("Starting file sorting by field '{}'...".format(field))
 
-    # File will be loaded in a list (watch out with the size)
-    lines = []
-    with open(path) as file:
-        for line in file:
-            lines.append(json.loads(line))
+    budget = memory_budget if memory_budget is not None else sort_memory_budget
+    key = line_key(field)
+    directory = os.path.dirname(os.path.abspath(path))
 
-    # Sort
+    def sort_run(run_lines):
+        run_lines.sort(key=key, reverse=reverse)
+        return run_lines
+
+    def spill(run_lines):
+        fd, run_path = tempfile.mkstemp(suffix=".run", dir=directory)
+        # Removed at the end even if the run can't be sorted
+        runs.append(run_path)
+        with os.fdopen(fd, "w") as run_file:
+            run_file.writelines(sort_run(run_lines))
+
+    runs = []
+    fd, sorted_path = tempfile.mkstemp(suffix=".sorted" + os.path.splitext(path)[1], dir=directory)
+    os.close(fd)
     try:
-        lines = sorted(lines, key=lambda k: int(k[field]), reverse=True)
+        lines, size = [], 0
+        with compression.open_file(path) as file:
+            for line in file:
+                if not line.endswith("\n"):
+                    line += "\n"
+                lines.append(line)
+                size += len(line)
+                if size >= budget:
+                    spill(lines)
+                    lines, size = [], 0
+
+        if not runs:
+            # Everything fits in memory
+            with compression.open_file(sorted_path, "w") as output:
+                output.writelines(sort_run(lines))
+        else:
+            if lines:
+                spill(lines)
+            merge_sorted_files(runs, sorted_path, field, reverse)
+
+        compression.replace(sorted_path, path)
     except KeyError:
-        pass
+        logger_err.error("Field '{}' not found in file '{}', not sorted".format(field, path))
+    finally:
+        for run_path in runs:
+            remove_file(run_path)
+        if os.path.isfile(sorted_path):
+            remove_file(sorted_path)
+        if os.path.isfile(compression.blocks_path(sorted_path)):
+            remove_file(compression.blocks_path(sorted_path))
+
+
+def file_fingerprint(path: str):
+    """
+    Function that returns the fingerprint of a file (size and modification time), to tell whether the input of a job
+    changed since its checkpoint was saved
+
+    :param path: str - path to the file
+    :return: list/None - size (bytes) and modification time (ns) of the file (None if it doesn't exist)
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_checkpoint(path: str, params: dict, check_file: bool = True):
+    """
+    Given the path to a file being generated and the parameters used to generate it, returns the checkpoint saved for
+    that file (only if it was saved with the same parameters and the file still holds everything it recorded: a file
+    deleted or truncated after the checkpoint was saved invalidates it)
+
+    :param path: str - path to the file being generated
+    :param params: dict - the parameters of the job generating the file
+    :param check_file: bool - False if the checkpoint doesn't belong to a file (its offset is not a size in bytes)
+    :return: dict/None - the checkpoint data (None if there is no valid checkpoint)
+    """
+
+    try:
+        with open(path + ".ckpt", "r") as input_file:
+            checkpoint = json.load(input_file)
+    except (OSError, IOError, ValueError):
+        return None
+
+    if checkpoint.get("params") != params:
+        logger.debug("Checkpoint of '{}' ignored (different parameters)".format(path))
+        return None
+
+    recorded = max(checkpoint.get("offset", 0), checkpoint.get("file_size", 0))
+    if check_file and (not os.path.isfile(path) or os.path.getsize(path) < recorded):
+        logger.debug("Checkpoint of '{}' ignored (file missing or smaller than recorded)".format(path))
+        remove_checkpoint(path)
+        return None
+
+    return checkpoint
+
+
+def save_checkpoint(path: str, params: dict, **data):
+    """
+    Given the path to a file being generated, the parameters used to generate it and the state of the job, saves
+    (atomically) a checkpoint next to the file ('.ckpt') so that the job can be resumed. The current size of the file is
+    also saved, to detect a file modified afterwards (see 'load_checkpoint')
+
+    :param path: str - path to the file being generated
+    :param params: dict - the parameters of the job generating the file
+    :param data: the state of the job to be saved (i.e last created_utc seen, offset of the file...)
+    """
+
+    checkpoint = dict(data, params=params, file_size=os.path.getsize(path) if os.path.isfile(path) else 0)
+    try:
+        with open(path + ".ckpt.tmp", "w") as output:
+            json.dump(checkpoint, output)
+        os.replace(path + ".ckpt.tmp", path + ".ckpt")
+    except (OSError, IOError):
+        logger_err.error("Checkpoint of '{}' cannot be saved".format(path))
+
+
+def remove_checkpoint(path: str):
+    """
+    Given the path to a file being generated, removes its checkpoint (if any)
+
+    :param path: str - path to the file being generated
+    """
+
+    if os.path.isfile(path + ".ckpt"):
+        remove_file(path + ".ckpt")
+
+
+def truncate_file(path: str, offset: int):
+    """
+    Given a path to a file and an offset, discards all the contents of the file after the offset (creating it if
+    not existing)
+
+    :param path: str - path to the file
+    :param offset: int - the size (bytes) of the file once truncated
+    """
+
+    if compression.codec_of(path):
+        compression.truncate(path, offset)
+        return
 
-    # Clean file
-    clear_file(path)
-    # And rewrite with the new sorting
     with open(path, "a") as file:
-        for line in lines:
-            file.write(json.dumps(line))
-            file.write("\n")
+        file.truncate(offset)
+
+
+def line_key(field: str):
+    """
+    Function that returns a function to extract the numeric value of a field of a line (.jsonl format), to be used as
+    a sort key. The value is found in the raw line when it appears only once, so the line only needs to be decoded
+    when the field is ambiguous (i.e also present in a nested object)
+
+    :param field: str - the field to extract
+    :return: function - given a line, returns the value of the field as an int
+    """
+
+    pattern = re.compile(r'"{}":\s*"?(-?\d+)(?:\.\d*)?"?\s*[,}}]'.format(re.escape(field)))
+
+    def key(line):
+        found = pattern.findall(line)
+        if len(found) == 1 and line.count('"{}":'.format(field)) == 1:
+            return int(found[0])
+        return int(json.loads(line)[field])
+
+    return key
+
+
+def merge_sorted_files(paths: list, save_path: str, field: str, reverse: bool = True, max_open: int = 256,
+                       dedupe: bool = False):
+    """
+    Given a list of paths to files (.jsonl format) already sorted by the provided key, merges them (k-way, loading only
+    a line per file) into a single sorted file. Equal keys keep the order of the files in the list, so the result is
+    the same as sorting (stable) the concatenation of all of them
+
+    :param paths: list[str] - paths to the sorted files
+    :param save_path: str - path to the file to be generated
+    :param field: str - the key the files are sorted by
+    :param reverse: bool - True if the files are sorted in descending order, False otherwise
+    :param max_open: int - maximum number of files opened at the same time (more files are merged in several passes)
+    :param dedupe: bool - True to keep only the first record of each id (duplicates are expected to have the same key,
+    i.e the same post fetched twice)
+    """
+
+    intermediate = []
+    # Merge consecutive groups first (keeping the order) if there are too many files to open at the same time
+    while len(paths) > max_open:
+        groups = [paths[i:i + max_open] for i in range(0, len(paths), max_open)]
+        paths = []
+        for group in groups:
+            merged = "{}.merge_{}".format(save_path, len(intermediate))
+            merge_sorted_files(group, merged, field, reverse, max_open, dedupe)
+            intermediate.append(merged)
+            paths.append(merged)
+
+    files = [compression.open_file(path, "r") for path in paths]
+    try:
+        key = line_key(field)
+        lines = heapq.merge(*files, key=key, reverse=reverse)
+        with compression.open_file(save_path, "w") as output:
+            output.writelines(drop_duplicates(lines, key) if dedupe else lines)
+    finally:
+        for file in files:
+            file.close()
+
+    for path in intermediate:
+        remove_file(path)
+
+
+def record_id(line: str):
+    """
+    Function that returns the id of a record given its line (.jsonl format). The backups are written with the id as
+    the first key (see record_writer.is_valid), so the line only needs to be decoded otherwise
+
+    :param line: str - the line
+    :return: str - the id of the record
+    """
+
+    found = _id_pattern.match(line)
+    if found is not None:
+        return found.group(1)
+    return str(json.loads(line)["id"])
+
+
+def drop_duplicates(lines, key):
+    """
+    Given the lines of a file sorted by a key, yields them skipping the records whose id was already seen among the
+    lines with the same key (only the ids of the current key are kept in memory)
+
+    :param lines: Iterable[str] - the sorted lines
+    :param key: function - given a line, returns its key (see 'line_key')
+    :return: generator - the lines without duplicates
+    """
+
+    current, seen = None, set()
+    for line in lines:
+        value = key(line)
+        if value != current:
+            current, seen = value, set()
+        _id = record_id(line)
+        if _id not in seen:
+            seen.add(_id)
+            yield line
 
 
 def files_in_path(path: str):
@@ -76,13 +329,19 @@ def files_in_path(path: str):
 
 def remove_file(path: str):
     """
-    Given a path to a file, tries to delete it
+    Given a path to a file, tries to delete it (along with its blocks sidecar if it's compressed and its line index, if
+    any)
 
     :param path: str - the path to the file
     """
 
+    import line_index
+
     try:
         os.remove(path)
+        for sidecar in (compression.blocks_path(path), line_index.index_path(path)):
+            if os.path.isfile(sidecar):
+                os.remove(sidecar)
     except OSError:
         logger_err.error("File cannot be removed")
 
@@ -111,27 +370,98 @@ def create_subdir(base: str, sub_dir: str):
     os.mkdir(os.path.join(base, sub_dir))
 
 
-def merge_backups(file1: str, file2: str):
+def append_file(src: str, dst: str):
+    """
+    Given two paths to files, appends the contents of the first one to the second one as bytes (without decoding the
+    lines). Compressed files with the same compression are appended without decompressing them, since they are
+    sequences of independent blocks (see compression)
+
+    :param src: str - path to the file to append
+    :param dst: str - path to the file to append to (created if not existing)
     """
-    Function that merges two backup file into a single one, appending the contents of one to the other
 
-    :param file1: str - the name of the first file
+    codec = compression.codec_of(dst)
+    if codec != compression.codec_of(src):
+        # Different formats, the contents must be recompressed
+        with compression.open_file(src, "rb") as input_file:
+            with compression.open_file(dst, "ab") as output:
+                shutil.copyfileobj(input_file, output, copy_buffer_size)
+        return
+
+    blocks = compression.load_blocks(src) if codec is not None else None
+    if codec is not None and compression.load_blocks(dst) is None:
+        # Build the sidecar of the destination before appending to it
+        compression.BlockWriter(dst, "a").close()
+
+    # Not opened in append mode, which can't be used to copy in the kernel
+    open(dst, "ab").close()
+    with open(src, "rb") as input_file:
+        with open(dst, "r+b") as output:
+            start = output.seek(0, 2)
+            if codec is None and start > 0:
+                output.seek(start - 1)
+                if output.read(1) != b"\n":
+                    output.write(b"\n")
+                    start += 1
+            _copy_bytes(input_file, output)
+
+    if codec is not None:
+        with open(compression.blocks_path(dst), "ab") as sidecar:
+            for block_start, block_end, lines in blocks or [(0, os.path.getsize(src), -1)]:
+                if block_end > block_start:
+                    sidecar.write(compression.block_entry.pack(start + block_start, start + block_end, lines))
+
+
+def _copy_bytes(input_file, output):
+    size = os.fstat(input_file.fileno()).st_size
+    output.flush()
+    try:
+        # Copy in the kernel, without reading the file in Python
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(output.fileno(), input_file.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+        output.seek(0, 2)
+    except (AttributeError, OSError):
+        input_file.seek(0)
+        output.seek(0, 2)
+        shutil.copyfileobj(input_file, output, copy_buffer_size)
+
+
+def merge_backups(file1: str, file2: str, ordered: bool = False, field: str = "created_utc", reverse: bool = True,
+                  dedupe: bool = False):
+    """
+    Function that merges two backup file into a single one, appending the contents of one to the other or, if both
+    are sorted, merging them keeping the order
+
+    :param file1: str - the name of the first file (where the result is saved)
     :param file2: str - the name of the second file
+    :param ordered: bool - True to merge the files (sorted by the given field) keeping the order, False to append the
+    second file to the first one
+    :param field: str - the key the files are sorted by (only if ordered)
+    :param reverse: bool - True if the files are sorted in descending order, False otherwise (only if ordered)
+    :param dedupe: bool - True to drop the records with a repeated id (only if ordered, see 'merge_sorted_files')
+    :return: bool - True if the files were merged, False otherwise
     """
 
+    path1, path2 = os.path.join("./backups/", file1), os.path.join("./backups/", file2)
     try:
-        with open(os.path.join("./backups/", file2), "r") as input_file:
-            with open(os.path.join("./backups/", file1), "a") as append_file:
-                for line in input_file:
-                    try:
-                        json.dump(line, append_file)
-                        append_file.write("\n")
-                    except UnicodeEncodeError:
-                        logger_err.error("Encoding error has occurred")
-                        return False
+        if not ordered:
+            append_file(path2, path1)
+            return True
+
+        base, extension = os.path.splitext(path1)
+        tmp_path = base + ".merge" + extension
+        merge_sorted_files([path1, path2], tmp_path, field, reverse, dedupe=dedupe)
+        compression.replace(tmp_path, path1)
     except (OSError, IOError):
         logger_err.error("Error merging the files, skipping...")
         return False
+    except (KeyError, ValueError):
+        logger_err.error("Field '{}' missing in some record, skipping merge...".format(field))
+        return False
     return True
 
 
@@ -1,15 +1,41 @@
 import logging
+import os
 import gzip
 import json
+import time
+import bisect
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 #####
+import compression
+import es_client
+import file_manager
 import logging_factory
 #####
-from elasticsearch import Elasticsearch, helpers, ConnectionTimeout, ConnectionError
-from elasticsearch.helpers import BulkIndexError
+from elasticsearch import Elasticsearch, helpers, ConnectionTimeout, ConnectionError, TransportError
+from typing import Optional, Iterable
 #####
 logger_err = logging_factory.get_module_logger("indexer_err", logging.ERROR)
 logger = logging_factory.get_module_logger("indexer", logging.DEBUG)
 
+try:
+    import pyarrow
+    import pyarrow.csv as pyarrow_csv
+    import pyarrow.compute as pyarrow_compute
+except ImportError:
+    pyarrow, pyarrow_csv, pyarrow_compute = None, None, None
+
+# Fields of the documents of the authors
+es_fields_keys = ("acc_id", "username", "created", "updated", "comment_karma", "link_karma")
+
+# Types of the columns of the .csv files of the authors (parsed with pyarrow)
+csv_column_types = {"acc_id": "string", "username": "string", "created": "int64", "updated": "int64",
+                    "comment_karma": "int64", "link_karma": "int64"}
+
+# Settings of the indices during the bulk loads (restored after them): no refreshes and no replicas
+bulk_settings = {"refresh_interval": "-1", "number_of_replicas": 0}
+
 
 def decode_file(file_handler, is_csv: bool):
     """
@@ -22,8 +48,6 @@ def decode_file(file_handler, is_csv: bool):
     creation of the account, the date of retrieval and the comment and link karma punctuations
     """
 
-    es_fields_keys = ("acc_id", "username", "created", "updated", "comment_karma", "link_karma")
-
     # If it's a .csv file, skip the header
     if is_csv:
         try:
@@ -51,52 +75,317 @@ def decode_file(file_handler, is_csv: bool):
         yield _id, dict(zip(es_fields_keys, es_fields_values))
 
 
-def es_add_bulk(path: str, index_name: str):
+def split_blocks(file_handler, block_size: int):
+    """
+    Given a binary file handler, reads it in blocks of (approximately) the given size that contain only complete lines
+
+    :param file_handler: the (binary) file handler
+    :param block_size: int - size (bytes) of the blocks
+    :return: generator - the blocks (bytes)
+    """
+
+    rest = b""
+    while True:
+        data = file_handler.read(block_size)
+        if not data:
+            break
+        data = rest + data
+        cut = data.rfind(b"\n") + 1
+        if cut == 0:
+            rest = data
+            continue
+        rest = data[cut:]
+        yield data[:cut]
+    if rest:
+        yield rest + b"\n"
+
+
+def _arrow_bulk_lines(block: bytes, index_name: str, skip: int):
+    # Lines (action + document) of each author as an arrow array, built with vectorized string joins (None if any
+    # identifier/username would need to be escaped in JSON)
+    columns = pyarrow_csv.read_csv(
+        pyarrow.py_buffer(block),
+        read_options=pyarrow_csv.ReadOptions(column_names=es_fields_keys, skip_rows=skip, use_threads=False),
+        convert_options=pyarrow_csv.ConvertOptions(column_types=csv_column_types)).combine_chunks()
+    acc_ids, usernames = columns.column("acc_id").chunk(0), columns.column("username").chunk(0)
+    strings = pyarrow_compute.binary_join_element_wise(acc_ids, usernames, "")
+    if pyarrow_compute.any(pyarrow_compute.match_substring_regex(strings, r"[^\x20\x21\x23-\x5b\x5d-\x7e]")).as_py():
+        return None
+
+    numbers = [pyarrow_compute.cast(columns.column(key).chunk(0), pyarrow.string()) for key in es_fields_keys[2:]]
+    # The identifier for the document will be account identifier of the user
+    parts = [json.dumps({"index": {"_index": index_name, "_type": "reddit", "_id": ""}})[:-3], acc_ids,
+             '"}}\n{"acc_id":"', acc_ids, '","username":"', usernames, '"']
+    for key, values in zip(es_fields_keys[2:], numbers):
+        parts += [',"{}":'.format(key), values]
+    parts.append("}\n")
+
+    return pyarrow_compute.binary_join_element_wise(*parts, "")
+
+
+def chunk_bounds(offsets, chunk_size: int, max_chunk_bytes: Optional[int] = None):
+    """
+    Given the offsets of the documents of a bulk body (where each one starts, plus the end of the last one), returns the
+    documents of each request: at most 'chunk_size' documents and 'max_chunk_bytes' bytes each one (a single document
+    bigger than the limit is sent alone, the same as helpers.parallel_bulk)
+
+    :param offsets: sequence[int] - the offsets (bytes) of the documents
+    :param chunk_size: int - maximum number of documents per request
+    :param max_chunk_bytes: int/None - maximum size (bytes) of each request (None -> no limit)
+    :return: list[tuple] - first document and end (excluded) of each request
+    """
+
+    n = len(offsets) - 1
+    bounds, start = [], 0
+    while start < n:
+        end = min(start + chunk_size, n)
+        if max_chunk_bytes is not None and offsets[end] - offsets[start] > max_chunk_bytes:
+            end = max(start + 1, bisect.bisect_right(offsets, offsets[start] + max_chunk_bytes, start, end) - 1)
+        bounds.append((start, end))
+        start = end
+
+    return bounds
+
+
+def build_bulk_batches(block: bytes, index_name: str, chunk_size: int, skip: int = 0,
+                       max_chunk_bytes: Optional[int] = None):
+    """
+    Given a block of lines of a .csv file with the data of the authors (without header), parses it (vectorized, see
+    pyarrow.csv, or pandas.read_csv if pyarrow is not installed) and builds the bodies of the bulk requests to index
+    them (same documents as 'decode_file')
+
+    :param block: bytes - the lines
+    :param index_name: str - the name of the index to save the data
+    :param chunk_size: int - maximum number of documents per request
+    :param skip: int - number of lines to skip at the beginning of the block
+    :param max_chunk_bytes: int/None - maximum size (bytes) of each request (None -> no limit, see 'chunk_bounds')
+    :return: list[tuple] - number of documents and body (str) of each request
+    """
+
+    lines = _arrow_bulk_lines(block, index_name, skip) if pyarrow is not None else None
+    if lines is not None:
+        # The bodies are slices of the buffer of the joined lines
+        data = lines.buffers()[2]
+        offsets = memoryview(lines.buffers()[1]).cast("i")[lines.offset:lines.offset + len(lines) + 1]
+        return [(end - start, data[offsets[start]:offsets[end]].to_pybytes().decode("utf-8"))
+                for start, end in chunk_bounds(offsets, chunk_size, max_chunk_bytes)]
+
+    import io
+    import pandas as pd
+
+    df = pd.read_csv(io.BytesIO(block), header=None, names=es_fields_keys, skiprows=skip,
+                     dtype={"acc_id": str, "username": str, "created": "int64", "updated": "int64",
+                            "comment_karma": "int64", "link_karma": "int64"}, keep_default_na=False)
+
+    # The identifier for the document will be account identifier of the user
+    actions = [json.dumps({"index": {"_index": index_name, "_type": "reddit", "_id": acc_id}})
+               for acc_id in df["acc_id"]]
+    sources = df.to_json(orient="records", lines=True).splitlines()
+    lines = [a + "\n" + d + "\n" for a, d in zip(actions, sources)]
+    offsets = list(itertools.accumulate((len(line.encode("utf-8")) for line in lines), initial=0))
+
+    return [(end - start, "".join(lines[start:end])) for start, end in chunk_bounds(offsets, chunk_size,
+                                                                                      max_chunk_bytes)]
+
+
+def csv_bulk_batches(path: str, index_name: str, chunk_size: int, offset: int = 0, processes: Optional[int] = None,
+                     block_size: int = 16 * 1024 * 1024, max_chunk_bytes: Optional[int] = None):
     """
-    Given the path of a file containing all the data of the authors (by now in .gzip + .csv format and .jsonl),
-    index all the data in an Elastic Search index (it MAY take quite a while if there are too many documents to index)
+    Given the path of a .csv.gz file containing the data of the authors, yields the bodies of the bulk requests to index
+    them (in the order of the file). The file is decompressed in blocks that are parsed in parallel by several
+    processes (see 'build_bulk_batches')
 
-    :param path: str - path to the (.gzip + .csv) or .jsonl file containing all the authors info
+    :param path: str - path to the .csv.gz file
     :param index_name: str - the name of the index to save the data
+    :param chunk_size: int - maximum number of documents per request
+    :param offset: int - number of documents to skip (already indexed)
+    :param processes: int/None - number of processes parsing the blocks (None -> number of CPUs)
+    :param block_size: int - size (bytes) of the blocks (uncompressed)
+    :param max_chunk_bytes: int/None - maximum size (bytes) of each request (None -> no limit)
+    :return: generator - number of documents and body (str) of each request
     """
 
-    valid = False
-    is_csv, fh = None, None
+    processes = processes if processes is not None else os.cpu_count()
+
+    with gzip.open(path, "rb") as fh, ProcessPoolExecutor(max_workers=processes) as executor:
+        # Skip the header
+        fh.readline()
+
+        pending = deque()
+        for block in split_blocks(fh, block_size):
+            lines = block.count(b"\n")
+            if offset >= lines:
+                # Block already indexed
+                offset -= lines
+                continue
+            pending.append(executor.submit(build_bulk_batches, block, index_name, chunk_size, offset,
+                                           max_chunk_bytes))
+            offset = 0
+            # Keep the processes busy but don't parse the whole file in advance
+            if len(pending) >= 2 * processes:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def send_bulk_batches(es: Elasticsearch, batches: Iterable, threads: int):
+    """
+    Given the bodies of several bulk requests, sends them with several threads and yields the results in order
+
+    :param es: Elasticsearch - the client
+    :param batches: Iterable - number of documents and body of each request (see 'csv_bulk_batches')
+    :param threads: int - number of requests sent at the same time
+    :return: generator - number of documents and errored items of each request
+    """
+
+    def send(n, body):
+        response = es.bulk(body=body)
+        errored = [item for item in response["items"] if "error" in next(iter(item.values()))] \
+            if response.get("errors") else []
+        return n, errored
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for n, body in batches:
+            pending.append(executor.submit(send, n, body))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def tune_index(es: Elasticsearch, index_name: str, settings: Optional[dict] = None):
+    """
+    Function that changes the settings of an index (creating it if not existing) and returns the previous values of the
+    settings changed, so that they can be restored
+
+    :param es: Elasticsearch - the client
+    :param index_name: str - the name of the index
+    :param settings: dict/None - the settings to apply (None -> the settings for bulk loads, see 'bulk_settings')
+    :return: dict - the previous values of the settings
+    """
+
+    settings = settings if settings is not None else bulk_settings
+    if not es.indices.exists(index=index_name):
+        es.indices.create(index=index_name)
+
+    current = es.indices.get_settings(index=index_name, include_defaults=True)[index_name]
+    previous = {}
+    for key in settings:
+        previous[key] = current["settings"]["index"].get(key, current["defaults"]["index"].get(key))
+    es.indices.put_settings(index=index_name, body={"index": settings})
+
+    return previous
+
+
+def es_add_bulk(path: str, index_name: str, threads: int = 4, chunk_size: int = 1000,
+                max_chunk_bytes: int = 20 * 1024 * 1024, tune: bool = True, resume: bool = True,
+                report_every: int = 100000, processes: Optional[int] = None):
+    """
+    Given the path of a file containing all the data of the authors (by now in .gzip + .csv format and .jsonl, also
+    compressed as .jsonl.gz/.jsonl.zst), index all the data in an Elastic Search index (it MAY take quite a while if
+    there are too many documents to index). The documents are sent in chunks by several threads and the number of
+    documents indexed is saved periodically, so that an interrupted load can be resumed. The .csv files are parsed in
+    blocks by several processes (see 'csv_bulk_batches')
+
+    :param path: str - path to the (.gzip + .csv) or .jsonl(.gz/.zst) file containing all the authors info
+    :param index_name: str - the name of the index to save the data
+    :param threads: int - number of threads sending chunks at the same time
+    :param chunk_size: int - maximum number of documents per chunk
+    :param max_chunk_bytes: int - maximum size (bytes) of each chunk (for the .csv files, the bodies built by the
+    processes are split at this size, see 'chunk_bounds'; a single document bigger than it is sent alone)
+    :param tune: bool - True to disable the refresh and the replicas of the index during the load (restored after it)
+    :param resume: bool - True to skip the documents already indexed by a previous (interrupted) load of the same file
+    :param report_every: int - number of documents between progress reports
+    :param processes: int/None - number of processes parsing the .csv files (None -> number of CPUs)
+    """
 
     # Check whether is two of the allowed extensions .csv or .jsonl
     extension = path.split(".")
-    if extension[len(extension) - 1] == "jsonl":
+    if extension[len(extension) - 1] == "jsonl" or \
+            (extension[len(extension) - 1] in ("gz", "zst") and extension[len(extension) - 2] == "jsonl"):
         is_csv = False
-        valid = True
-        fh = open(path, "r")
     elif extension[len(extension) - 1] == "gz" and extension[len(extension) - 2] == "csv":
         is_csv = True
-        valid = True
-        fh = gzip.open(path, "rt")
     else:
-        logger_err.error("Provide a valid file format: (.gzip + .csv) or .jsonl")
+        logger_err.error("Provide a valid file format: (.gzip + .csv) or .jsonl(.gz/.zst)")
+        return
 
-    if valid:
-        logger.debug("Starting indexing...")
-        host, port = "localhost", 9200
-        es = Elasticsearch(hosts=[{"host": host, "port": port}])
+    # The checkpoint is saved next to the file, one per index
+    checkpoint_path = "{}.{}".format(path, index_name)
+    params = {"index": index_name, "size": os.path.getsize(path)}
+    # The offset is a number of documents (not of bytes of the checkpoint path)
+    checkpoint = file_manager.load_checkpoint(checkpoint_path, params, check_file=False) if resume else None
+    offset = checkpoint["offset"] if checkpoint is not None else 0
 
-        # Setup the generator
-        k = ({
-            "_index": index_name,
-            "_type": "reddit",
-            "_id": _id,
-            "_source": es_dict,
-        } for _id, es_dict in decode_file(fh, is_csv))
+    logger.debug("Starting indexing{}...".format(" from document {}".format(offset) if offset > 0 else ""))
+    es = es_client.get_client(threads)
 
-        try:
-            # Index all the data
-            helpers.bulk(es, k)
+    previous, completed, fh = None, False, None
+    indexed, errors = offset, 0
+    start, last_report = time.time(), offset
+    try:
+        if tune:
+            previous = tune_index(es, index_name)
+
+        if is_csv:
+            # Requests already built by the processes
+            results = send_bulk_batches(es, csv_bulk_batches(path, index_name, chunk_size, offset, processes,
+                                                             max_chunk_bytes=max_chunk_bytes), threads)
+        else:
+            fh = compression.open_file(path, "r")
+            # Skip the documents already indexed
+            documents = itertools.islice(decode_file(fh, is_csv), offset, None)
+
+            # Setup the generator
+            k = ({
+                "_index": index_name,
+                "_type": "reddit",
+                "_id": _id,
+                "_source": es_dict,
+            } for _id, es_dict in documents)
+
+            results = ((1, [] if ok else [info]) for ok, info in
+                       helpers.parallel_bulk(es, k, thread_count=threads, chunk_size=chunk_size,
+                                             max_chunk_bytes=max_chunk_bytes, raise_on_error=False))
+
+        # Results in the same order as the documents, so all the documents before the offset saved are indexed
+        for n, errored in results:
+            indexed += n
+            errors += len(errored)
+            for info in errored:
+                logger_err.error("Document not indexed: {}".format(info))
+
+            if indexed - last_report >= report_every:
+                elapsed = time.time() - start
+                logger.debug("{} documents indexed ({:.0f} docs/sec)".format(indexed, (indexed - offset) / elapsed))
+                file_manager.save_checkpoint(checkpoint_path, params, offset=indexed)
+                last_report = indexed
+
+        completed = True
+        file_manager.remove_checkpoint(checkpoint_path)
+    except (ConnectionError, ConnectionTimeout):
+        logger_err.error("Error communicating with Elasticsearch - hosts: {}".format(es_client.hosts_description()))
+    except TransportError:
+        logger_err.error("Errored encountered while indexing the data")
+    finally:
+        if fh is not None:
             fh.close()
-        except (ConnectionError, ConnectionTimeout):
-            logger_err.error("Error communicating with Elasticsearch - host: {}, port: {}".format(host, port))
-        except BulkIndexError:
-            logger_err.error("Errored encountered while indexing the data")
+        if not completed and indexed > last_report:
+            # Resume from the last document indexed
+            file_manager.save_checkpoint(checkpoint_path, params, offset=indexed)
+        if previous is not None:
+            try:
+                es.indices.put_settings(index=index_name, body={"index": previous})
+                es.indices.refresh(index=index_name)
+            except (ConnectionError, ConnectionTimeout, TransportError):
+                logger_err.error("Settings of index '{}' cannot be restored: {}".format(index_name, previous))
+
+    elapsed = time.time() - start
+    logger.debug("{} documents indexed in {:.2f} seconds ({:.0f} docs/sec, {} errors)".format(
+        indexed - offset, elapsed, (indexed - offset) / elapsed if elapsed > 0 else 0, errors))
+    # Latency and size of the requests, by endpoint
+    es_client.log_stats()
 
 
 # es_add_bulk("./backups/subr_authors_info_backup.jsonl", "r_depression_users_info")
@@ -0,0 +1,233 @@
+import logging
+import os
+import struct
+from array import array
+#####
+import file_manager
+import logging_factory
+#####
+from typing import Optional
+#####
+logger_err = logging_factory.get_module_logger("line_index_err", logging.ERROR)
+logger = logging_factory.get_module_logger("line_index", logging.DEBUG)
+
+# Sidecar file format ('<file>.idx'):
+#   header: magic (8 bytes) + size in bytes of the indexed part of the file (uint64)
+#   entries: one per line, byte offset of the line (int64) + created_utc of the record (int64, no_key if missing)
+magic = b"JSONLIDX"
+header = struct.Struct("<8sQ")
+entry = struct.Struct("<qq")
+
+# Key saved for the lines without created_utc
+no_key = -(1 << 63)
+
+_created_utc = file_manager.line_key("created_utc")
+
+
+def index_path(path: str):
+    """
+    Given a path to a .jsonl file, returns the path to its index
+
+    :param path: str - path to the .jsonl file
+    :return: str - path to the index
+    """
+
+    return path + ".idx"
+
+
+def record_key(line):
+    """
+    Function that given a line (.jsonl format), returns the key saved in the index (its created_utc)
+
+    :param line: str/bytes - the line
+    :return: int - the created_utc of the record (no_key if missing or not numeric)
+    """
+
+    try:
+        return _created_utc(line.decode("utf-8") if isinstance(line, bytes) else line)
+    except (KeyError, ValueError, TypeError):
+        return no_key
+
+
+def indexed_size(path: str):
+    """
+    Given a path to a .jsonl file, returns the size of the part of the file covered by its index
+
+    :param path: str - path to the .jsonl file
+    :return: int/None - size in bytes (None if there is no valid index)
+    """
+
+    try:
+        with open(index_path(path), "rb") as idx:
+            file_magic, size = header.unpack(idx.read(header.size))
+    except (OSError, IOError, struct.error):
+        return None
+
+    return size if file_magic == magic else None
+
+
+def is_up_to_date(path: str):
+    """
+    Given a path to a .jsonl file, checks whether its index covers the whole file and the file wasn't modified after
+    the last update of the index
+
+    :param path: str - path to the .jsonl file
+    :return: bool - True if the index is up to date, False otherwise
+    """
+
+    try:
+        return indexed_size(path) == os.path.getsize(path) and \
+            os.stat(index_path(path)).st_mtime_ns >= os.stat(path).st_mtime_ns
+    except OSError:
+        return False
+
+
+def update_index(path: str):
+    """
+    Given a path to a .jsonl file, builds its index (if there is no index or the file was truncated) or indexes only
+    the lines appended since the last update (the file is assumed to be only appended)
+
+    :param path: str - path to the .jsonl file
+    :return: int - number of lines indexed
+    """
+
+    size = os.path.getsize(path) if os.path.isfile(path) else 0
+    start = indexed_size(path)
+    if start is not None and start == size and not is_up_to_date(path):
+        # Rewritten with the same size
+        start = None
+    if start is None or start > size:
+        start = 0
+        with open(index_path(path), "wb") as idx:
+            idx.write(header.pack(magic, 0))
+
+    if start == size:
+        return 0
+
+    entries = []
+    offset = start
+    with open(path, "rb") as file:
+        file.seek(start)
+        for line in file:
+            if not line.endswith(b"\n"):
+                # Incomplete line (still being written), indexed in the next update
+                break
+            entries.append((offset, record_key(line)))
+            offset += len(line)
+
+    append_entries(path, start, offset, entries)
+
+    return len(entries)
+
+
+def append_entries(path: str, start: int, end: int, entries: list):
+    """
+    Given a path to a .jsonl file and the entries of the lines appended to it, adds them to its index (only if the
+    index is up to date until the start of the appended lines, otherwise it is left as is and considered outdated)
+
+    :param path: str - path to the .jsonl file
+    :param start: int - offset of the first line appended
+    :param end: int - offset after the last line appended
+    :param entries: list[tuple] - for each line, its offset and its created_utc
+    :return: bool - True if the index was updated, False otherwise
+    """
+
+    if indexed_size(path) != start:
+        return False
+
+    data = array("q")
+    for offset, key in entries:
+        data.append(offset)
+        data.append(key)
+
+    with open(index_path(path), "r+b") as idx:
+        idx.seek(0, 2)
+        data.tofile(idx)
+        idx.seek(0)
+        idx.write(header.pack(magic, end))
+
+    return True
+
+
+def load_index(path: str, build: bool = False):
+    """
+    Given a path to a .jsonl file, loads its index (only if it covers the whole file)
+
+    :param path: str - path to the .jsonl file
+    :param build: bool - True to build/update the index if it's missing or outdated
+    :return: tuple/None - the offsets of the lines and their created_utc (array[int] each one), None if there is no
+    index up to date
+    """
+
+    if build:
+        update_index(path)
+    if not is_up_to_date(path):
+        return None
+
+    data = array("q")
+    with open(index_path(path), "rb") as idx:
+        idx.seek(header.size)
+        data.frombytes(idx.read())
+
+    return data[0::2], data[1::2]
+
+
+def count_lines(path: str):
+    """
+    Given a path to a .jsonl file, returns its number of lines using its index (without reading the file)
+
+    :param path: str - path to the .jsonl file
+    :return: int/None - the number of lines (None if there is no index up to date)
+    """
+
+    if not is_up_to_date(path):
+        return None
+
+    return (os.path.getsize(index_path(path)) - header.size) // entry.size
+
+
+def read_line(path: str, n: int, offsets: Optional[array] = None):
+    """
+    Given a path to a .jsonl file and a line number, returns that line (random access using the index)
+
+    :param path: str - path to the .jsonl file
+    :param n: int - the line number (starting at 0)
+    :param offsets: array[int]/None - the offsets of the lines if already loaded (see 'load_index')
+    :return: str - the line
+    """
+
+    if offsets is None:
+        with open(index_path(path), "rb") as idx:
+            idx.seek(header.size + n * entry.size)
+            offset = entry.unpack(idx.read(entry.size))[0]
+    else:
+        offset = offsets[n]
+
+    with open(path, "rb") as file:
+        file.seek(offset)
+        return file.readline().decode("utf-8")
+
+
+def split_ranges(path: str, n: int):
+    """
+    Given a path to a .jsonl file, splits it into (at most) n byte ranges with the same number of lines, each one
+    starting at the beginning of a line
+
+    :param path: str - path to the .jsonl file
+    :param n: int - number of ranges
+    :return: list[tuple]/None - start and end offsets of each range (None if there is no index up to date)
+    """
+
+    index = load_index(path)
+    if index is None:
+        return None
+
+    offsets = index[0]
+    size = os.path.getsize(path)
+    if len(offsets) == 0:
+        return []
+
+    n = min(n, len(offsets))
+    starts = [offsets[len(offsets) * i // n] for i in range(n)]
+
+    return list(zip(starts, starts[1:] + [size]))
@@ -0,0 +1,377 @@
+import logging
+import json
+import time
+import heapq
+import itertools
+import random
+import bisect
+import argparse
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+#####
+import compression
+import logging_factory
+#####
+from typing import Optional
+#####
+logger_err = logging_factory.get_module_logger("pushshift_replay_err", logging.ERROR)
+logger = logging_factory.get_module_logger("pushshift_replay", logging.DEBUG)
+
+# Maximum number of documents returned per request (as the Pushshift API)
+max_size = 100
+
+# Default number of documents returned per request
+default_size = 25
+
+# Fields that can be used to filter the searches (comma separated values, case insensitive as in Pushshift)
+filter_fields = ("subreddit", "author", "id", "link_id", "parent_id")
+
+# Kinds of documents served
+kinds = ("submission", "comment")
+
+
+class Corpus:
+    """
+    Documents (posts or comments) served by the replay server, sorted by date of creation and indexed by the fields
+    that can be used to filter the searches, so that each page of a search only visits the documents it returns (and
+    the total of results is computed without visiting them when possible)
+    """
+
+    def __init__(self, documents: list):
+        """
+        :param documents: list[dict] - the documents (with their date of creation, 'created_utc')
+        """
+
+        self.documents = sorted(documents, key=lambda doc: int(doc.get("created_utc", 0)))
+        self.created = [int(doc.get("created_utc", 0)) for doc in self.documents]
+
+        # For each field, the positions of the documents with each value (ascending)
+        self.index = {field: {} for field in filter_fields}
+        for position, doc in enumerate(self.documents):
+            for field in filter_fields:
+                if doc.get(field) is not None:
+                    self.index[field].setdefault(str(doc[field]).lower(), []).append(position)
+
+    def __len__(self):
+        return len(self.documents)
+
+    @classmethod
+    def from_file(cls, path: str):
+        """
+        Loads the documents of a .jsonl file (plain or compressed, i.e a backup generated by the fetcher)
+
+        :param path: str - path to the file
+        :return: Corpus - the corpus
+        """
+
+        documents = []
+        with compression.open_file(path, "r") as input_file:
+            for line in input_file:
+                try:
+                    documents.append(json.loads(line))
+                except ValueError:
+                    logger_err.error("Errored line in file '{}'".format(path))
+        logger.debug("{} documents loaded from '{}'".format(len(documents), path))
+
+        return cls(documents)
+
+    def _positions(self, params: dict, lo: int, hi: int):
+        # Positions (ascending) of the documents in [lo, hi) that match the filters of the search
+        filters = []
+        for field in filter_fields:
+            if params.get(field):
+                values = set(value.strip().lower() for value in params[field].split(","))
+                lists = [self.index[field].get(value, []) for value in values]
+                filters.append((sum(len(positions) for positions in lists), field, values, lists))
+
+        if not filters:
+            return range(lo, hi), None
+
+        # The smallest list of positions is traversed and the rest of filters are checked on each document
+        _, field, values, lists = min(filters, key=lambda f: f[0])
+        slices = [positions[bisect.bisect_left(positions, lo):bisect.bisect_left(positions, hi)] for positions in lists]
+        positions = slices[0] if len(slices) == 1 else list(heapq.merge(*slices))
+        others = [(f, v) for _, f, v, _ in filters if f != field]
+
+        return positions, others
+
+    def search(self, params: dict):
+        """
+        Performs a search with the parameters of the Pushshift API: 'before'/'after' (epochs, excluded), 'sort'
+        ("desc" or "asc", by date of creation), 'size'/'limit', 'q' (text contained in the title/selftext/body),
+        'fields'/'filter' (fields returned), 'metadata' and the filters of the module ('filter_fields')
+
+        :param params: dict - the parameters (strings)
+        :return: dict - the documents found ("data") and, if requested, the metadata of the search
+        """
+
+        after, before = params.get("after"), params.get("before")
+        lo = bisect.bisect_right(self.created, int(after)) if after else 0
+        hi = bisect.bisect_left(self.created, int(before)) if before else len(self.created)
+
+        size = int(params.get("size", params.get("limit", default_size)) or 0)
+        size = max(0, min(size, max_size))
+        text = params.get("q", "").strip().lower()
+        fields = params.get("fields", params.get("filter"))
+        fields = [field.strip() for field in fields.split(",")] if fields else None
+
+        positions, others = self._positions(params, lo, hi)
+        exact = not others and not text
+
+        def matches(doc):
+            if others and any(str(doc.get(field, "")).lower() not in values for field, values in others):
+                return False
+            return not text or any(text in str(doc.get(key, "")).lower() for key in ("title", "selftext", "body"))
+
+        ordered = reversed(positions) if params.get("sort", "desc") == "desc" else iter(positions)
+        if exact:
+            found = [self.documents[position] for position in itertools.islice(ordered, size)]
+            total = len(positions)
+        else:
+            found, total = [], 0
+            for position in ordered:
+                if matches(self.documents[position]):
+                    total += 1
+                    if len(found) < size:
+                        found.append(self.documents[position])
+
+        if fields is not None:
+            found = [{key: doc[key] for key in fields if key in doc} for doc in found]
+
+        response = {"data": found}
+        if params.get("metadata", "").lower() == "true":
+            response["metadata"] = {"total_results": total, "size": len(found), "before": before, "after": after,
+                                    "sort": params.get("sort", "desc"), "sort_type": "created_utc",
+                                    "timed_out": False, "shards": {"total": 1, "successful": 1, "failed": 0}}
+
+        return response
+
+
+def synthetic_corpus(n: int, comments: bool = False, start: int = 1500000000, end: int = 1600000000,
+                     subreddits: tuple = ("depression", "askreddit", "news"), authors: int = 1000, seed: int = 0):
+    """
+    Function that generates a corpus of synthetic documents (with the fields saved by the fetcher)
+
+    :param n: int - number of documents
+    :param comments: bool - True to generate comments, False for posts
+    :param start: int - date (epoch) of the oldest document
+    :param end: int - date (epoch) of the newest document
+    :param subreddits: tuple[str] - the subreddits of the documents
+    :param authors: int - number of different authors
+    :param seed: int - seed of the generator
+    :return: Corpus - the corpus
+    """
+
+    rnd = random.Random(seed)
+    documents = []
+    for i in range(n):
+        doc = {"id": "{:x}".format(i + 1), "author": "author_{}".format(rnd.randrange(authors)),
+               "created_utc": rnd.randint(start, end), "retrieved_on": end, "subreddit": rnd.choice(subreddits)}
+        doc["subreddit_id"] = "t5_{}".format(doc["subreddit"])
+        text = " ".join("word{}".format(rnd.randrange(5000)) for _ in range(rnd.randint(5, 80)))
+        if comments:
+            doc.update({"link_id": "t3_{:x}".format(rnd.randrange(n) + 1), "parent_id": "t3_{:x}".format(i),
+                        "body": text, "guilded": False})
+        else:
+            doc.update({"url": "https://www.reddit.com/r/{}/{}".format(doc["subreddit"], doc["id"]),
+                        "title": text[:80], "selftext": text, "subreddit_type": "public", "domain": "self",
+                        "gildings": {}, "num_comments": rnd.randrange(50), "score": rnd.randrange(100),
+                        "over_18": False, "permalink": "/r/{}/comments/{}/".format(doc["subreddit"], doc["id"])})
+        documents.append(doc)
+
+    return Corpus(documents)
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    Local stand-in of the Pushshift API serving the searches of submissions and comments ('/reddit/submission/search',
+    '/reddit/search/submission' and the same for comments) and '/meta' from a corpus of each kind, with configurable
+    latency, jitter, rate of errors and rate limit (429 when exceeded). The fetcher uses it through 'PUSHSHIFT_URL'
+    (see fetcher)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, corpora: dict, host: str = "127.0.0.1", port: int = 8080, latency: float = 0.0,
+                 jitter: float = 0.0, error_rate: float = 0.0, rate_limit: Optional[int] = None, seed: int = 0):
+        """
+        :param corpora: dict - the corpus (Corpus) of each kind ("submission", "comment")
+        :param host: str - interface to listen on
+        :param port: int - port to listen on (0 -> any free port)
+        :param latency: float - seconds added to each response
+        :param jitter: float - maximum seconds added at random (uniformly) to the latency
+        :param error_rate: float - [0-1.0] probability of answering a search with an error (500)
+        :param rate_limit: int/None - requests allowed per minute (None -> unlimited), also reported by '/meta'
+        :param seed: int - seed of the random errors and jitter
+        """
+
+        super().__init__((host, port), ReplayHandler)
+        self.corpora = corpora
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.stats = {"requests": 0, "errors": 0, "throttled": 0, "documents": 0}
+
+        self._random = random.Random(seed)
+        self._requests = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        """
+        Base URL of the server (value for 'PUSHSHIFT_URL')
+        """
+
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def admit(self):
+        """
+        Registers a request and decides how it's answered
+
+        :return: tuple - the delay (seconds) and the status code (200, 429 if throttled or 500 if failed)
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self.stats["requests"] += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+
+            # Requests of the last minute
+            while self._requests and self._requests[0] <= now - 60:
+                self._requests.popleft()
+            if self.rate_limit is not None and len(self._requests) >= self.rate_limit:
+                self.stats["throttled"] += 1
+                return delay, 429
+            self._requests.append(now)
+
+            if self._random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return delay, 500
+
+        return delay, 200
+
+    def start(self):
+        """
+        Serves the requests in a background thread
+
+        :return: ReplayServer - the server itself
+        """
+
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        logger.debug("Pushshift replay server listening on {}".format(self.url))
+
+        return self
+
+    def stop(self):
+        """
+        Stops serving the requests and closes the server
+        """
+
+        self.shutdown()
+        self.server_close()
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        # The fields returned can be given as a repeated parameter
+        params = {key: ",".join(values) if key in ("fields", "filter") else values[-1]
+                  for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split("/") if part]
+
+        if parts == ["meta"]:
+            rate_limit = self.server.rate_limit
+            return self._send(200, {"server_ratelimit_per_minute": rate_limit if rate_limit is not None else 10000})
+
+        kind = None
+        if len(parts) == 3 and parts[0] == "reddit" and parts[2] == "search":
+            kind = parts[1]
+        elif len(parts) == 3 and parts[:2] == ["reddit", "search"]:
+            kind = parts[2]
+        if kind not in kinds:
+            return self._send(404, {"error": "Not found"})
+
+        delay, status = self.server.admit()
+        if delay > 0:
+            time.sleep(delay)
+        if status != 200:
+            return self._send(status, {"error": "Too many requests" if status == 429 else "Internal error"})
+
+        corpus = self.server.corpora.get(kind)
+        try:
+            response = corpus.search(params) if corpus is not None else {"data": []}
+        except ValueError:
+            return self._send(400, {"error": "Invalid parameters"})
+
+        with self.server._lock:
+            self.server.stats["documents"] += len(response["data"])
+        self._send(200, response)
+
+    def _send(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(submissions: Optional[str] = None, comments: Optional[str] = None, synthetic: int = 0, **kwargs):
+    """
+    Function that starts a replay server (in a background thread) with the documents of the given files or a synthetic
+    corpus
+
+    :param submissions: str/None - path to the .jsonl file with the posts (None -> synthetic posts)
+    :param comments: str/None - path to the .jsonl file with the comments (None -> synthetic comments)
+    :param synthetic: int - number of synthetic documents of each kind without file
+    :param kwargs: the settings of the server (see 'ReplayServer')
+    :return: ReplayServer - the server
+    """
+
+    corpora = {"submission": Corpus.from_file(submissions) if submissions is not None else
+               synthetic_corpus(synthetic, False, seed=kwargs.get("seed", 0)),
+               "comment": Corpus.from_file(comments) if comments is not None else
+               synthetic_corpus(synthetic, True, seed=kwargs.get("seed", 0))}
+
+    return ReplayServer(corpora, **kwargs).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local replay server of the Pushshift API")
+    parser.add_argument("--submissions", help="JSONL file with the posts (plain or compressed)")
+    parser.add_argument("--comments", help="JSONL file with the comments (plain or compressed)")
+    parser.add_argument("--synthetic", type=int, default=10000, help="Synthetic documents of each kind without file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum random seconds added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of answering with an error")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Requests allowed per minute")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = serve(args.submissions, args.comments, args.synthetic, host=args.host, port=args.port,
+                   latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, rate_limit=args.rate_limit,
+                   seed=args.seed)
+    logger.debug("Use PUSHSHIFT_URL={} to point the fetcher to the server".format(server.url))
+    try:
+        while True:
+            time.sleep(60)
+            logger.debug("Stats: {}".format(server.stats))
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
+
+# python pushshift_replay.py --submissions ./backups/r_depression_posts_base.jsonl --latency 0.2 --jitter 0.1 \
+#     --error-rate 0.01 --rate-limit 120
+# PUSHSHIFT_URL=http://127.0.0.1:8080 python fetcher.py
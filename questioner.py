@@ -1,86 +1,172 @@
 import json
 import logging
-import pandas as pd
 #####
+import account_matcher
+import compression
+import es_client
+import file_manager
 import logging_factory
 import indexer
+import tools
 #####
 from elasticsearch import Elasticsearch, ConnectionTimeout, TransportError, ConnectionError
-from elasticsearch_dsl import Search, Q
+from elasticsearch_dsl import Search, MultiSearch, Q
+from typing import Optional
 #####
 logger_err = logging_factory.get_module_logger("questioner_err", logging.ERROR)
 logger = logging_factory.get_module_logger("questioner", logging.DEBUG)
 
 
-def extract_authors_info(authors_path: str):
+def search_authors_slice(es: Elasticsearch, usernames: list, slice_id: int = 0, max_slices: int = 1):
+    """
+    Given a list of usernames, searches in an Elasticsearch index their information (only a slice of the results if
+    the search is sliced, so that the slices can be scrolled in parallel)
+
+    :param es: Elasticsearch - the client
+    :param usernames: list[str] - the usernames to search
+    :param slice_id: int - the slice of the results to obtain
+    :param max_slices: int - number of slices of the search (1 -> not sliced)
+    :return: list[dict] - the information of the authors found (None if the search failed)
+    """
+
+    search = Search(using=es, index="reddit_users").filter("terms", username=usernames)
+    if max_slices > 1:
+        search = search.extra(slice={"id": slice_id, "max": max_slices})
+
+    result = []
+    try:
+        for hit in search.scan():
+            result.append({"acc_id": hit.acc_id,
+                           "username": hit.username,
+                           "created": hit.created,
+                           "updated": hit.updated,
+                           "comment_karma": hit.comment_karma,
+                           "link_karma": hit.link_karma
+                           })
+    except (ConnectionError, ConnectionTimeout):
+        logger_err.error("Error communicating with Elasticsearch - hosts: {}".format(es_client.hosts_description()))
+        return None
+    except TransportError:
+        logger_err.error("Errored Elasticsearch query: 'filter'")
+        return None
+
+    return result
+
+
+def lookup_authors_info(table: account_matcher.AccountTable, authors: list, save_path: str,
+                        batch_size: int = 50000):
+    """
+    Given a list of author names, looks up their information in a table of accounts (see account_matcher) and writes
+    it to a .jsonl file
+
+    :param table: AccountTable - the table of all the users
+    :param authors: list[str] - the names of the authors
+    :param save_path: str - path to the .jsonl file to be generated
+    :param batch_size: int - number of names looked up together
+    :return: int - number of authors found
+    """
+
+    found = 0
+    with open(save_path, "w") as output:
+        for start in range(0, len(authors), batch_size):
+            result = [account for account in table.lookup(authors[start:start + batch_size], "username")
+                      if account is not None]
+            output.write("".join(json.dumps(line) + "\n" for line in result))
+            found += len(result)
+
+    return found
+
+
+def extract_authors_info(authors_path: str, save_path: str = "./data/subr_authors_info_backup.jsonl",
+                         max_workers: int = 4, max_query_size: int = 50000, slice_size: int = 10000,
+                         accounts: Optional[str] = None):
     """
     Given a .txt file containing the names of the authors, searches in an Elasticsearch index their corresponding
     information (for reddit: account identifier, username, date of creation, date of retrieval, comment and
     link karma punctuation). Generates a .jsonl file containing all the authors info sorted by their account id.
+    The names are searched in chunks (each one scrolled in slices if it's big) that are queried concurrently, and the
+    results are written to the file as they are obtained
 
     :param authors_path: str - path to the .txt file containing the authors
+    :param save_path: str - path to the .jsonl file to be generated
+    :param max_workers: int - maximum number of searches running at the same time
+    :param max_query_size: int - maximum number of names per chunk
+    :param slice_size: int - approximate number of names per slice of a chunk
+    :param accounts: str/None - path to a file with the information of all the users (.jsonl or .csv, see
+    account_matcher) to look up the authors in a local table instead of in Elasticsearch (the result is not indexed)
+    / None -> Elasticsearch
     """
 
     import math
-
-    host, port = "localhost", 9200
-    es = Elasticsearch(hosts=[{"host": host, "port": port}])
-    search = Search(using=es, index="reddit_users")
-    max_query_size = 50000
+    import threading
+    from concurrent.futures import ThreadPoolExecutor, as_completed
 
     authors = []
-    result = []
     # Extract the author names
     try:
-        with open(authors_path, "r") as input_file:
+        with compression.open_file(authors_path, "r") as input_file:
             for author in input_file:
                 authors.append(author.replace("\n", ""))
-            logger.debug("Authors loaded ({})".format(len(authors)))
-            n_chunks = math.ceil(len(authors) / max_query_size)
-
-            processed = 1
-            # Divide the list of author names in chunks of the maximum size allowed in order to speed up the search
-            for chunk in [authors[round(len(authors) / n_chunks * i):round(len(authors) / n_chunks * (i + 1))] for i in
-                          range(n_chunks)]:
-                # Query with all the chunk at the same time
-                try:
-                    search = search.filter("terms", username=chunk)
-                    for hit in search.scan():
-                        result.append({"acc_id": hit.acc_id,
-                                       "username": hit.username,
-                                       "created": hit.created,
-                                       "updated": hit.updated,
-                                       "comment_karma": hit.comment_karma,
-                                       "link_karma": hit.link_karma
-                                       })
-                except (ConnectionError, ConnectionTimeout):
-                    logger_err.error("Error communicating with Elasticsearch - host: {}, port: {}".format(host, port))
-                except TransportError:
-                    logger_err.error("Errored Elasticsearch query: 'filter'")
-
-                logger.debug("Chunk {}/{} processed".format(processed, n_chunks))
-                processed += 1
     except (OSError, IOError):
         logger_err.error("Read/Write error has occurred")
-    logger.debug("Information successfully found of {} authors".format(len(result)))
+        return
+    logger.debug("Authors loaded ({})".format(len(authors)))
 
-    result = sorted(result, key=lambda k: int(k["acc_id"]))
-
-    # Save data to file
+    if accounts is not None:
+        try:
+            found = lookup_authors_info(account_matcher.AccountTable.load(accounts), authors, save_path,
+                                        max_query_size)
+        except (OSError, IOError):
+            logger_err.error("Read/Write error has occurred")
+            return
+        logger.debug("Information successfully found of {} authors".format(found))
+        file_manager.sort_file(save_path, "acc_id", reverse=False)
+        return
+
+    # A connection per worker
+    es = es_client.get_client(max_workers)
+
+    # Divide the list of author names in chunks of the maximum size allowed, each one independent of the others
+    n_chunks = math.ceil(len(authors) / max_query_size)
+    chunks = [authors[round(len(authors) / n_chunks * i):round(len(authors) / n_chunks * (i + 1))]
+              for i in range(n_chunks)]
+    tasks = []
+    for chunk in chunks:
+        max_slices = max(1, min(max_workers, math.ceil(len(chunk) / slice_size)))
+        tasks.extend((chunk, slice_id, max_slices) for slice_id in range(max_slices))
+
+    found = 0
+    lock = threading.Lock()
     try:
-        with open("./data/subr_authors_info_backup.jsonl", "w") as output:
-            for line in result:
-                output.write(json.dumps(line))
-                output.write("\n")
+        with open(save_path, "w") as output:
+            def search_task(chunk, slice_id, max_slices):
+                result = search_authors_slice(es, chunk, slice_id, max_slices)
+                if result:
+                    lines = "".join(json.dumps(line) + "\n" for line in result)
+                    with lock:
+                        output.write(lines)
+                return result
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(search_task, *task) for task in tasks]
+                for processed, future in enumerate(as_completed(futures), 1):
+                    result = future.result()
+                    found += len(result) if result is not None else 0
+                    logger.debug("Search {}/{} processed ({} chunks)".format(processed, len(tasks), n_chunks))
     except (OSError, IOError):
         logger_err.error("Read/Write error has occurred")
+        return
+    logger.debug("Information successfully found of {} authors".format(found))
 
-    # Save to data to Elasticsearch
-    indexer.es_add_bulk("./data/subr_authors_info_backup.jsonl", "r_depression_authors_info")
+    # Save to data to Elasticsearch (it doesn't need to be sorted)
+    indexer.es_add_bulk(save_path, "r_depression_authors_info")
     logger.debug("Data successfully indexed")
 
+    # Sort the file by account id (without loading it, see file_manager)
+    file_manager.sort_file(save_path, "acc_id", reverse=False)
+
 
-def clean_sample(not_found: list, authors_info: str):
+def clean_sample(not_found: list, authors_info: str, export: Optional[str] = None):
     """
         Given a list of users that for whom a pair was not found and the path to the original sample,
         overwrites the sample with the users not appearing in that list.
@@ -88,28 +174,123 @@ def clean_sample(not_found: list, authors_info: str):
         :param not_found: list[str] - the usernames of the users to remove
         :param authors_info: str - path to the original sampled file containing all the information about
         the authors
+        :param export: str/None - also export the cleaned sample as a table: "csv", "parquet" or "xlsx" (None -> not
+        exported, see tools.export_table)
     """
+    not_found = set(not_found)
     authors = []
     try:
-        with open(authors_info, "r") as file:
+        with compression.open_file(authors_info, "r") as file:
             for author in file:
                 authors.append(json.loads(author))
-        with open(authors_info, "w") as output:
+        with compression.open_file(authors_info, "w") as output:
             for author in authors:
                 if author["username"] not in not_found:
                     output.write(json.dumps(author))
                     output.write("\n")
     except (OSError, IOError):
         logger_err.error("Read/Write error has occurred")
+        return
+
+    if export is not None:
+        tools.export_table(authors_info, export)
+
+
+def similar_authors_query(author, days_diff: int, similarity_karma: float):
+    """
+    Function that given the information of an author returns the query to find the authors that are similar in account
+    creation time and in comment and link karma punctuations
+
+    :param author: dict - the information of the author (created, comment_karma and link_karma)
+    :param days_diff: int - interval of difference in days between accounts creation
+    [base - days, base, base + days]
+    :param similarity_karma: float - (0-1.0] Percentage of deviation of comment and karma punctuations
+    :return: Q - the query
+    """
+
+    # Create the ranges
+    ranges = account_matcher.similarity_ranges(int(author["created"]), int(author["comment_karma"]),
+                                               int(author["link_karma"]), days_diff, similarity_karma)
 
-    df = pd.DataFrame(authors)
-    df.to_excel("./data/subr_authors_selected.xlsx")
+    # Define queries for each field to be contained in the given intervals
+    return Q("range", created={"gte": ranges[0][0], "lte": ranges[0][1]}) & \
+        Q("range", comment_karma={"gte": ranges[1][0], "lte": ranges[1][1]}) & \
+        Q("range", link_karma={"gte": ranges[2][0], "lte": ranges[2][1]})
 
 
-def generate_reference_authors(authors_info: str, subreddit_authors: str, days_diff: int, similarity_karma: float):
+def search_similar_candidates(es: Elasticsearch, authors: list, days_diff: int, similarity_karma: float):
+    """
+    Function that given a list of authors searches in Elasticsearch their information (by account id) and the
+    candidates to be paired with each one of them, with a multi search for the accounts and another one for the
+    candidates
+
+    :param es: Elasticsearch - the client
+    :param authors: list[dict] - the authors (with their account id)
+    :param days_diff: int - interval of difference in days between accounts creation
+    :param similarity_karma: float - (0-1.0] Percentage of deviation of comment and karma punctuations
+    :return: list[tuple] - for each author found, its information and its candidates (the authors whose queries failed
+    are skipped)
+    """
+
+    # Indices with the information of all users and with only r/depression users
+    s_all = Search(using=es, index="reddit_users_info")
+    s_dep = Search(using=es, index="r_depression_users_info")
+
+    try:
+        # Extract users info based on their account id (unique)
+        ms_dep = MultiSearch(using=es, index="r_depression_users_info")
+        for author in authors:
+            ms_dep = ms_dep.add(s_dep.query("match", acc_id=author["acc_id"]))
+        responses = ms_dep.execute(raise_on_error=False)
+    except (ConnectionError, ConnectionTimeout):
+        logger_err.error("Error communicating with Elasticsearch - hosts: {}".format(es_client.hosts_description()))
+        return []
+    except TransportError:
+        logger_err.error("Errored Elasticsearch query: 'match'")
+        return []
+
+    founds, queries = [], []
+    ms_all = MultiSearch(using=es, index="reddit_users_info")
+    for response in responses:
+        if response is None:
+            logger_err.error("Errored Elasticsearch query: 'match'")
+        elif len(response.hits) > 0:
+            found = response.hits[0].to_dict()
+            q = similar_authors_query(found, days_diff, similarity_karma)
+            founds.append(found)
+            queries.append(q)
+            # Query the "all" users index to find potential similar users
+            ms_all = ms_all.add(s_all.filter(q))
+
+    if not founds:
+        return []
+
+    try:
+        responses = ms_all.execute(raise_on_error=False)
+    except (ConnectionError, ConnectionTimeout):
+        logger_err.error("Error communicating with Elasticsearch - hosts: {}".format(es_client.hosts_description()))
+        return []
+    except TransportError:
+        logger_err.error("Errored Elasticsearch query: 'filter'")
+        return []
+
+    result = []
+    for found, q, response in zip(founds, queries, responses):
+        if response is None:
+            logger_err.error("Errored Elasticsearch query: {}".format(str(q)))
+        else:
+            result.append((found, [hit.to_dict() for hit in response]))
+
+    return result
+
+
+def generate_reference_authors(authors_info: str, subreddit_authors: str, days_diff: int, similarity_karma: float,
+                               batch_size: int = 100, accounts: Optional[str] = None, export: Optional[str] = None,
+                               save_path: str = "./data/ref_authors_selected.jsonl"):
     """
     Function that given a file containing data about the author selected via systematic sampling and a file containing
-    the names of the authors to omit, generates two files (.jsonl and .xlsx) with authors that are similar in account
+    the names of the authors to omit, generates a .jsonl file (also exported as a table if requested, and the sample
+    cleaned of the authors with no pair found) with authors that are similar in account
     creation time (by means of an user defined interval of days) and in comment and link karma punctuations
     (by means of a percentage controlled by the user)
 
@@ -120,10 +301,16 @@ def generate_reference_authors(authors_info: str, subreddit_authors: str, days_d
     [base - days, base, base + days]
     :param similarity_karma: float - (0-1.0] Percentage of deviation of comment and karma punctuations between the users
     provided and the users to be found
+    :param batch_size: int - number of authors whose queries are sent together (a multi search for the accounts and
+    another one for the similar users)
+    :param accounts: str/None - path to a file with the information of all the users (.jsonl or .csv, see
+    account_matcher) to look up the authors and find the similar users in a local table instead of in Elasticsearch
+    / None -> Elasticsearch
+    :param export: str/None - also export the reference authors and the cleaned sample as tables: "csv", "parquet" or
+    "xlsx" (None -> not exported, see tools.export_table)
+    :param save_path: str - path to the .jsonl file to be generated
     """
 
-    import date_utils as d
-
     logger.debug("Starting reference authors generation...")
 
     # List of users with no pair found for this configuration
@@ -132,16 +319,17 @@ def generate_reference_authors(authors_info: str, subreddit_authors: str, days_d
     # Usernames already found
     usernames_found = set()
 
-    host, port = "localhost", 9200
-    es = Elasticsearch(hosts=[{"host": host, "port": port}])
-    # Indices with the information of all users and with only r/depression users
-    s_all = Search(using=es, index="reddit_users_info")
-    s_dep = Search(using=es, index="r_depression_users_info")
+    es, table = None, None
+    if accounts is not None:
+        # Local table of all the users instead of Elasticsearch
+        table = account_matcher.AccountTable.load(accounts)
+    else:
+        es = es_client.get_client()
 
     # Load selected users
     authors_selected = []
     try:
-        with open(authors_info, "r") as input_file:
+        with compression.open_file(authors_info, "r") as input_file:
             for author_info in input_file:
                 authors_selected.append(author_info)
     except (OSError, IOError):
@@ -150,81 +338,69 @@ def generate_reference_authors(authors_info: str, subreddit_authors: str, days_d
     # Load all usernames of the authors of the subreddit
     dep_authors = set()
     try:
-        with open(subreddit_authors, "r") as input_file:
+        with compression.open_file(subreddit_authors, "r") as input_file:
             for author in input_file:
                 dep_authors.add(author.replace("\n", ""))
     except (OSError, IOError):
         logger_err.error("Read/Write error has occurred")
 
     result = []
-    for i, author in enumerate(authors_selected):
-        try:
-            # Extract user info based on its account id (unique)
-            response = s_dep.query("match", acc_id=json.loads(author)["acc_id"]).execute()
-
-            if len(response.hits) > 0:
-                found = response.hits[0]
-                # Extract the information
-                created, comment, link = int(found.created), int(found.comment_karma), int(found.link_karma)
-
-                # And create the ranges
-                ranges = [[d.substract_days_from_epoch(created, days_diff), d.add_days_to_epoch(created, days_diff)],
-                          [comment - comment * similarity_karma, comment + comment * similarity_karma],
-                          [link - link * similarity_karma, link + link * similarity_karma]]
-
-                # Define queries for each field to be contained in the given intervals
-                q = Q("range", created={"gte": ranges[0][0], "lte": ranges[0][1]}) & \
-                    Q("range", comment_karma={"gte": ranges[1][0], "lte": ranges[1][1]}) & \
-                    Q("range", link_karma={"gte": ranges[2][0], "lte": ranges[2][1]})
-
-                try:
-                    # Query the "all" users index to find potential similar users
-                    response2 = s_all.filter(q)
-
-                    is_found = False
-                    for hit in response2:
-                        # Make sure that our user is not present in the list of all users who have ever published in the
-                        # subreddit (i.e r/depression), is not the same we are using to find the pair and is not already
-                        # in the list of users found (and that complies with the interval of posts)
-                        if hit.username not in dep_authors and hit.username not in usernames_found \
-                                and found.username is not hit.username and hit.username != "[deleted]":
-                            is_found = True
-                            usernames_found.add(hit.username)
-
-                            result.append({"acc_id": hit.acc_id,
-                                           "username": hit.username,
-                                           "created": hit.created,
-                                           "updated": hit.updated,
-                                           "comment_karma": hit.comment_karma,
-                                           "link_karma": hit.link_karma,
-                                           })
-                            break  # We only want the first user found
-                    if is_found is False:
-                        not_found.append(found.username)
-                except TransportError:
-                    logger_err.error("Errored Elasticsearch query: {}".format(str(q)))
-        except (ConnectionError, ConnectionTimeout):
-            logger_err.error("Error communicating with Elasticsearch - host: {}, port: {}".format(host, port))
-        except TransportError:
-            logger_err.error("Errored Elasticsearch query: 'match'")
+    for start in range(0, len(authors_selected), batch_size):
+        batch = [json.loads(author) for author in authors_selected[start:start + batch_size]]
+        if table is not None:
+            # Extract users info based on their account id (unique)
+            founds = [found for found in table.lookup([author["acc_id"] for author in batch], "acc_id")
+                      if found is not None]
+            candidates = table.similar_candidates(founds, days_diff, similarity_karma)
+        else:
+            candidates = search_similar_candidates(es, batch, days_diff, similarity_karma)
+
+        # The candidates are processed in the order of the authors, so each user is only paired once
+        for found, hits in candidates:
+            is_found = False
+            for hit in hits:
+                # Make sure that our user is not present in the list of all users who have ever published in the
+                # subreddit (i.e r/depression), is not the same we are using to find the pair and is not already
+                # in the list of users found (and that complies with the interval of posts)
+                if hit["username"] not in dep_authors and hit["username"] not in usernames_found \
+                        and found["username"] != hit["username"] and hit["username"] != "[deleted]":
+                    is_found = True
+                    usernames_found.add(hit["username"])
+
+                    result.append({"acc_id": hit["acc_id"],
+                                   "username": hit["username"],
+                                   "created": hit["created"],
+                                   "updated": hit["updated"],
+                                   "comment_karma": hit["comment_karma"],
+                                   "link_karma": hit["link_karma"],
+                                   })
+                    break  # We only want the first user found
+            if is_found is False:
+                not_found.append(found["username"])
+
+        logger.debug("Authors {}/{} processed".format(min(start + batch_size, len(authors_selected)),
+                                                      len(authors_selected)))
 
     logger.debug("Total amount of authors found: {}".format(len(result)))
+    if es is not None:
+        es_client.log_stats()
 
     if len(not_found) > 0:
         logger.debug("Total amount of authors with no pair found: {} (Cleaning...)".format(len(not_found)))
-        clean_sample(not_found, authors_info)
+        clean_sample(not_found, authors_info, export)
 
-    # Backup list to .jsonl and .xlsx
+    # Backup list to .jsonl (and export it)
     try:
-        with open("./data/ref_authors_selected.jsonl", "w") as output:
+        with open(save_path, "w") as output:
             for line in result:
                 output.write(json.dumps(line))
                 output.write("\n")
     except (OSError, IOError):
         logger_err.error("Read/Write error has occurred")
+        return
 
-    df = pd.DataFrame(result)
-    df.to_excel("./data/ref_authors_selected.xlsx")
+    if export is not None:
+        tools.export_table(save_path, export)
 
 # extract_authors_info("./data/subr_authors.txt")
-# generate_reference_authors("./data/subr_authors_selected.jsonl", "./data/subr_authors.txt", 30, 0.10)
+# generate_reference_authors("./data/subr_authors_selected.jsonl", "./data/subr_authors.txt", 30, 0.10, export="xlsx")
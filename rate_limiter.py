@@ -0,0 +1,129 @@
+import logging
+import time
+import threading
+#####
+import logging_factory
+#####
+from typing import Optional
+#####
+logger_err = logging_factory.get_module_logger("rate_limiter_err", logging.ERROR)
+logger = logging_factory.get_module_logger("rate_limiter", logging.DEBUG)
+
+# Limiter shared by the whole process (see 'get_limiter')
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket limiting the requests per minute made to an API. The rate is halved (down to a minimum) every time a
+    request is throttled or errored (429/5xx) and increased again, step by step, while the responses are successful
+    (never above the maximum allowed)
+    """
+
+    def __init__(self, requests_per_minute: float, burst: Optional[int] = None, min_requests_per_minute: float = 1,
+                 increase_per_minute: float = 1, decrease_factor: float = 0.5):
+        """
+        :param requests_per_minute: float - maximum rate allowed (requests per minute)
+        :param burst: int/None - maximum number of requests that can be done at once (None -> a second of requests)
+        :param min_requests_per_minute: float - minimum rate when backing off
+        :param increase_per_minute: float - requests per minute added to the rate after each successful response
+        :param decrease_factor: float - (0-1.0) factor applied to the rate after each throttled/errored response
+        """
+
+        self.max_rate = requests_per_minute / 60
+        self.min_rate = min(min_requests_per_minute, requests_per_minute) / 60
+        self.increase = increase_per_minute / 60
+        self.decrease_factor = decrease_factor
+        self.burst = burst
+        self.capacity = burst if burst is not None else max(1, round(self.max_rate))
+
+        self.rate = self.max_rate
+        self.tokens = float(self.capacity)
+        self.waiting = 0
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        Blocks until a request can be done
+        """
+
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    self._refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    self._cond.wait((1 - self.tokens) / self.rate)
+            finally:
+                self.waiting -= 1
+
+    def report(self, status_code: Optional[int]):
+        """
+        Adapts the rate given the result of a request
+
+        :param status_code: int/None - the HTTP status code of the response (None if the connection failed)
+        """
+
+        with self._cond:
+            self._refill()
+            if status_code is None or status_code == 429 or status_code >= 500:
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                # Wait before the next request
+                self.tokens = min(self.tokens, 0)
+                logger.debug("Request failed ({}), rate reduced to {:.2f} requests/minute".format(status_code,
+                                                                                                  self.rate * 60))
+            elif self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+            self._cond.notify_all()
+
+    def set_max_rate(self, requests_per_minute: float):
+        """
+        Changes the maximum rate allowed
+
+        :param requests_per_minute: float - maximum rate allowed (requests per minute)
+        """
+
+        with self._cond:
+            self.max_rate = requests_per_minute / 60
+            self.rate = self.max_rate
+            if self.burst is None:
+                self.capacity = max(1, round(self.max_rate))
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Returns the current state of the limiter
+
+        :return: dict - current and maximum rate (requests per minute), tokens available and number of requests
+        waiting
+        """
+
+        with self._cond:
+            self._refill()
+            return {"rate_per_minute": self.rate * 60, "max_rate_per_minute": self.max_rate * 60,
+                    "tokens": self.tokens, "queue_depth": self.waiting}
+
+
+def get_limiter(requests_per_minute: float = 60):
+    """
+    Function that returns the rate limiter shared by the whole process (created the first time it's requested)
+
+    :param requests_per_minute: float - maximum rate allowed if the limiter has to be created
+    :return: AdaptiveRateLimiter - the shared limiter
+    """
+
+    global _limiter
+
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = AdaptiveRateLimiter(requests_per_minute)
+        return _limiter
@@ -0,0 +1,207 @@
+import logging
+import json
+import time
+import threading
+#####
+import compression
+import line_index
+import logging_factory
+#####
+from typing import Optional
+#####
+logger_err = logging_factory.get_module_logger("record_writer_err", logging.ERROR)
+logger = logging_factory.get_module_logger("record_writer", logging.DEBUG)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Default flush policy: whatever is reached first (number of records, bytes buffered or seconds since last flush)
+max_records = 1000
+max_bytes = 1 << 20
+max_interval = 5.0
+
+
+def is_valid(record: dict):
+    """
+    Function that checks whether a record (post/comment) is valid to be saved, that is, it's not empty and its first
+    key is the identifier (same as checking that its serialization starts with '{"id":' without serializing it)
+
+    :param record: dict - the record to check
+    :return: bool - True if the record is valid, False otherwise
+    """
+
+    return bool(record) and next(iter(record)) == "id"
+
+
+def encode(record: dict, backend: str = "json"):
+    """
+    Function that serializes a record as a line of a .jsonl file
+
+    :param record: dict - the record to serialize
+    :param backend: str - "json" (standard library, same output as json.dump) or "orjson" (faster, if installed,
+    non-ASCII characters are not escaped)
+    :return: bytes - the serialized record (ending with a new line)
+    """
+
+    if backend == "orjson" and orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+
+    return (json.dumps(record) + "\n").encode("ascii")
+
+
+class RecordWriter:
+    """
+    Buffered writer of records to a .jsonl file. Each record is serialized only once, the lines are written in batches
+    (following the flush policy) and it can be shared by several threads. Compressed files (.jsonl.gz/.jsonl.zst) are
+    written with a compressed block per batch (see compression.BlockWriter)
+    """
+
+    def __init__(self, path: str, mode: str = "a", backend: str = "json", flush_records: Optional[int] = None,
+                 flush_bytes: Optional[int] = None, flush_interval: Optional[float] = None, index: bool = False):
+        """
+        :param path: str - path to the .jsonl file
+        :param mode: str - "a" to append to the file, "w" to overwrite it
+        :param backend: str - JSON backend to serialize the records ("json" or "orjson")
+        :param flush_records: int/None - flush after this number of records buffered (None -> module default)
+        :param flush_bytes: int/None - flush after this number of bytes buffered (None -> module default)
+        :param flush_interval: float/None - flush if this number of seconds passed since the last flush
+        (None -> module default)
+        :param index: bool - True to keep the line index of the file ('.idx', see line_index) up to date (not
+        available for compressed files)
+        """
+
+        if backend == "orjson" and orjson is None:
+            logger.debug("orjson not installed, using json backend")
+
+        self.path = path
+        self.backend = backend
+        self.flush_records = flush_records if flush_records is not None else max_records
+        self.flush_bytes = flush_bytes if flush_bytes is not None else max_bytes
+        self.flush_interval = flush_interval if flush_interval is not None else max_interval
+
+        self.codec = compression.codec_of(path)
+        self.index = index and self.codec is None
+
+        self._file = open(path, mode + "b") if self.codec is None else compression.BlockWriter(path, mode)
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._keys = []
+        self._buffered_bytes = 0
+        self._last_flush = time.time()
+
+        # Size of the file once all the records are flushed (for compressed files, only after each flush) and number
+        # of records written
+        self.offset = self._file.seek(0, 2) if self.codec is None else self._file.tell()
+        self.records = 0
+        self._flushed = self.offset
+
+        if self.index:
+            line_index.update_index(path)
+
+    def write(self, record: dict):
+        """
+        Serializes a record and adds it to the buffer (it must be valid, see 'is_valid')
+
+        :param record: dict - the record to write
+        :return: bool - True if the record was written, False if it's not valid or it couldn't be serialized
+        """
+
+        if not is_valid(record):
+            return False
+
+        try:
+            line = encode(record, self.backend)
+        except (TypeError, ValueError):
+            logger_err.error("Encoding error has occurred")
+            return False
+
+        with self._lock:
+            self._buffer.append(line)
+            if self.index:
+                self._keys.append(record.get("created_utc"))
+            self._buffered_bytes += len(line)
+            self.offset += len(line)
+            self.records += 1
+
+            if len(self._buffer) >= self.flush_records or self._buffered_bytes >= self.flush_bytes or \
+                    time.time() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+        return True
+
+    def flush(self):
+        """
+        Writes all the buffered records to the file
+        """
+
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._file.write(b"".join(self._buffer))
+            self._file.flush()
+
+            if self.index:
+                entries, offset = [], self._flushed
+                for line, key in zip(self._buffer, self._keys):
+                    try:
+                        entries.append((offset, int(key)))
+                    except (TypeError, ValueError):
+                        entries.append((offset, line_index.no_key))
+                    offset += len(line)
+                line_index.append_entries(self.path, self._flushed, offset, entries)
+                self._keys = []
+
+            if self.codec is not None:
+                # Size of the compressed file
+                self.offset = self._file.tell()
+            self._flushed = self.offset
+            self._buffer = []
+            self._buffered_bytes = 0
+        self._last_flush = time.time()
+
+    def close(self):
+        """
+        Flushes the buffered records and closes the file
+        """
+
+        with self._lock:
+            if not self._file.closed:
+                self._flush()
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RecordBuffer:
+    """
+    In-memory writer with the same interface as 'RecordWriter', used to collect the records obtained in a thread so
+    that they can be written to a file later (i.e in a given order)
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, record: dict):
+        """
+        Adds a record to the buffer (it must be valid, see 'is_valid')
+
+        :param record: dict - the record to add
+        :return: bool - True if the record was added, False if it's not valid
+        """
+
+        if not is_valid(record):
+            return False
+
+        self.records.append(record)
+        return True
+
+    def close(self):
+        pass
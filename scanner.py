@@ -0,0 +1,211 @@
+import logging
+import os
+import json
+import copy
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+#####
+import compression
+import line_index
+import logging_factory
+#####
+from typing import Optional, Callable
+#####
+logger_err = logging_factory.get_module_logger("scanner_err", logging.ERROR)
+logger = logging_factory.get_module_logger("scanner", logging.DEBUG)
+
+# Files smaller than this size (bytes) are scanned in the current process
+min_parallel_size = 64 * 1024 * 1024
+
+# Size (bytes) of the ranges when streaming the records of a file
+stream_range_size = 16 * 1024 * 1024
+
+
+def split_file(path: str, n: int):
+    """
+    Given a path to a .jsonl file, splits it into (at most) n byte ranges of similar size, each one starting at the
+    beginning of a line (using the line index of the file if it's up to date, see line_index). Compressed files are
+    split at block boundaries (see compression)
+
+    :param path: str - path to the .jsonl file
+    :param n: int - number of ranges
+    :return: list[tuple] - start and end offsets of each range
+    """
+
+    if compression.codec_of(path) is not None:
+        return split_blocks(path, n)
+
+    ranges = line_index.split_ranges(path, n)
+    if ranges is not None:
+        return ranges
+
+    size = os.path.getsize(path)
+    starts = [0]
+    with open(path, "rb") as file:
+        for i in range(1, n):
+            # Move to the beginning of the next line
+            file.seek(max(size * i // n, starts[-1]))
+            if file.tell() > 0:
+                file.seek(file.tell() - 1)
+                file.readline()
+            if file.tell() >= size:
+                break
+            if file.tell() > starts[-1]:
+                starts.append(file.tell())
+
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def split_blocks(path: str, n: int):
+    """
+    Given a path to a compressed .jsonl file, groups its blocks into (at most) n byte ranges of similar size
+
+    :param path: str - path to the compressed file
+    :param n: int - number of ranges
+    :return: list[tuple] - start and end offsets of each range
+    """
+
+    size = os.path.getsize(path)
+    blocks = compression.load_blocks(path)
+    if not blocks:
+        # Written without blocks, only readable as a whole
+        return [(0, size)] if size > 0 else []
+
+    starts = [0]
+    for block_start, _, _ in blocks[1:]:
+        if block_start >= size * len(starts) // n:
+            starts.append(block_start)
+            if len(starts) == n:
+                break
+
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def scan_range(path: str, start: int, end: int, map_fn: Optional[Callable] = None,
+               filter_fn: Optional[Callable] = None, reduce_fn: Optional[Callable] = None, initial=None):
+    """
+    Given a path to a .jsonl file and a byte range, decodes the records of the range and applies to them the given
+    functions (filter -> map -> reduce)
+
+    :param path: str - path to the .jsonl file
+    :param start: int - offset of the first line of the range
+    :param end: int - offset after the last line of the range
+    :param map_fn: function/None - applied to each record (None -> the record itself)
+    :param filter_fn: function/None - only the records for which it returns True are kept (None -> all of them)
+    :param reduce_fn: function/None - given the accumulated value and a (mapped) record, returns the new accumulated
+    value (None -> the list of records is returned)
+    :param initial: the initial accumulated value (copied)
+    :return: the accumulated value or the list of records of the range
+    """
+
+    result = copy.deepcopy(initial) if reduce_fn is not None else []
+
+    for position, line in _read_range(path, start, end):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            logger_err.error("Errored line at offset {} of file '{}'".format(position, path))
+            continue
+
+        if filter_fn is not None and not filter_fn(record):
+            continue
+        if map_fn is not None:
+            record = map_fn(record)
+
+        if reduce_fn is not None:
+            result = reduce_fn(result, record)
+        else:
+            result.append(record)
+
+    return result
+
+
+def _read_range(path: str, start: int, end: int):
+    if compression.codec_of(path) is not None:
+        # Blocks of a compressed file (offsets relative to the decompressed range)
+        position = 0
+        for line in compression.read_blocks(path, start, end):
+            yield position, line
+            position += len(line)
+        return
+
+    with open(path, "rb") as file:
+        file.seek(start)
+        position = start
+        while position < end:
+            line = file.readline()
+            if not line:
+                break
+            yield position, line
+            position += len(line)
+
+
+def scan(path: str, map_fn: Optional[Callable] = None, filter_fn: Optional[Callable] = None,
+         reduce_fn: Optional[Callable] = None, initial=None, combine_fn: Optional[Callable] = None,
+         workers: Optional[int] = None):
+    """
+    Given a path to a .jsonl file, splits it into byte ranges that are decoded in parallel (a process per range) and
+    applies to the records the given functions (filter -> map -> reduce). The functions must be defined at module
+    level (so that they can be sent to the processes)
+
+    :param path: str - path to the .jsonl file
+    :param map_fn: function/None - applied to each record (None -> the record itself)
+    :param filter_fn: function/None - only the records for which it returns True are kept (None -> all of them)
+    :param reduce_fn: function/None - given the accumulated value and a (mapped) record, returns the new accumulated
+    value (None -> the list of records is returned, in the order of the file)
+    :param initial: the initial accumulated value of each range
+    :param combine_fn: function/None - given two accumulated values (of different ranges), returns them combined
+    (required if reduce_fn is provided)
+    :param workers: int/None - number of processes (None -> number of CPUs)
+    :return: the accumulated value or the list of records of the file
+    """
+
+    workers = workers if workers is not None else os.cpu_count()
+
+    if os.path.getsize(path) < min_parallel_size or workers <= 1:
+        ranges = [(0, os.path.getsize(path))]
+        partials = [scan_range(path, 0, ranges[0][1], map_fn, filter_fn, reduce_fn, initial)]
+    else:
+        ranges = split_file(path, workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(scan_range, path, start, end, map_fn, filter_fn, reduce_fn, initial)
+                       for start, end in ranges]
+            partials = [future.result() for future in futures]
+
+    logger.debug("'{}' scanned in {} ranges".format(path, len(ranges)))
+
+    if reduce_fn is None:
+        return [record for partial in partials for record in partial]
+
+    result = partials[0]
+    for partial in partials[1:]:
+        result = combine_fn(result, partial)
+
+    return result
+
+
+def iter_records(path: str, map_fn: Optional[Callable] = None, filter_fn: Optional[Callable] = None,
+                 workers: Optional[int] = None):
+    """
+    Given a path to a .jsonl file, yields its records (filtered and mapped) in the order of the file, decoding them in
+    parallel by ranges (only a few ranges are kept in memory at the same time)
+
+    :param path: str - path to the .jsonl file
+    :param map_fn: function/None - applied to each record (None -> the record itself)
+    :param filter_fn: function/None - only the records for which it returns True are kept (None -> all of them)
+    :param workers: int/None - number of processes (None -> number of CPUs)
+    :return: generator - the records
+    """
+
+    workers = workers if workers is not None else os.cpu_count()
+    ranges = split_file(path, max(1, os.path.getsize(path) // stream_range_size))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for start, end in ranges:
+            pending.append(executor.submit(scan_range, path, start, end, map_fn, filter_fn))
+            # Keep the processes busy but don't decode the whole file in advance
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# The modules of the project are at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# The modules log to (and some of them write to) relative paths: run the tests in a temporary directory
+os.chdir(tempfile.mkdtemp(prefix="tests_"))
@@ -0,0 +1,60 @@
+import json
+import random
+#####
+import pytest
+#####
+import account_matcher
+
+pytest.importorskip("numpy")
+
+
+@pytest.fixture
+def accounts(tmp_path):
+    generator = random.Random(7)
+    path = str(tmp_path / "accounts.jsonl")
+    rows = []
+    with open(path, "w") as output:
+        for i in range(5000):
+            row = {"acc_id": "t2_{}".format(i), "username": "user_{}".format(i),
+                   "created": 1400000000 + generator.randrange(86400 * 200), "updated": 1600000000,
+                   "comment_karma": generator.choice([0, generator.randrange(1, 300)]),
+                   "link_karma": generator.randrange(0, 300)}
+            rows.append(row)
+            output.write(json.dumps(row) + "\n")
+
+    return path, rows
+
+
+def brute_force(rows: list, author: dict, days_diff: int, similarity_karma: float, size: int):
+    ranges = account_matcher.similarity_ranges(author["created"], author["comment_karma"], author["link_karma"],
+                                               days_diff, similarity_karma)
+    return [row for row in rows
+            if all(low <= row[field] <= high for (low, high), field in
+                   zip(ranges, ("created", "comment_karma", "link_karma")))][:size]
+
+
+def test_similar_candidates(accounts):
+    path, rows = accounts
+    table = account_matcher.AccountTable.load(path)
+    authors = rows[:300]
+
+    result = table.similar_candidates(authors, 30, 0.1)
+    assert [author for author, _ in result] == authors
+    assert any(candidates for _, candidates in result)
+    for author, candidates in result:
+        assert candidates == brute_force(rows, author, 30, 0.1, account_matcher.max_candidates)
+        ranges = account_matcher.similarity_ranges(author["created"], author["comment_karma"], author["link_karma"],
+                                                   30, 0.1)
+        assert candidates == table.candidates(ranges)
+
+    assert table.similar_candidates([], 30, 0.1) == []
+    assert [len(c) for _, c in table.similar_candidates(authors, 30, 0.1, size=3)] == \
+        [min(3, len(c)) for _, c in result]
+
+
+def test_lookup(accounts):
+    path, rows = accounts
+    table = account_matcher.AccountTable.load(path)
+
+    assert table.lookup(["user_10", "nobody", "user_4999"]) == [rows[10], None, rows[4999]]
+    assert table.lookup(["t2_42"], "acc_id") == [rows[42]]
@@ -0,0 +1,63 @@
+import json
+import math
+#####
+import pytest
+#####
+import columnar
+import compression
+
+pytest.importorskip("pyarrow")
+
+records = [
+    {"id": "a1", "created_utc": 1500000000, "author": "alice", "subreddit": "depression", "body": "first"},
+    {"id": "a2", "created_utc": 1500000001, "author": "bob", "subreddit": "depression", "body": "second",
+     "score": 3, "gildings": {"gid_1": 1}, "awards": [{"name": "gold", "count": 2}]},
+    {"id": "a3", "created_utc": 1500000002, "author": "alice", "subreddit": "AskReddit", "body": None,
+     "edited": 1500000100.5, "stickied": False},
+    {"id": "a4", "created_utc": 1500000003, "author": "carol", "subreddit": "AskReddit", "body": "fourth",
+     "edited": False, "gildings": {}, "media": "text"},
+]
+
+
+def loaded_records(path: str, columns=None):
+    # Records of the DataFrame without the missing values (nulls of the fields not in the record)
+    data = columnar.load_backup(path, columns)
+    return [{key: value for key, value in row.items()
+             if value is not None and not (isinstance(value, float) and math.isnan(value))}
+            for row in data.to_dict("records")]
+
+
+def expected_records(columns=None):
+    return [{key: value for key, value in record.items() if value is not None and (columns is None or key in columns)}
+            for record in records]
+
+
+@pytest.mark.parametrize("extension", [".jsonl", ".jsonl.gz"])
+def test_round_trip(tmp_path, extension):
+    path = str(tmp_path / ("posts" + extension))
+    with compression.open_file(path, "w") as output:
+        for record in records:
+            output.write(json.dumps(record) + "\n")
+
+    # The fields of all the records are saved, not only the ones of the first record
+    assert loaded_records(path) == expected_records()
+
+    with compression.open_file(path, "r") as input_file:
+        assert [json.loads(line) for line in input_file] == records
+
+
+def test_inferred_types(tmp_path):
+    path = str(tmp_path / "posts.jsonl")
+    with open(path, "w") as output:
+        for record in records:
+            output.write(json.dumps(record) + "\n")
+
+    columnar.convert(path)
+    schema = columnar.parquet.read_schema(columnar.columnar_path(path))
+    assert str(schema.field("score").type) == "int64"
+    assert str(schema.field("stickied").type) == "bool"
+    assert str(schema.field("media").type) == "string"
+    assert json.loads(schema.metadata[columnar.json_key]) == ["gildings", "awards", "edited"]
+
+    # Only the requested columns are loaded (and decoded)
+    assert loaded_records(path, ["id", "gildings"]) == expected_records(["id", "gildings"])
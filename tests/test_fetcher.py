@@ -0,0 +1,106 @@
+import os
+import json
+import functools
+#####
+import pytest
+#####
+import fetcher
+import line_index
+import pushshift_replay
+#####
+from concurrent.futures import Future
+
+# Newest date of the synthetic corpus (see pushshift_replay.synthetic_corpus)
+corpus_end = 1600000000
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = pushshift_replay.serve(synthetic=3000, port=0)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def replay(server, monkeypatch):
+    monkeypatch.setenv("PUSHSHIFT_URL", server.url)
+    monkeypatch.setattr(fetcher, "pushshift_url", server.url)
+    return server
+
+
+def backup_ids(path: str):
+    with open(path) as input_file:
+        return [json.loads(line)["id"] for line in input_file]
+
+
+def run_in(path, monkeypatch):
+    os.makedirs(os.path.join(str(path), "backups"))
+    monkeypatch.chdir(str(path))
+
+
+def test_sharded_matches_unsharded(replay, tmp_path, monkeypatch):
+    filename = "r_depression_posts_{}_base.jsonl".format(corpus_end + 1)
+
+    run_in(tmp_path / "unsharded", monkeypatch)
+    result = fetcher.extract_historic_for_subreddit("depression", False, corpus_end + 1)
+    expected = backup_ids(os.path.join("backups", filename))
+    assert result["ok_docs"] == len(expected) > 0
+
+    run_in(tmp_path / "sharded", monkeypatch)
+    result = fetcher.extract_historic_for_subreddit_sharded("depression", False, corpus_end + 1, n_shards=4)
+    path = os.path.join("backups", filename)
+    assert result["ok_docs"] == len(expected)
+    assert backup_ids(path) == expected
+
+    # Only the merged file (and its index) is left
+    assert not [name for name in os.listdir("backups") if name.endswith("_shards")]
+    offsets, _ = line_index.load_index(path)
+    assert len(offsets) == len(expected)
+
+
+def test_interrupted_search_is_resumed(replay, tmp_path, monkeypatch):
+    run_in(tmp_path / "complete", monkeypatch)
+    fetcher.extract_historic_for_subreddit("depression", False, corpus_end + 1)
+    expected = backup_ids(os.path.join("backups", "r_depression_posts_{}_base.jsonl".format(corpus_end + 1)))
+
+    # Checkpoints every 100 posts and an I/O error after 550 posts
+    run_in(tmp_path / "resumed", monkeypatch)
+    extract_window = fetcher.extract_window_for_subreddit
+    monkeypatch.setattr(fetcher, "extract_window_for_subreddit", functools.partial(extract_window,
+                                                                                  checkpoint_every=100))
+    convert_response, calls = fetcher.convert_response, []
+
+    def failing_convert(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 550:
+            raise OSError("Disk full")
+        return convert_response(*args, **kwargs)
+
+    monkeypatch.setattr(fetcher, "convert_response", failing_convert)
+    monkeypatch.setattr(fetcher.date_utils, "get_current_date", lambda is_str: corpus_end + 1)
+    assert fetcher.extract_historic_for_subreddit("depression") is None
+
+    # Without date, the next run (at a later date) resumes the interrupted one from its last checkpoint
+    calls.clear()
+    monkeypatch.setattr(fetcher.date_utils, "get_current_date", lambda is_str: corpus_end + 3600)
+    result = fetcher.extract_historic_for_subreddit("depression")
+    path = os.path.join("backups", "r_depression_posts_{}_base.jsonl".format(corpus_end + 1))
+    assert result["ok_docs"] == len(expected)
+    assert backup_ids(path) == expected
+    assert len(calls) < len(expected)
+    name = os.path.basename(path)
+    assert sorted(os.listdir("backups")) == [name, name + ".ckpt", name + ".idx"]
+
+    # A completed search is not resumed
+    assert fetcher.interrupted_start_date("depression", False) is None
+
+
+def test_failed_block_is_skipped():
+    buffer = fetcher.record_writer.RecordBuffer()
+    failed, searched = Future(), Future()
+    failed.set_result((None, [{"id": "a"}]))
+    searched.set_result(({"elapsed_time": 0.1}, [{"id": "b"}, {"id": "c"}]))
+
+    assert fetcher._write_block(failed, buffer, 0) == 0
+    assert fetcher._write_block(searched, buffer, 0) == 2
+    assert [post["id"] for post in buffer.records] == ["b", "c"]
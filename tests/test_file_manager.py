@@ -0,0 +1,119 @@
+import os
+import json
+import random
+#####
+import pytest
+#####
+import compression
+import file_manager
+
+extensions = [".jsonl", ".jsonl.gz",
+              pytest.param(".jsonl.zst", marks=pytest.mark.skipif(compression.zstandard is None,
+                                                                   reason="zstandard not installed"))]
+
+
+def posts(ids, seed: int = 0):
+    # Few different dates, so that there are many equal keys
+    generator = random.Random(seed)
+    return [{"id": str(i), "created_utc": 1500000000 + generator.randrange(50), "body": "x" * generator.randrange(80)}
+            for i in ids]
+
+
+def write(path: str, records: list):
+    with compression.open_file(path, "w") as output:
+        for record in records:
+            output.write(json.dumps(record) + "\n")
+
+
+def read(path: str):
+    with compression.open_file(path, "r") as input_file:
+        return [json.loads(line) for line in input_file]
+
+
+def created(record: dict):
+    return record["created_utc"]
+
+
+def leftovers(directory, expected: list):
+    # Files of the directory other than the expected ones (and their blocks sidecars)
+    return sorted(name for name in os.listdir(str(directory))
+                  if name not in expected and name not in [compression.blocks_path(e) for e in expected])
+
+
+@pytest.mark.parametrize("extension", extensions)
+@pytest.mark.parametrize("reverse", [True, False])
+def test_sort_file_in_runs(tmp_path, monkeypatch, extension, reverse):
+    path = str(tmp_path / ("posts" + extension))
+    records = posts(range(2000))
+    write(path, records)
+
+    # Count the runs spilled to disk
+    spilled = []
+    mkstemp = file_manager.tempfile.mkstemp
+
+    def counting_mkstemp(*args, **kwargs):
+        spilled.append(kwargs.get("suffix"))
+        return mkstemp(*args, **kwargs)
+
+    monkeypatch.setattr(file_manager.tempfile, "mkstemp", counting_mkstemp)
+    file_manager.sort_file(path, "created_utc", reverse=reverse, memory_budget=4096)
+
+    assert spilled.count(".run") > 10
+    # Stable: the records with the same date keep the order of the file
+    assert read(path) == sorted(records, key=created, reverse=reverse)
+    if compression.codec_of(path) is not None:
+        assert compression.count_lines(path) == len(records)
+    assert leftovers(tmp_path, [os.path.basename(path)]) == []
+
+
+def test_sort_file_missing_field(tmp_path):
+    path = str(tmp_path / "posts.jsonl")
+    records = posts(range(100)) + [{"id": "no_date"}]
+    write(path, records)
+
+    file_manager.sort_file(path, "created_utc", memory_budget=512)
+
+    # Not sorted, and the file is left as it was
+    assert read(path) == records
+    assert leftovers(tmp_path, ["posts.jsonl"]) == []
+
+
+@pytest.mark.parametrize("extension", extensions)
+def test_merge_sorted_files_dedupe(tmp_path, extension):
+    # Overlapping ranges of ids (the same post in several files has the same date)
+    everything = posts(range(1000))
+    paths = []
+    for i, (start, end) in enumerate([(0, 400), (300, 700), (650, 1000), (0, 50), (990, 1000)]):
+        paths.append(str(tmp_path / ("part_{}{}".format(i, extension))))
+        write(paths[-1], sorted(everything[start:end], key=created, reverse=True))
+    save_path = str(tmp_path / ("merged" + extension))
+
+    # Several passes (at most 2 files opened at the same time)
+    file_manager.merge_sorted_files(paths, save_path, "created_utc", max_open=2, dedupe=True)
+
+    merged = read(save_path)
+    assert [created(record) for record in merged] == sorted((created(record) for record in everything), reverse=True)
+    assert sorted(record["id"] for record in merged) == sorted(record["id"] for record in everything)
+    assert leftovers(tmp_path, [os.path.basename(path) for path in paths + [save_path]]) == []
+
+
+@pytest.mark.parametrize("extension", extensions)
+def test_merge_backups(tmp_path, monkeypatch, extension):
+    os.makedirs(str(tmp_path / "backups"))
+    monkeypatch.chdir(str(tmp_path))
+    everything = posts(range(600), seed=1)
+    first, second = everything[:400], everything[250:]
+    write(os.path.join("backups", "first" + extension), sorted(first, key=created, reverse=True))
+    write(os.path.join("backups", "second" + extension), sorted(second, key=created, reverse=True))
+
+    assert file_manager.merge_backups("first" + extension, "second" + extension, ordered=True, dedupe=True)
+
+    merged = read(os.path.join("backups", "first" + extension))
+    # The records of the first file come first among the ones with the same date
+    expected = sorted(first + [record for record in second if record not in first], key=created, reverse=True)
+    assert merged == expected
+    assert leftovers(tmp_path / "backups", ["first" + extension, "second" + extension]) == []
+
+    # Appended without order
+    assert file_manager.merge_backups("second" + extension, "first" + extension)
+    assert read(os.path.join("backups", "second" + extension)) == sorted(second, key=created, reverse=True) + merged
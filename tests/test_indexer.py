@@ -0,0 +1,46 @@
+import json
+#####
+import pytest
+#####
+import indexer
+
+
+def csv_block(n: int):
+    return "".join("t2_{0},user_{0}{1},{2},1600000000,{3},{4}\n".format(i, "x" * (i % 50), 1300000000 + i, i, 2 * i)
+                   for i in range(n)).encode()
+
+
+def documents(batches: list):
+    lines = "".join(body for _, body in batches).splitlines()
+    return [json.loads(line) for line in lines[1::2]]
+
+
+@pytest.mark.parametrize("arrow", [True, False])
+@pytest.mark.parametrize("max_chunk_bytes", [None, 1000, 10])
+def test_bulk_batches_limits(monkeypatch, arrow, max_chunk_bytes):
+    if not arrow:
+        monkeypatch.setattr(indexer, "pyarrow", None)
+    elif indexer.pyarrow is None:
+        pytest.skip("pyarrow not installed")
+
+    batches = indexer.build_bulk_batches(csv_block(500), "users", 100, skip=3, max_chunk_bytes=max_chunk_bytes)
+
+    assert sum(n for n, _ in batches) == 497
+    assert [doc["acc_id"] for doc in documents(batches)] == ["t2_{}".format(i) for i in range(3, 500)]
+    for n, body in batches:
+        assert 0 < n <= 100
+        assert body.count("\n") == 2 * n
+        if max_chunk_bytes is not None:
+            # Only a single document can exceed the limit
+            assert len(body.encode("utf-8")) <= max_chunk_bytes or n == 1
+    if max_chunk_bytes == 10:
+        assert len(batches) == 497
+
+
+def test_chunk_bounds():
+    offsets = [0, 10, 20, 30, 100, 110]
+
+    assert indexer.chunk_bounds(offsets, 2) == [(0, 2), (2, 4), (4, 5)]
+    assert indexer.chunk_bounds(offsets, 10, 30) == [(0, 3), (3, 4), (4, 5)]
+    assert indexer.chunk_bounds(offsets, 10, 5) == [(i, i + 1) for i in range(5)]
+    assert indexer.chunk_bounds([0], 10, 5) == []
@@ -0,0 +1,126 @@
+import json
+import random
+#####
+import pytest
+#####
+import questioner
+from elasticsearch_dsl import Search
+
+indices = {"r_depression_users_info", "reddit_users_info"}
+
+
+def matches(query: dict, doc: dict):
+    # Evaluates the queries built by questioner (match, range and bool must/filter)
+    kind, value = next(iter(query.items()))
+    if kind == "match":
+        field, expected = next(iter(value.items()))
+        return doc.get(field) == expected
+    if kind == "range":
+        field, limits = next(iter(value.items()))
+        return limits.get("gte", doc[field]) <= doc[field] <= limits.get("lte", doc[field])
+    if kind == "bool":
+        return all(matches(q, doc) for key in ("must", "filter") for q in value.get(key, []))
+    if kind == "match_all":
+        return True
+    raise ValueError("Unknown query: {}".format(kind))
+
+
+class FakeElasticsearch:
+    """
+    In-memory client answering the searches and multi searches of questioner, counting the requests
+    """
+
+    def __init__(self, docs: dict, failing: tuple = ()):
+        # The account lookups of the 'failing' account ids return an error
+        self.docs = docs
+        self.failing = failing
+        self.requests = {"search": 0, "msearch": 0}
+
+    def _search(self, index, body: dict):
+        index = index[0] if isinstance(index, (list, tuple)) else index
+        if index not in indices:
+            raise ValueError("Unknown index: {}".format(index))
+        query = body.get("query", {"match_all": {}})
+        if query.get("match", {}).get("acc_id") in self.failing:
+            return {"error": {"type": "search_phase_execution_exception"}, "status": 400}
+        hits = [{"_index": index, "_id": str(doc["acc_id"]), "_score": 1.0, "_source": doc}
+                for doc in self.docs[index] if matches(query, doc)]
+        return {"took": 1, "timed_out": False, "hits": {"total": {"value": len(hits), "relation": "eq"},
+                                                        "max_score": 1.0, "hits": hits[:body.get("size", 10)]}}
+
+    def search(self, index=None, body=None, **kwargs):
+        self.requests["search"] += 1
+        return self._search(index, body if body is not None else kwargs)
+
+    def msearch(self, body, index=None, **kwargs):
+        self.requests["msearch"] += 1
+        return {"responses": [self._search(header.get("index", index), query)
+                              for header, query in zip(body[0::2], body[1::2])]}
+
+
+def users(n: int, seed: int):
+    generator = random.Random(seed)
+    return [{"acc_id": i, "username": "user_{}_{}".format(seed, i),
+             "created": 1300000000 + generator.randrange(10 ** 8), "updated": 1600000000,
+             "comment_karma": generator.randrange(1, 5000),
+             "link_karma": generator.randrange(1, 5000)} for i in range(n)]
+
+
+def per_author_candidates(es, authors: list, days_diff: int, similarity_karma: float):
+    # Same searches as 'search_similar_candidates', one request per author and query
+    result = []
+    for author in authors:
+        response = Search(using=es, index="r_depression_users_info").query("match", acc_id=author["acc_id"]).execute()
+        if len(response.hits) > 0:
+            found = response.hits[0].to_dict()
+            q = questioner.similar_authors_query(found, days_diff, similarity_karma)
+            response = Search(using=es, index="reddit_users_info").filter(q).execute()
+            result.append((found, [hit.to_dict() for hit in response]))
+    return result
+
+
+@pytest.fixture
+def docs():
+    return {"r_depression_users_info": users(200, 1), "reddit_users_info": users(2000, 2)}
+
+
+def test_multi_search_matches_per_author_search(docs):
+    # Some authors are not in the index
+    authors = [{"acc_id": i} for i in range(0, 260, 2)]
+
+    es = FakeElasticsearch(docs)
+    expected = per_author_candidates(es, authors, 30, 0.1)
+    assert es.requests == {"search": 2 * len(expected) + len(authors) - len(expected), "msearch": 0}
+    assert any(hits for _, hits in expected)
+
+    es = FakeElasticsearch(docs)
+    assert questioner.search_similar_candidates(es, authors, 30, 0.1) == expected
+    assert es.requests == {"search": 0, "msearch": 2}
+
+
+def test_failed_sub_search_skips_only_its_author(docs):
+    authors = [{"acc_id": i} for i in range(10)]
+
+    es = FakeElasticsearch(docs, failing=(3,))
+    expected = [c for c in per_author_candidates(FakeElasticsearch(docs), authors, 30, 0.1) if c[0]["acc_id"] != 3]
+    assert questioner.search_similar_candidates(es, authors, 30, 0.1) == expected
+
+
+def test_generate_reference_authors_requests(docs, tmp_path, monkeypatch):
+    sample = tmp_path / "sample.jsonl"
+    with open(sample, "w") as output:
+        for user in docs["r_depression_users_info"]:
+            output.write(json.dumps(user) + "\n")
+    subreddit_authors = tmp_path / "authors.txt"
+    subreddit_authors.write_text("\n".join(user["username"] for user in docs["r_depression_users_info"]))
+
+    es = FakeElasticsearch(docs)
+    monkeypatch.setattr(questioner.es_client, "get_client", lambda *args: es)
+    questioner.generate_reference_authors(str(sample), str(subreddit_authors), 30, 0.1, batch_size=100,
+                                          save_path=str(tmp_path / "ref.jsonl"))
+
+    # 200 authors in batches of 100: a multi search for the accounts and another one for the candidates per batch
+    # (instead of 2 searches per author)
+    assert es.requests == {"search": 0, "msearch": 4}
+    with open(tmp_path / "ref.jsonl") as input_file:
+        assert len([json.loads(line) for line in input_file]) > 0
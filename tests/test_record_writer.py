@@ -0,0 +1,52 @@
+import os
+#####
+import compression
+import line_index
+import record_writer
+
+
+def write_records(path: str, start: int, n: int, mode: str = "a"):
+    with record_writer.RecordWriter(path, mode, flush_records=7, index=True) as writer:
+        for i in range(start, start + n):
+            writer.write({"id": str(i), "created_utc": 1500000000 + i, "body": "post {}".format(i)})
+
+
+def test_append_keeps_index_consistent(tmp_path):
+    path = str(tmp_path / "posts.jsonl")
+
+    write_records(path, 0, 50, "w")
+    write_records(path, 50, 30)
+    write_records(path, 80, 1)
+
+    offsets, keys = line_index.load_index(path)
+    assert line_index.count_lines(path) == len(offsets) == 81
+    assert list(keys) == [1500000000 + i for i in range(81)]
+    with open(path, "rb") as file:
+        lines = file.readlines()
+    assert list(offsets) == [sum(len(line) for line in lines[:i]) for i in range(len(lines))]
+    assert line_index.read_line(path, 42, offsets).startswith('{"id": "42"')
+
+
+def test_truncated_file_rebuilds_index(tmp_path):
+    path = str(tmp_path / "posts.jsonl")
+
+    write_records(path, 0, 20, "w")
+    offsets, _ = line_index.load_index(path)
+    with open(path, "ab") as file:
+        file.truncate(offsets[10])
+    assert line_index.load_index(path) is None
+
+    # The next writer reindexes the file before appending to it
+    write_records(path, 10, 5)
+    offsets, keys = line_index.load_index(path)
+    assert line_index.count_lines(path) == len(offsets) == 15
+    assert list(keys) == [1500000000 + i for i in range(15)]
+
+
+def test_compressed_files_are_not_indexed(tmp_path):
+    path = str(tmp_path / "posts.jsonl.gz")
+
+    write_records(path, 0, 20, "w")
+    write_records(path, 20, 5)
+    assert not os.path.isfile(line_index.index_path(path))
+    assert compression.count_lines(path) == 25
@@ -1,7 +1,10 @@
 import logging
 import json
 import os
+import math
+import zlib
 #####
+import compression
 import logging_factory
 #####
 from typing import Optional
@@ -9,26 +12,26 @@ from typing import Optional
 logger_err = logging_factory.get_module_logger("tools_err", logging.ERROR)
 logger = logging_factory.get_module_logger("tools", logging.DEBUG)
 
+# Default memory budget (bytes) of the comments loaded by 'link_comments_and_submissions'
+link_memory_budget = 512 * 1024 * 1024
 
-def obtain_usernames(subr_path: str):
+
+def obtain_usernames(subr_path: str, workers: Optional[int] = None):
     """
-    Given the path of the backup, generates one .txt file containing the authors in the backup
+    Given the path of the backup, generates one .txt file containing the authors in the backup (the backup is read in
+    parallel, see scanner)
 
     :param subr_path: str - path to the file (i.e subreddit file)
+    :param workers: int/None - number of processes reading the backup (None -> number of CPUs)
     """
 
+    import scanner
+
     subr_authors = set()
 
     try:
-        with open(subr_path, "r") as input_file:
-            for line in input_file:
-                try:
-                    loaded = json.loads(line)
-                    author = loaded["author"]
-                    if author != "[deleted]":
-                        subr_authors.add(author)
-                except KeyError:
-                    logger_err.error("Error in author key with post with ID: {}".format(loaded["id"]))
+        subr_authors = scanner.scan(subr_path, reduce_fn=add_author, initial=set(), combine_fn=set.union,
+                                    workers=workers)
     except (OSError, IOError):
         logger_err.error("Read/Write error has occurred")
 
@@ -41,6 +44,25 @@ def obtain_usernames(subr_path: str):
         logger_err.error("Read/Write error has occurred")
 
 
+def add_author(authors: set, post: dict):
+    """
+    Given a set of authors and a post, adds the author of the post to the set (unless deleted)
+
+    :param authors: set[str] - the authors
+    :param post: dict - the post
+    :return: set[str] - the authors
+    """
+
+    try:
+        author = post["author"]
+        if author != "[deleted]":
+            authors.add(author)
+    except KeyError:
+        logger_err.error("Error in author key with post with ID: {}".format(post.get("id")))
+
+    return authors
+
+
 def list_excluded_subreddits(path: str, additional: Optional[list] = None):
     """
     Given a path to a file containing names of subreddits to be excluded and any other additional (and optional)
@@ -55,7 +77,7 @@ def list_excluded_subreddits(path: str, additional: Optional[list] = None):
     subreddits = []
     try:
         if os.path.isfile(path):
-            with open(path, "r") as output:
+            with compression.open_file(path, "r") as output:
                 for subreddit in output:
                     subreddits.append(subreddit.strip("\n"))
     except (OSError, IOError):
@@ -69,92 +91,235 @@ def list_excluded_subreddits(path: str, additional: Optional[list] = None):
     return subreddits
 
 
-def systematic_authors_sample(authors_info_path: str, sample_size: int):
+def systematic_authors_sample(authors_info_path: str, sample_size: int,
+                              save_path: str = "./data/subr_authors_selected.jsonl", export: Optional[str] = None):
     """
-    Given the path to a .jsonl file containing the info of the authors, generates another .jsonl file and an excel file
-    containing the authors selected using systematic sampling (of the size given as parameter)
+    Given the path to a .jsonl file containing the info of the authors, generates another .jsonl file containing the
+    authors selected using systematic sampling (of the size given as parameter). The file is read as a stream (the lines
+    are not decoded), so the memory used doesn't depend on its size
 
     :param authors_info_path: str - path to the .jsonl file containing the info of the authors
     :param sample_size: int - the size of the sample to be generated
+    :param save_path: str - path to the .jsonl file to be generated
+    :param export: str/None - also export the sample as a table: "csv", "parquet" or "xlsx" (None -> not exported)
     """
 
     import random
-    import math
-    import pandas as pd
+    import file_manager
 
     logger.debug("Starting systematic sampling generation...")
 
-    authors = []
-    # Load all the collection of users' data
-    try:
-        with open(authors_info_path, "r") as input_file:
-            for auth in input_file:
-                authors.append(json.loads(auth))
-    except (OSError, IOError):
-        logger_err.error("Read/Write error has occurred")
-    logger.debug("Total amount of authors in file: {}".format(len(authors)))
+    # Number of authors (from the index/blocks of the file if available, see file_manager)
+    total = file_manager.count_lines_file(authors_info_path)
+    logger.debug("Total amount of authors in file: {}".format(total))
 
-    selected = []
-    # Systematic sampling
-    k = len(authors) / sample_size
+    # Systematic sampling: the positions are computed as the file is read
+    k = total / sample_size if sample_size > 0 else 0
     starting_point = random.random() * k
-    while starting_point <= len(authors):
-        index = math.ceil(starting_point) - 1
-        selected.append(authors[index])
-        starting_point += k
-
-    # Backup list to .jsonl and .xlsx
+    selected = 0
     try:
-        with open("./data/subr_authors_selected.jsonl", "w+") as output:
-            for auth in selected:
-                output.write(json.dumps(auth))
-                output.write("\n")
+        with compression.open_file(authors_info_path, "r") as input_file:
+            with open(save_path, "w+") as output:
+                for i, auth in enumerate(input_file):
+                    if k <= 0 or starting_point > total:
+                        break
+                    # Same author more than once if the sample is bigger than the file
+                    while math.ceil(starting_point) - 1 <= i and starting_point <= total:
+                        output.write(auth if auth.endswith("\n") else auth + "\n")
+                        selected += 1
+                        starting_point += k
     except (OSError, IOError):
         logger_err.error("Read/Write error has occurred")
+        return
 
-    df = pd.DataFrame(selected)
-    df.to_excel("./data/subr_authors_selected.xlsx")
+    if export is not None:
+        export_table(save_path, export)
 
-    logger.debug("Sample generated")
+    logger.debug("Sample generated ({} authors)".format(selected))
 
 
-def link_comments_and_submissions(submissions_path: str, comments_path: str, merge_path: str, remove_op: bool = False):
+def export_table(path: str, file_format: str = "csv"):
+    """
+    Given the path to a .jsonl file, exports its records as a table (next to it, with the extension of the format)
+
+    :param path: str - path to the .jsonl file
+    :param file_format: str - "csv", "parquet" (requires pyarrow) or "xlsx" (much slower)
+    :return: str - path to the exported file
+    """
+
+    import pandas as pd
+
+    with compression.open_file(path, "r") as input_file:
+        df = pd.read_json(input_file, lines=True)
+
+    save_path = os.path.splitext(path)[0] + "." + file_format
+    if file_format == "csv":
+        df.to_csv(save_path, index=False)
+    elif file_format == "parquet":
+        df.to_parquet(save_path, index=False)
+    elif file_format == "xlsx":
+        df.to_excel(save_path)
+    else:
+        raise ValueError("Unknown table format: '{}'".format(file_format))
+
+    logger.debug("'{}' exported to '{}'".format(path, save_path))
+
+    return save_path
+
+
+def link_comments_and_submissions(submissions_path: str, comments_path: str, merge_path: str, remove_op: bool = False,
+                                  memory_budget: Optional[int] = None):
     """
     Given the paths to the submissions and comments files, generates a .jsonl file containing the links between them
+    (each submission with the list of its comments). The comments file is read only once to build an index by the
+    submission they belong to; if it doesn't fit in the memory budget, both files are split in partitions (by
+    submission) that are linked one at a time. The submissions keep the order of the submissions file
 
     :param submissions_path: str - path to the submissions file
     :param comments_path: str - path to the comments file
     :param merge_path: str - path to the file to be generated
     :param remove_op: bool - whether to remove OP comments
+    :param memory_budget: int/None - maximum size (bytes, uncompressed) of the comments loaded at the same time (None
+    -> module default)
     """
 
+    import heapq
+    import shutil
+    import tempfile
+
+    budget = memory_budget if memory_budget is not None else link_memory_budget
     merge_path = merge_path if not remove_op else merge_path.replace(".jsonl", "_no_op.jsonl")
-    with open(merge_path, "a") as outfile:
-        with open(submissions_path, "r") as submissions_file:
-            for submission in submissions_file:
-                submission = json.loads(submission)
-                submission_id = submission["id"]
-                op = submission["author"]
-                comments = get_all_comments_for_id(submission_id, comments_path, remove_op, op)
-                submission["comments"] = comments
-                if submission["num_comments"] != len(comments):
-                    logger.debug(f"Submission {submission_id} has{submission['num_comments']} comments, but {len(comments)} comments were found")
-                json.dump(submission, outfile)
+
+    logger.debug("Linking comments and submissions...")
+
+    # The budget is compared with the decompressed comments (a compressed file takes several times its size in memory)
+    comments_size = compression.uncompressed_size(comments_path)
+    if comments_size <= budget:
+        index = index_comments(comments_path)
+        with compression.open_file(merge_path, "a") as outfile:
+            with compression.open_file(submissions_path, "r") as submissions_file:
+                for submission in submissions_file:
+                    outfile.write(link_submission(json.loads(submission), index, remove_op))
+                    outfile.write("\n")
+        return
+
+    # Partition both files by submission so that the comments of each partition fit in memory
+    n_partitions = 2 * math.ceil(comments_size / budget)
+    logger.debug("Comments don't fit in memory, linking in {} partitions...".format(n_partitions))
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(merge_path)))
+    try:
+        comments_parts = [open(os.path.join(tmp_path, "comments_{}".format(i)), "w") for i in range(n_partitions)]
+        with compression.open_file(comments_path, "r") as comments_file:
+            for comment in comments_file:
+                link_id = submission_id_of(json.loads(comment)["link_id"])
+                comments_parts[zlib.crc32(link_id.encode()) % n_partitions].write(comment)
+        for part in comments_parts:
+            part.close()
+
+        # Submissions are numbered to restore their order at the end
+        submissions_parts = [open(os.path.join(tmp_path, "submissions_{}".format(i)), "w")
+                             for i in range(n_partitions)]
+        with compression.open_file(submissions_path, "r") as submissions_file:
+            for i, submission in enumerate(submissions_file):
+                submission_id = json.loads(submission)["id"]
+                submissions_parts[zlib.crc32(submission_id.encode()) % n_partitions].write(
+                    "{}\t{}".format(i, submission))
+        for part in submissions_parts:
+            part.close()
+
+        for i in range(n_partitions):
+            index = index_comments(os.path.join(tmp_path, "comments_{}".format(i)))
+            with open(os.path.join(tmp_path, "submissions_{}".format(i)), "r") as submissions_file:
+                with open(os.path.join(tmp_path, "linked_{}".format(i)), "w") as outfile:
+                    for line in submissions_file:
+                        n, submission = line.split("\t", 1)
+                        outfile.write("{}\t{}\n".format(n, link_submission(json.loads(submission), index,
+                                                                              remove_op)))
+
+        # Merge the linked partitions back in the original order
+        linked = [open(os.path.join(tmp_path, "linked_{}".format(i)), "r") for i in range(n_partitions)]
+        try:
+            with compression.open_file(merge_path, "a") as outfile:
+                for line in heapq.merge(*linked, key=lambda k: int(k.split("\t", 1)[0])):
+                    outfile.write(line.split("\t", 1)[1])
+        finally:
+            for part in linked:
+                part.close()
+    finally:
+        shutil.rmtree(tmp_path)
+
+
+def submission_id_of(link_id: str):
+    """
+    Given the link identifier of a comment, returns the identifier of its submission (without the "t3_" prefix)
+
+    :param link_id: str - the link identifier of the comment
+    :return: str - the identifier of the submission
+    """
+
+    return link_id[3:] if link_id.startswith("t3_") else link_id
+
+
+def index_comments(comments_path: str):
+    """
+    Given the path to a comments file, reads it once and returns its comments grouped by the submission they belong to
+
+    :param comments_path: str - path to the comments file
+    :return: dict - submission identifier -> list[str] with the comments (raw lines)
+    """
+
+    index = {}
+    with compression.open_file(comments_path, "r") as comments_file:
+        for comment in comments_file:
+            link_id = submission_id_of(json.loads(comment)["link_id"])
+            index.setdefault(link_id, []).append(comment)
+
+    return index
+
+
+def link_submission(submission: dict, index: dict, remove_op: bool = False):
+    """
+    Given a submission and the index of comments, adds to the submission its comments and returns it serialized
+
+    :param submission: dict - the submission
+    :param index: dict - the comments grouped by submission (see 'index_comments')
+    :param remove_op: bool - whether to remove OP comments
+    :return: str - the submission (with the key "comments") serialized
+    """
+
+    submission_id = submission["id"]
+    op = submission["author"]
+
+    comments = []
+    for comment in index.get(submission_id, []):
+        comment = json.loads(comment)
+        if remove_op and comment["author"] == op:
+            continue
+        comments.append(comment)
+
+    submission["comments"] = comments
+    if submission["num_comments"] != len(comments):
+        logger.debug(f"Submission {submission_id} has {submission['num_comments']} comments, but {len(comments)} "
+                     f"comments were found")
+
+    return json.dumps(submission)
 
 
 def get_all_comments_for_id(submissions_id: str, comments_path: str, remove_op: bool = False, op: Optional[str] = None):
     """
-    Given the ID of a submission, returns all the comments related to it
+    Given the ID of a submission, returns all the comments related to it (the same as 'index_comments', with or
+    without the "t3_" prefix)
 
     :param submissions_id: str - ID of the submission
     :return: list - list of comments
     """
 
+    submissions_id = submission_id_of(submissions_id)
     comments = []
-    with open(comments_path, "r") as comments_file:
+    with compression.open_file(comments_path, "r") as comments_file:
         for comment in comments_file:
             comment = json.loads(comment)
-            comment_id = comment["link_id"]
+            comment_id = submission_id_of(comment["link_id"])
             if comment_id == submissions_id:
                 if remove_op and comment["author"] == op:
                     continue